@@ -15,15 +15,33 @@ FLUJO COMPLETO:
     Imagen en disco
         ↓
     [1] VLM (Ollama) → Genera descripción textual detallada (Captioning)
-        ↓
-    [2] CLIP Model → Genera embedding visual de la imagen
-        ↓
+        ↓                con VLM_CONCURRENCY peticiones simultáneas, reintentos
+        ↓                con espera exponencial y timeout por imagen
+    [2] CLIP Model → Genera embedding visual de la imagen (en un hilo, en
+        ↓            paralelo a las descripciones)
     [3] Metadatos → Extrae Asignatura/Tema de la estructura de carpetas
         ↓
     [4] ChromaDB → Guarda todo para futura recuperación
+
+Las imágenes cuya descripción falla tras agotar los reintentos NO se guardan:
+se listan al final de la ingesta con su error. El servidor de Ollama debe
+admitir peticiones paralelas (OLLAMA_NUM_PARALLEL) para aprovechar la concurrencia.
+
+INGESTA INCREMENTAL:
+    Las descripciones se guardan en una caché persistente (CAPTION_CACHE_PATH,
+    JSON Lines) con clave (modelo VLM, hash del prompt, hash de la imagen): solo
+    se describen las imágenes nuevas o modificadas. La colección no se borra:
+    se actualizan (upsert) las imágenes cambiadas y se eliminan las que ya no
+    están en disco. Con el argumento --completa se re-vectorizan todas las
+    imágenes (las descripciones siguen saliendo de la caché).
 ================================================================================
 """
 import os
+import sys
+import json
+import time
+import hashlib
+import asyncio
 import chromadb
 from sentence_transformers import SentenceTransformer
 from PIL import Image
@@ -49,17 +67,24 @@ CLIP_MODEL = "clip-ViT-B-32"
 VISION_MODEL = "llava" 
 DATA_DIR = "./data/imagenes"
 
+# Descripción concurrente con el VLM
+VLM_CONCURRENCY = int(os.getenv("VLM_CONCURRENCY", "4"))
+VLM_TIMEOUT = float(os.getenv("VLM_TIMEOUT", "300"))
+VLM_RETRIES = int(os.getenv("VLM_RETRIES", "3"))
+VLM_BACKOFF = float(os.getenv("VLM_BACKOFF", "2"))
+
+# Caché persistente de descripciones del VLM
+CAPTION_CACHE_PATH = os.getenv("CAPTION_CACHE_PATH") or os.path.join(DB_PATH, "captions_vlm.jsonl")
+LOTE_CHROMA = 500
+# Marca que la API compara en el refresco en caliente de sus índices BM25
+MARCA_INGESTA_PATH = os.path.join(DB_PATH, "ingesta_multimodal_knowledge.json")
+
 
 # =============================================================================
 # 2. FUNCIÓN DE DESCRIPCIÓN DE IMÁGENES (MODELO VISUAL)
 # =============================================================================
 
-def describir_imagen(ruta):
-    """
-    Usa LLaVA (Ollama) para generar una descripción detallada en español.
-    """
-    try:
-        PROMPT = """
+PROMPT_DESCRIPCION = """
         Actúa como un profesor experto de universidad hispanohablante. Analiza esta imagen con el MÁXIMO DETALLE posible.
         
         IMPORTANTE: TU RESPUESTA DEBE SER 100% EN ESPAÑOL.
@@ -75,45 +100,227 @@ def describir_imagen(ruta):
         
         REGLA DE ORO: Todo el output debe estar en CASTELLANO, incluso si el contenido original está en inglés.
         """
+HASH_PROMPT = hashlib.sha256(PROMPT_DESCRIPCION.encode("utf-8")).hexdigest()[:16]
 
-        response = ollama.chat(
-            model=VISION_MODEL,
-            messages=[{'role': 'user', 'content': PROMPT, 'images': [ruta]}]
-        )
-        return response['message']['content']
 
-    except Exception as e:
-        print(f"\n ERROR OLLAMA en {os.path.basename(ruta)}: {e}")
-        return "Sin descripción"
+def _error(e):
+    return f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+
+
+async def describir_imagen(cliente, ruta, semaforo):
+    """
+    Usa LLaVA (Ollama) para generar una descripción detallada en español.
+    Reintenta con espera exponencial; si se agotan los intentos lanza el último error.
+    """
+    for intento in range(VLM_RETRIES + 1):
+        try:
+            async with semaforo:
+                response = await asyncio.wait_for(
+                    cliente.chat(
+                        model=VISION_MODEL,
+                        messages=[{'role': 'user', 'content': PROMPT_DESCRIPCION, 'images': [ruta]}]
+                    ),
+                    timeout=VLM_TIMEOUT
+                )
+            descripcion = response['message']['content'].strip()
+            if not descripcion:
+                raise ValueError("respuesta vacía del modelo")
+            return descripcion
+
+        except Exception as e:
+            # Modelo inexistente o petición inválida: reintentar no sirve de nada
+            definitivo = isinstance(e, ollama.ResponseError) and e.status_code in (400, 404)
+            if definitivo or intento == VLM_RETRIES:
+                raise
+            espera = VLM_BACKOFF * 2 ** intento
+            logger.warning(f"[VLM] {os.path.basename(ruta)}: intento {intento + 1} fallido ({_error(e)}). "
+                           f"Reintento en {espera:g}s")
+            await asyncio.sleep(espera)
+
+
+async def describir_imagenes(pendientes, cache):
+    """
+    Describe con hasta VLM_CONCURRENCY peticiones simultáneas a Ollama las imágenes
+    de `pendientes` ({hash: ruta}). Cada descripción se guarda en la caché nada más
+    obtenerse. Devuelve {hash: error} de las que han fallado.
+    """
+    cliente = ollama.AsyncClient()
+    semaforo = asyncio.Semaphore(max(1, VLM_CONCURRENCY))
+    errores = {}
+
+    async def tarea(hash_imagen, ruta, progreso):
+        try:
+            cache.put(clave_descripcion(hash_imagen), await describir_imagen(cliente, ruta, semaforo))
+        except Exception as e:
+            errores[hash_imagen] = _error(e)
+            logger.error(f"[VLM] ERROR OLLAMA en {os.path.basename(ruta)}: {errores[hash_imagen]}")
+        finally:
+            progreso.update(1)
+
+    with tqdm(total=len(pendientes), desc="Describiendo (VLM)") as progreso:
+        await asyncio.gather(*(tarea(h, ruta, progreso) for h, ruta in pendientes.items()))
+    return errores
 
 
 # =============================================================================
-# 3. PROGRAMA PRINCIPAL
+# 3. CACHÉ DE DESCRIPCIONES E IDENTIFICADORES
 # =============================================================================
 
-def main():
-    logger.info(f"Iniciando Ingesta con doble nivel (Asignatura/Tema) en {DATA_DIR}...")
+def hash_fichero(ruta, bloque=1 << 20):
+    """
+    SHA-256 del contenido del fichero (leído por bloques).
+    """
+    h = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        for trozo in iter(lambda: f.read(bloque), b""):
+            h.update(trozo)
+    return h.hexdigest()
 
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    logger.info(f"Dispositivo seleccionado: {device.upper()}")
-    
-    if device == "cpu":
-        logger.warning("CUIDADO: Se está usando CPU.")
+def clave_descripcion(hash_imagen):
+    return f"{VISION_MODEL}|{HASH_PROMPT}|{hash_imagen}"
 
-    model = SentenceTransformer(CLIP_MODEL, device=device)
-    client = chromadb.PersistentClient(path=DB_PATH)
+def id_imagen(relativa):
+    """
+    Id estable por ruta relativa: no depende del orden del escaneo ni del resto de imágenes.
+    """
+    return "img_" + hashlib.sha256(relativa.replace(os.sep, "/").encode("utf-8")).hexdigest()[:20]
 
-    try:
-        client.delete_collection("multimodal_knowledge")
-    except:
-        pass
-    
-    collection = client.create_collection(
-        name="multimodal_knowledge",
-        metadata={"hnsw:space": "cosine"}
+
+def marcar_ingesta():
+    """
+    Avisa a la API de que la colección ha cambiado: las imágenes modificadas
+    conservan su id, así que el cambio no se ve comparando solo ids.
+    """
+    os.makedirs(os.path.dirname(MARCA_INGESTA_PATH), exist_ok=True)
+    temporal = MARCA_INGESTA_PATH + ".tmp"
+    with open(temporal, "w", encoding="utf-8") as f:
+        json.dump({"marca": f"{time.time():.6f}-{os.getpid()}"}, f)
+    os.replace(temporal, MARCA_INGESTA_PATH)
+
+
+class CacheDescripciones:
+    """
+    Almacén persistente de descripciones del VLM en JSON Lines (solo se añaden líneas).
+    Cada descripción se escribe en cuanto se obtiene: si la ingesta se interrumpe,
+    lo ya descrito no se vuelve a pedir al VLM.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.datos = {}
+        self._f = None
+        try:
+            with open(ruta, "r", encoding="utf-8") as f:
+                for linea in f:
+                    try:
+                        registro = json.loads(linea)
+                        self.datos[registro["clave"]] = registro["descripcion"]
+                    except (ValueError, KeyError, TypeError):
+                        continue  # línea cortada por una interrupción
+        except OSError:
+            pass
+
+    def __contains__(self, clave):
+        return clave in self.datos
+
+    def get(self, clave):
+        return self.datos.get(clave)
+
+    def put(self, clave, descripcion):
+        self.datos[clave] = descripcion
+        if self._f is None:
+            os.makedirs(os.path.dirname(self.ruta) or ".", exist_ok=True)
+            cortada = False
+            if os.path.exists(self.ruta) and os.path.getsize(self.ruta) > 0:
+                with open(self.ruta, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    cortada = f.read(1) != b"\n"
+            self._f = open(self.ruta, "a", encoding="utf-8")
+            # Si la última línea quedó cortada, se empieza en una línea nueva
+            if cortada:
+                self._f.write("\n")
+        self._f.write(json.dumps({"clave": clave, "descripcion": descripcion}, ensure_ascii=False) + "\n")
+        self._f.flush()
+
+    def cerrar(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+def importar_descripciones_previas(cache, existentes, imagenes):
+    """
+    Migración desde colecciones anteriores a la caché: reutiliza la descripción
+    guardada de las imágenes cuya entrada no registra hash (ids por nombre de
+    fichero) para no volver a describirlas con el VLM.
+    """
+    por_ruta = {item["path"]: item for item in imagenes}
+    importadas = 0
+    for meta, documento in existentes.values():
+        item = por_ruta.get((meta or {}).get("path"))
+        if item is None or "file_hash" in meta or not documento or documento == "Sin descripción":
+            continue
+        clave = clave_descripcion(item["hash"])
+        if clave not in cache:
+            cache.put(clave, documento)
+            importadas += 1
+    return importadas
+
+
+# =============================================================================
+# 4. EMBEDDINGS VISUALES (CLIP)
+# =============================================================================
+
+def vectorizar_imagenes(rutas, model):
+    """
+    Embedding CLIP de cada imagen. Devuelve ({ruta: embedding}, {ruta: error}).
+    """
+    embeddings, errores = {}, {}
+    for ruta in rutas:
+        try:
+            with Image.open(ruta) as image:
+                embeddings[ruta] = model.encode(image).tolist()
+        except Exception as e:
+            errores[ruta] = _error(e)
+            logger.error(f"[CLIP] Error {os.path.basename(ruta)}: {errores[ruta]}")
+    return embeddings, errores
+
+
+async def procesar_imagenes(imagenes, model, cache):
+    """
+    Lanza las descripciones que faltan en la caché (VLM, una por contenido distinto)
+    y los embeddings (CLIP, en un hilo) a la vez. Devuelve ({ruta: embedding}, {ruta: error}).
+    """
+    por_describir = {}
+    for item in imagenes:
+        if clave_descripcion(item["hash"]) not in cache:
+            por_describir.setdefault(item["hash"], item["path"])
+
+    t0 = time.time()
+    errores_vlm, (embeddings, errores) = await asyncio.gather(
+        describir_imagenes(por_describir, cache),
+        asyncio.to_thread(vectorizar_imagenes, [item["path"] for item in imagenes], model)
     )
+    duracion = time.time() - t0
+    descritas = len(por_describir) - len(errores_vlm)
+    logger.info(f"[VLM] {descritas} imágenes descritas en {duracion:.1f}s "
+                f"({descritas / max(duracion, 1e-9) * 60:.1f} imágenes/min, concurrencia {VLM_CONCURRENCY}); "
+                f"{len(imagenes) - len(por_describir)} desde la caché")
 
-    ids, embeddings, metadatas, documents = [], [], [], []
+    for item in imagenes:
+        if item["hash"] in errores_vlm:
+            errores[item["path"]] = errores_vlm[item["hash"]]
+    return embeddings, errores
+
+
+# =============================================================================
+# 5. PROGRAMA PRINCIPAL
+# =============================================================================
+
+def escanear_imagenes():
+    """
+    Lista ordenada de imágenes con sus metadatos de ruta (asignatura / tema).
+    """
     archivos_encontrados = []
 
     for root, _, files in os.walk(DATA_DIR):
@@ -134,63 +341,132 @@ def main():
                 
                 archivos_encontrados.append({
                     "path": ruta_completa,
+                    "relativa": relativa,
                     "filename": file,
                     "asignatura": asignatura,
                     "tema": tema
                 })
 
+    return sorted(archivos_encontrados, key=lambda item: item["relativa"])
+
+
+def metadatos_imagen(item):
+    return {
+        "type": "image",
+        "path": item["path"],
+        "source": item["filename"],
+        "asignatura": item["asignatura"],
+        "tema": item["tema"],
+        "file_hash": item["hash"],
+        "vlm_model": VISION_MODEL,
+        "prompt_hash": HASH_PROMPT
+    }
+
+
+def sin_cambios(item, existentes):
+    """
+    La imagen ya está guardada con el mismo contenido, ruta, modelo VLM y prompt.
+    """
+    previo = existentes.get(id_imagen(item["relativa"]))
+    return previo is not None and previo[0] == metadatos_imagen(item)
+
+
+def main():
+    logger.info(f"Iniciando Ingesta con doble nivel (Asignatura/Tema) en {DATA_DIR}...")
+
+    if not os.path.isdir(DATA_DIR):
+        logger.error(f"Error crítico: No existe la carpeta {DATA_DIR}")
+        return
+
+    archivos_encontrados = escanear_imagenes()
     if not archivos_encontrados:
+        # Sin imágenes no se poda nada: protege la colección de una carpeta vaciada por error
         logger.warning(f"No hay imágenes en {DATA_DIR}")
         return
 
     logger.info(f"Encontradas {len(archivos_encontrados)} imágenes.")
 
-    seen_ids = set()
+    errores = {}
+    imagenes = []
+    for item in archivos_encontrados:
+        try:
+            item["hash"] = hash_fichero(item["path"])
+            imagenes.append(item)
+        except OSError as e:
+            errores[item["path"]] = _error(e)
+
+    client = chromadb.PersistentClient(path=DB_PATH)
+    collection = client.get_or_create_collection(
+        name="multimodal_knowledge",
+        metadata={"hnsw:space": "cosine"}
+    )
+
+    # Estado actual de la colección: {id: (metadatos, descripción)}
+    guardado = collection.get(include=["metadatas", "documents"])
+    existentes = {i: (m, d) for i, m, d in zip(guardado["ids"], guardado["metadatas"], guardado["documents"])}
+
+    cache = CacheDescripciones(CAPTION_CACHE_PATH)
+    importadas = importar_descripciones_previas(cache, existentes, imagenes)
+    if importadas:
+        logger.info(f"Importadas a la caché {importadas} descripciones de la colección anterior.")
+
+    completa = "--completa" in sys.argv
+    pendientes = [item for item in imagenes if completa or not sin_cambios(item, existentes)]
+    logger.info(f"Nuevas o modificadas: {len(pendientes)} | Sin cambios: {len(imagenes) - len(pendientes)}")
 
-    for item in tqdm(archivos_encontrados, desc="Procesando"):
+    ids, embeddings, metadatas, documents = [], [], [], []
+
+    if pendientes:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        logger.info(f"Dispositivo seleccionado: {device.upper()}")
+        
+        if device == "cpu":
+            logger.warning("CUIDADO: Se está usando CPU.")
+
+        model = SentenceTransformer(CLIP_MODEL, device=device)
         try:
-            base_id = f"img_{item['filename']}"
-            unique_id = base_id
-            counter = 1
-            
-            while unique_id in seen_ids:
-                unique_id = f"{base_id}_{counter}"
-                counter += 1
-            
-            seen_ids.add(unique_id)
-
-            image = Image.open(item["path"])
-            emb = model.encode(image).tolist()
-
-            descripcion = describir_imagen(item["path"])
-
-            ids.append(unique_id)
-            embeddings.append(emb)
-            documents.append(descripcion)
-            metadatas.append({
-                "type": "image",
-                "path": item["path"],
-                "source": item["filename"],
-                "asignatura": item["asignatura"],
-                "tema": item["tema"]
-            })
+            embs, errores_proceso = asyncio.run(procesar_imagenes(pendientes, model, cache))
+        finally:
+            cache.cerrar()
+        errores.update(errores_proceso)
 
-        except Exception as e:
-            logger.error(f"Error {item['filename']}: {e}")
-
-    if ids:
-        collection.add(
-            ids=ids,
-            embeddings=embeddings,
-            metadatas=metadatas,
-            documents=documents
+        for item in pendientes:
+            if item["path"] in errores:
+                continue
+            ids.append(id_imagen(item["relativa"]))
+            embeddings.append(embs[item["path"]])
+            documents.append(cache.get(clave_descripcion(item["hash"])))
+            metadatas.append(metadatos_imagen(item))
+
+    for i in range(0, len(ids), LOTE_CHROMA):
+        collection.upsert(
+            ids=ids[i:i+LOTE_CHROMA],
+            embeddings=embeddings[i:i+LOTE_CHROMA],
+            metadatas=metadatas[i:i+LOTE_CHROMA],
+            documents=documents[i:i+LOTE_CHROMA]
         )
-        logger.info(f"Guardado. Total: {len(ids)}. DB en: {DB_PATH}")
+
+    # Poda: imágenes borradas, ids antiguos por nombre de fichero y entradas de
+    # imágenes cuya nueva versión ha fallado (se reintentarán en la próxima ingesta)
+    vigentes = {id_imagen(item["relativa"]) for item in imagenes if item["path"] not in errores}
+    obsoletos = [i for i in existentes if i not in vigentes]
+    for i in range(0, len(obsoletos), LOTE_CHROMA):
+        collection.delete(ids=obsoletos[i:i+LOTE_CHROMA])
+    if ids or obsoletos:
+        marcar_ingesta()
+
+    logger.info(f"Guardado. Actualizadas: {len(ids)} | Eliminadas: {len(obsoletos)} | "
+                f"Total: {collection.count()}. DB en: {DB_PATH}")
+
+    if errores:
+        logger.warning(f"{len(errores)} imágenes NO se han guardado:")
+        for ruta, error in sorted(errores.items()):
+            logger.warning(f"   - {os.path.relpath(ruta, DATA_DIR)}: {error}")
 
 
 # =============================================================================
-# 4. EJECUCIÓN
+# 6. EJECUCIÓN
 # =============================================================================
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
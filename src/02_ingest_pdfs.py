@@ -11,24 +11,59 @@ PIPELINE DE INGESTA DE DOCUMENTOS (PDFs)
 FLUJO COMPLETO:
     PDF en disco (ej: /BDA/Hadoop/comandos_hdfs.pdf)
         ↓
-    [1] Loader (PyPDF) → Extrae texto crudo y metadatos básicos
+    [1] Parser (PyMuPDF) → Extrae el texto de cada página, en paralelo en un
+        pool de procesos (INGEST_WORKERS; 0 = un proceso por núcleo)
         ↓
     [2] Enriquecimiento → Añade metadata: {asignatura: "BDA", tema: "Hadoop"}
         ↓
     [3] Splitter → Divide en chunks de 1000 caracteres (contexto ideal)
         ↓
-    [4] Embedding Model → Convierte texto a vectores (Qwen/Qwen3-Embedding-0.6B)
+    [4] Embedding Model → Convierte texto a vectores (Qwen/Qwen3-Embedding-0.6B),
+        truncados a EMB_DIM_TEXT dimensiones (Matryoshka) y re-normalizados.
+        Los chunks se agrupan por longitud en lotes de EMB_BATCH_TOKENS tokens
+        (con padding) para no gastar cómputo en relleno
         ↓
     [5] ChromaDB → Indexa vectores y metadatos para búsqueda semántica
+        (la colección registra el modelo y la dimensión con que se construyó)
+
+EJECUCIÓN EN STREAMING:
+    Las etapas [1], [3], [4] y [5] corren a la vez, cada una en su hilo, unidas
+    por colas acotadas (INGEST_QUEUE_SIZE): un PDF se trocea en cuanto se lee y
+    cada lote se vectoriza y escribe sin esperar al resto de la biblioteca.
+    La memoria depende del tamaño de las colas, no del número de PDFs. Cada
+    INGEST_LOG_SECONDS se registra el ritmo de cada etapa y la ocupación de su cola.
+
+INGESTA INCREMENTAL:
+    Un manifiesto (manifest_pdfs.json, junto a la base de datos) guarda el hash
+    SHA-256 del contenido de cada PDF. Cada chunk tiene un id estable derivado
+    de (hash del fichero, página, índice del chunk en la página), de modo que:
+      - Solo se leen y vectorizan los PDFs nuevos o modificados (upsert).
+      - Los chunks cuyo hash ya no corresponde a ningún PDF (ficheros borrados,
+        versiones anteriores de un PDF modificado o ids antiguos 'pdf_N') se
+        eliminan de la colección.
+    Copias idénticas de un mismo PDF se indexan una sola vez.
+    Con el argumento --completa se ignora el manifiesto y se re-vectoriza todo.
 ================================================================================
 """
 import os
+import sys
+import json
+import time
+import queue
+import hashlib
 import logging
-import chromadb
+import threading
+import multiprocessing
+from itertools import islice
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import fitz  # PyMuPDF
 from dotenv import load_dotenv
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from sentence_transformers import SentenceTransformer
+# chromadb, langchain y sentence_transformers se importan dentro de las funciones
+# que los usan: los procesos de lectura (spawn) vuelven a importar este script y
+# solo necesitan fitz
 
 # ==============================================================================
 # CONFIGURACIÓN Y LOGS
@@ -45,29 +80,96 @@ DB_PATH = os.getenv("DB_PATH", os.path.join(PROJECT_ROOT, "chroma_db_multimodal(
 PDF_DIR = os.path.join(PROJECT_ROOT, "data", "pdfs")
 
 MODELO_EMBEDDING = "Qwen/Qwen3-Embedding-0.6B"
+# Dimensión Matryoshka de los embeddings (0 = dimensión completa del modelo).
+# Debe coincidir con la de la API: se guarda en los metadatos de la colección.
+EMB_DIM_TEXT = int(os.getenv("EMB_DIM_TEXT", "0"))
 
+# Procesos para extraer el texto de los PDFs (0 = uno por núcleo)
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "0")) or os.cpu_count() or 1
+# Capacidad de cada cola entre etapas (PDFs o lotes) y cadencia del log de progreso
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "8"))
+INGEST_LOG_SECONDS = float(os.getenv("INGEST_LOG_SECONDS", "10"))
+BATCH_SIZE = 50  # chunks por mensaje entre la etapa de chunking y la de embedding
+# Lotes del modelo por presupuesto de tokens (con padding) en vez de por número de chunks:
+# se ordenan por longitud ventanas de EMB_SORT_WINDOW chunks para agrupar los de tamaño parecido
+EMB_BATCH_TOKENS = int(os.getenv("EMB_BATCH_TOKENS", "16384"))
+EMB_SORT_WINDOW = int(os.getenv("EMB_SORT_WINDOW", "1024"))
 
-def main():
-  
-    logger.info("="*60)
-    logger.info(f"INICIANDO INGESTA DE PDFs")
-    logger.info(f"Directorio: {PDF_DIR}")
-    logger.info(f"Modelo: {MODELO_EMBEDDING}")
-    logger.info("="*60)
-    
-    if not os.path.exists(PDF_DIR):
-        logger.error(f"Error crítico: No existe la carpeta {PDF_DIR}")
-        return
+MANIFEST_PATH = os.path.join(DB_PATH, "manifest_pdfs.json")
+# Marca que la API compara en el refresco en caliente de sus índices BM25
+MARCA_INGESTA_PATH = os.path.join(DB_PATH, "ingesta_text_knowledge.json")
+LOTE_CHROMA = 5000  # ids por llamada de get/delete a ChromaDB
 
-    # ====================================================================
-    # PASO 1: EXTRACCIÓN Y ENRIQUECIMIENTO (Metadata Extraction)
-    # ====================================================================
-    
-    docs = []
-    total_archivos = 0
-    
-    print("\n Escaneando biblioteca de documentos...")
-    
+# ==============================================================================
+# MANIFIESTO E IDS ESTABLES (INGESTA INCREMENTAL)
+# ==============================================================================
+
+def hash_fichero(ruta, bloque=1 << 20):
+    """
+    SHA-256 del contenido del fichero (leído por bloques).
+    """
+    h = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        for trozo in iter(lambda: f.read(bloque), b""):
+            h.update(trozo)
+    return h.hexdigest()
+
+def id_chunk(hash_pdf, pagina, indice):
+    """
+    Id estable de un chunk: no depende del orden de la ingesta ni del resto de PDFs.
+    """
+    return f"pdf_{hash_pdf[:20]}_p{pagina}_c{indice}"
+
+def hash_de_id(chunk_id):
+    """
+    Prefijo de hash de un id estable (None para ids antiguos 'pdf_N').
+    """
+    partes = chunk_id.split("_")
+    return partes[1] if len(partes) == 4 and partes[0] == "pdf" else None
+
+def cargar_manifest():
+    try:
+        with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def guardar_manifest(manifest):
+    """
+    Escritura atómica (fichero temporal + rename) para no dejar un manifiesto a medias.
+    """
+    os.makedirs(os.path.dirname(MANIFEST_PATH), exist_ok=True)
+    temporal = MANIFEST_PATH + ".tmp"
+    with open(temporal, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(temporal, MANIFEST_PATH)
+
+def marcar_ingesta():
+    """
+    Avisa a la API de que la colección ha cambiado: puede haber chunks con el mismo
+    id y metadatos nuevos (p. ej. un PDF movido de carpeta), que no se ven comparando ids.
+    """
+    os.makedirs(os.path.dirname(MARCA_INGESTA_PATH), exist_ok=True)
+    temporal = MARCA_INGESTA_PATH + ".tmp"
+    with open(temporal, "w", encoding="utf-8") as f:
+        json.dump({"marca": f"{time.time():.6f}-{os.getpid()}"}, f)
+    os.replace(temporal, MARCA_INGESTA_PATH)
+
+def chunks_por_hash(ficheros):
+    """
+    Chunks de cada contenido distinto: las copias idénticas comparten ids y solo
+    cuentan una vez al compararlo con la colección.
+    """
+    chunks = {}
+    for f in ficheros.values():
+        chunks[f["hash"]] = max(chunks.get(f["hash"], 0), f["chunks"])
+    return chunks
+
+def escanear_pdfs():
+    """
+    Lista ordenada de PDFs con sus metadatos de ruta (asignatura / tema).
+    """
+    pdfs = []
     for root, _, files in os.walk(PDF_DIR):
         for filename in files:
             if filename.lower().endswith(".pdf"):
@@ -79,77 +181,467 @@ def main():
                 
                 asignatura = partes[0] if len(partes) > 1 else "general"
                 tema = partes[1] if len(partes) > 2 else "general"
-                
+                pdfs.append({"ruta": ruta_completa, "relativa": relativa, "filename": filename,
+                             "asignatura": asignatura, "tema": tema})
+    return sorted(pdfs, key=lambda x: x["relativa"])
+
+# ==============================================================================
+# EXTRACCIÓN DE TEXTO (PyMuPDF EN UN POOL DE PROCESOS)
+# ==============================================================================
+
+def extraer_paginas(ruta):
+    """
+    Texto de cada página del PDF. Se ejecuta en un proceso del pool: solo recibe
+    y devuelve tipos simples (la ruta y una lista de cadenas).
+    """
+    with fitz.open(ruta) as pdf:
+        return [pagina.get_text() for pagina in pdf]
+
+def crear_pool(workers):
+    """
+    Pool de procesos de lectura con arranque "spawn" (el de Windows): el pool se
+    crea desde el hilo de la etapa de parseo mientras corren los hilos de torch y
+    tokenizers, y hacer fork de un proceso con hilos puede bloquearse.
+    Cada proceso importa de nuevo este script, por eso a nivel de módulo solo se
+    importan fitz y la biblioteca estándar.
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+def extraer_aislado(ruta):
+    """
+    Reintento de un PDF en un proceso propio, para que un fallo grave no afecte a otros.
+    """
+    with crear_pool(1) as aislado:
+        try:
+            return aislado.submit(extraer_paginas, ruta).result()
+        except Exception as e:
+            return e
+
+def leer_pdfs(pdfs, errores, pool, workers):
+    """
+    Generador (pdf, [Document]) en el mismo orden que `pdfs`. La extracción va en
+    paralelo en `pool` (de `workers` procesos, creado con crear_pool), con como
+    mucho 2 x workers PDFs en vuelo para acotar la memoria. Un PDF que falla no
+    afecta al resto: su ruta relativa se añade a `errores`. Cierra el pool al acabar.
+    """
+    from langchain_core.documents import Document
+
+    ventana = 2 * workers
+    restantes, en_vuelo = iter(pdfs), deque()
+
+    def enviar():
+        for pdf in islice(restantes, ventana - len(en_vuelo)):
+            en_vuelo.append((pdf, pool.submit(extraer_paginas, pdf["ruta"])))
+
+    try:
+        enviar()
+        while en_vuelo:
+            pdf, futuro = en_vuelo.popleft()
+            try:
+                paginas = futuro.result()
+            except BrokenProcessPool:
+                # Un proceso caído (p. ej. un PDF corrupto que rompe MuPDF) invalida el pool:
+                # este PDF se reintenta aislado y los que estaban en vuelo se reenvían a uno nuevo
+                paginas = extraer_aislado(pdf["ruta"])
+                pool.shutdown(wait=False)
+                pool = crear_pool(workers)
+                en_vuelo = deque((p, pool.submit(extraer_paginas, p["ruta"])) for p, _ in en_vuelo)
+            except Exception as e:
+                paginas = e
+            enviar()
+
+            if isinstance(paginas, Exception):
+                errores.add(pdf["relativa"])
+                logger.error(f"   Error leyendo {pdf['filename']}: {paginas}")
+                continue
+            docs = [
+                Document(page_content=texto, metadata={
+                    "source": pdf["filename"],
+                    "page": num,
+                    "total_pages": len(paginas),
+                    "type": "text",
+                    "asignatura": pdf["asignatura"],
+                    "tema": pdf["tema"],
+                    "path": pdf["relativa"],
+                    "file_hash": pdf["hash"],
+                })
+                for num, texto in enumerate(paginas)
+            ]
+            logger.info(f"   Leído: {pdf['asignatura']} | {pdf['filename']} ({len(paginas)} páginas)")
+            yield pdf, docs
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+# ==============================================================================
+# PIPELINE POR ETAPAS (PARSEO → CHUNKING → EMBEDDING → ESCRITURA)
+# ==============================================================================
+
+class _Error:
+    def __init__(self, exc):
+        self.exc = exc
+
+class EtapaEnHilo:
+    """
+    Ejecuta un generador en un hilo propio y entrega sus elementos a la etapa
+    siguiente por una cola acotada. Si la siguiente etapa va más lenta, esta se
+    bloquea (contrapresión): las etapas se solapan y la memoria no crece con el
+    tamaño de la biblioteca. Los errores se propagan al consumidor.
+    """
+
+    _FIN = object()
+
+    def __init__(self, nombre, generador, unidad, medida=len, maxsize=INGEST_QUEUE_SIZE):
+        self.nombre, self.unidad, self.medida = nombre, unidad, medida
+        self.cantidad = 0
+        self.cola = queue.Queue(maxsize=max(1, maxsize))
+        self._generador = generador
+        self._parar = threading.Event()
+        self._hilo = threading.Thread(target=self._producir, name=f"ingesta-{nombre}", daemon=True)
+        self._hilo.start()
+
+    def _poner(self, item):
+        while not self._parar.is_set():
+            try:
+                self.cola.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _producir(self):
+        try:
+            for item in self._generador:
+                self.cantidad += self.medida(item)
+                if not self._poner(item):
+                    self._generador.close()  # el consumidor ha abandonado: se cierra la etapa anterior
+                    return
+            self._poner(self._FIN)
+        except BaseException as e:
+            self._poner(_Error(e))
+
+    def parar(self):
+        """
+        Detiene la etapa (el hilo termina en su siguiente escritura en la cola).
+        """
+        self._parar.set()
+
+    def __iter__(self):
+        try:
+            while True:
                 try:
-                    loader = PyPDFLoader(ruta_completa)
-                    pdf_docs = loader.load()
-                    for doc in pdf_docs:
-                        doc.metadata["source"] = filename
-                        doc.metadata["type"] = "text"
-                        doc.metadata["asignatura"] = asignatura
-                        doc.metadata["tema"] = tema
-                        doc.metadata["path"] = relativa 
-                    
-                    docs.extend(pdf_docs)
-                    total_archivos += 1
-                    logger.info(f"   Leído: {asignatura} | {filename}")
-                    
-                except Exception as e:
-                    logger.error(f"   Error leyendo {filename}: {e}")
-
-    if total_archivos == 0:
-        logger.warning(" No se encontraron PDFs. Revisa la carpeta 'data/pdfs'.")
+                    item = self.cola.get(timeout=0.5)
+                except queue.Empty:
+                    if self._parar.is_set():
+                        return
+                    continue
+                if item is self._FIN:
+                    return
+                if isinstance(item, _Error):
+                    raise item.exc
+                yield item
+        finally:
+            self._parar.set()
+
+class MonitorPipeline:
+    """
+    Registra cada INGEST_LOG_SECONDS (y al terminar) lo procesado por cada etapa,
+    su ritmo y la ocupación de la cola que la separa de la siguiente.
+    """
+
+    def __init__(self, etapas, escritura):
+        self.etapas, self.escritura = etapas, escritura
+        self.inicio = time.perf_counter()
+        self._fin = threading.Event()
+        self._hilo = threading.Thread(target=self._bucle, name="ingesta-monitor", daemon=True)
+        self._hilo.start()
+
+    def _bucle(self):
+        while not self._fin.wait(INGEST_LOG_SECONDS):
+            self.registrar()
+
+    def registrar(self, titulo="[PIPELINE]"):
+        segundos = max(time.perf_counter() - self.inicio, 1e-9)
+        partes = [
+            f"{e.nombre}: {e.cantidad} {e.unidad} ({e.cantidad / segundos:.1f}/s, cola {e.cola.qsize()}/{e.cola.maxsize})"
+            for e in self.etapas
+        ]
+        partes.append(f"escritura: {self.escritura['chunks']} chunks ({self.escritura['chunks'] / segundos:.1f}/s)")
+        logger.info(f"{titulo} {segundos:.0f}s | " + " | ".join(partes))
+
+    def terminar(self):
+        self._fin.set()
+        self.registrar("[PIPELINE] Total")
+
+def trocear(documentos, splitter, ficheros):
+    """
+    Etapa de chunking: trocea cada PDF en cuanto llega y emite lotes de BATCH_SIZE
+    chunks (id estable, texto, metadatos). Cuenta los chunks de cada fichero.
+    """
+    lote = []
+    for pdf, docs in documentos:
+        ficheros[pdf["relativa"]] = {"hash": pdf["hash"], "chunks": 0}
+        # Id estable por (hash del PDF, página, índice del chunk dentro de la página)
+        contador = defaultdict(int)
+        for d in splitter.split_documents(docs):
+            pagina = d.metadata.get("page", 0)
+            lote.append((id_chunk(pdf["hash"], pagina, contador[pagina]), d.page_content, d.metadata))
+            contador[pagina] += 1
+            ficheros[pdf["relativa"]]["chunks"] += 1
+            if len(lote) == BATCH_SIZE:
+                yield lote
+                lote = []
+    if lote:
+        yield lote
+
+def lotes_por_presupuesto(longitudes, presupuesto):
+    """
+    Agrupa los índices, ordenados por longitud, en lotes cuyo coste con padding
+    (nº de chunks x longitud máxima del lote) no supera `presupuesto` tokens.
+    """
+    orden = sorted(range(len(longitudes)), key=lambda i: longitudes[i])
+    lotes, actual = [], []
+    for i in orden:
+        # En orden ascendente, la longitud máxima del lote es la del último chunk
+        if actual and longitudes[i] * (len(actual) + 1) > presupuesto:
+            lotes.append(actual)
+            actual = []
+        actual.append(i)
+    if actual:
+        lotes.append(actual)
+    return lotes
+
+def coste_con_padding(longitudes, lotes):
+    return sum(len(lote) * max(longitudes[i] for i in lote) for lote in lotes)
+
+def vectorizar(lotes, model, stats):
+    """
+    Etapa de embedding: acumula ventanas de EMB_SORT_WINDOW chunks, las vectoriza
+    en lotes de longitud parecida (EMB_BATCH_TOKENS) y las devuelve en el orden
+    original junto a sus vectores. Acumula en `stats` tokens, padding y tiempo.
+    """
+    ventana = []
+    for lote in lotes:
+        ventana.extend(lote)
+        if len(ventana) >= EMB_SORT_WINDOW:
+            yield ventana, vectorizar_ventana(ventana, model, stats)
+            ventana = []
+    if ventana:
+        yield ventana, vectorizar_ventana(ventana, model, stats)
+
+def vectorizar_ventana(ventana, model, stats):
+    textos = [texto for _, texto, _ in ventana]
+    longitudes = [
+        len(ids) for ids in model.tokenizer(textos, truncation=True, max_length=model.max_seq_length)["input_ids"]
+    ]
+    lotes = lotes_por_presupuesto(longitudes, EMB_BATCH_TOKENS)
+
+    embeddings = [None] * len(ventana)
+    t0 = time.perf_counter()
+    for lote in lotes:
+        # Truncado Matryoshka + re-normalización L2 (truncate_dim se aplica antes de normalizar)
+        vectores = model.encode([textos[i] for i in lote], batch_size=len(lote), normalize_embeddings=True)
+        for i, vec in zip(lote, vectores):
+            embeddings[i] = vec.tolist()
+
+    stats["segundos"] += time.perf_counter() - t0
+    stats["lotes"] += len(lotes)
+    stats["tokens"] += sum(longitudes)
+    stats["tokens_padding"] += coste_con_padding(longitudes, lotes)
+    # Referencia: lotes fijos de BATCH_SIZE chunks en orden de documento
+    fijos = [list(range(i, min(i + BATCH_SIZE, len(ventana)))) for i in range(0, len(ventana), BATCH_SIZE)]
+    stats["tokens_padding_fijo"] += coste_con_padding(longitudes, fijos)
+    return embeddings
+
+def podar_coleccion(collection, hashes_vigentes):
+    """
+    Borra los chunks cuyo hash no corresponde a ningún PDF vigente
+    (PDFs borrados, versiones anteriores y ids antiguos por posición).
+    """
+    todos = collection.get(include=[])["ids"]
+    obsoletos = [i for i in todos if (hash_de_id(i) or "") not in hashes_vigentes]
+    for i in range(0, len(obsoletos), LOTE_CHROMA):
+        collection.delete(ids=obsoletos[i:i+LOTE_CHROMA])
+    return len(obsoletos)
+
+
+def main():
+    import chromadb
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    from sentence_transformers import SentenceTransformer
+
+    logger.info("="*60)
+    logger.info(f"INICIANDO INGESTA DE PDFs")
+    logger.info(f"Directorio: {PDF_DIR}")
+    logger.info(f"Modelo: {MODELO_EMBEDDING}")
+    logger.info("="*60)
+    
+    if not os.path.exists(PDF_DIR):
+        logger.error(f"Error crítico: No existe la carpeta {PDF_DIR}")
         return
 
     # ====================================================================
-    # PASO 2: CHUNKING (División de Texto)
+    # PASO 0: DETECCIÓN DE CAMBIOS (Manifiesto de hashes)
     # ====================================================================
-    # QUE HACE? Divide el texto en bloques de 1000 caracteres con 200 de solapamiento.
-    
-    logger.info(f"\n Troceando {len(docs)} páginas de documentos...")
-    
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,    # Tamaño del fragmento
-        chunk_overlap=200,  # Solapamiento para no cortar frases a la mitad
-        separators=["\n\n", "\n", ". ", " ", ""] # Prioridad de corte
+    completa = "--completa" in sys.argv
+    manifest = {} if completa else cargar_manifest()
+    previos = manifest.get("ficheros", {})
+    if manifest and (manifest.get("embedding_model"), manifest.get("embedding_dim_text")) != (MODELO_EMBEDDING, EMB_DIM_TEXT):
+        logger.warning(" El modelo o la dimensión han cambiado desde la última ingesta: se re-vectoriza todo.")
+        previos = {}
+
+    client = chromadb.PersistentClient(path=DB_PATH)
+    try:
+        collection = client.get_collection("text_knowledge")
+    except Exception:
+        collection = None
+    # Si la colección se ha borrado o modificado por otra vía, el manifiesto no es fiable
+    if previos and (collection.count() if collection else 0) != sum(chunks_por_hash(previos).values()):
+        logger.warning(" La colección no coincide con el manifiesto: se re-vectoriza todo.")
+        previos = {}
+
+    print("\n Escaneando biblioteca de documentos...")
+    pdfs = escanear_pdfs()
+    if not pdfs:
+        logger.warning(" No se encontraron PDFs. Revisa la carpeta 'data/pdfs'.")
+
+    ficheros = {}
+    pendientes = []
+    hashes_indexados = set()
+    for pdf in pdfs:
+        pdf["hash"] = hash_fichero(pdf["ruta"])
+        previo = previos.get(pdf["relativa"])
+        if previo and previo["hash"] == pdf["hash"]:
+            ficheros[pdf["relativa"]] = previo
+            hashes_indexados.add(pdf["hash"])
+        else:
+            pendientes.append(pdf)
+
+    # Copias idénticas (mismo hash) se indexan una sola vez: los ids coinciden.
+    # Su entrada se añade al final, cuando se sabe si el original se indexó.
+    a_procesar = []
+    duplicados = {}
+    for pdf in pendientes:
+        if pdf["hash"] in hashes_indexados:
+            logger.info(f"   Duplicado (mismo contenido ya indexado): {pdf['relativa']}")
+            duplicados[pdf["relativa"]] = pdf["hash"]
+            continue
+        hashes_indexados.add(pdf["hash"])
+        a_procesar.append(pdf)
+
+    borrados = sorted(set(previos) - {p["relativa"] for p in pdfs})
+    logger.info(
+        f" PDFs: {len(pdfs)} | sin cambios: {len(pdfs) - len(pendientes)} | "
+        f"nuevos o modificados: {len(a_procesar)} | eliminados: {len(borrados)}"
     )
-    splits = text_splitter.split_documents(docs)
-    
-    logger.info(f"   - Total fragmentos (chunks) generados: {len(splits)}")
 
     # ====================================================================
-    # PASO 3: EMBEDDING Y ALMACENAMIENTO (Vector Store)
+    # PASO 1: MODELO Y COLECCIÓN (solo si hay PDFs que procesar)
     # ====================================================================
-    logger.info(f"\n Preparando ChromaDB en: {DB_PATH}")
-    
-    client = chromadb.PersistentClient(path=DB_PATH)
-    collection = client.get_or_create_collection(
-        name="text_knowledge",
-        metadata={"hnsw:space": "cosine"}
-    )
+    if a_procesar:
+        # El pool de lectura se arranca antes de cargar el modelo: sus procesos
+        # (que con spawn importan este módulo, solo con fitz) se inician mientras se carga
+        workers = max(1, min(INGEST_WORKERS, len(a_procesar)))
+        pool = crear_pool(workers)
+        for _ in range(workers):
+            pool.submit(int)
 
-    logger.info(f"Cargando modelo en memoria ({MODELO_EMBEDDING})...")
-    model = SentenceTransformer(MODELO_EMBEDDING)
-    batch_size = 50
-    total_batches = (len(splits) // batch_size) + 1
-    
-    print(f"\n Iniciando vectorización ({total_batches} lotes)...")
-    
-    for i in range(0, len(splits), batch_size):
-        batch = splits[i:i+batch_size]
-        texts = [d.page_content for d in batch]
-        metadatas = [d.metadata for d in batch]
-
-        ids = [f"pdf_{i+j}" for j in range(len(batch))]
-
-        embeddings = model.encode(texts).tolist()
-        collection.add(
-            ids=ids,
-            documents=texts,
-            embeddings=embeddings,
-            metadatas=metadatas
+        logger.info(f"Cargando modelo en memoria ({MODELO_EMBEDDING})...")
+        model = SentenceTransformer(MODELO_EMBEDDING, truncate_dim=EMB_DIM_TEXT or None)
+        dimension = model.get_sentence_embedding_dimension()
+        logger.info(f"   - Dimensión de los embeddings: {dimension}")
+
+        logger.info(f"\n Preparando ChromaDB en: {DB_PATH}")
+        
+        collection = client.get_or_create_collection(
+            name="text_knowledge",
+            metadata={"hnsw:space": "cosine", "embedding_model": MODELO_EMBEDDING, "embedding_dim": dimension}
+        )
+
+        # Una colección existente no puede mezclar vectores de distinta dimensión
+        # (sin registro = colección antigua construida con la dimensión completa)
+        dimension_previa = (collection.metadata or {}).get("embedding_dim")
+        compatible = dimension_previa == dimension if dimension_previa is not None else not EMB_DIM_TEXT
+        if collection.count() > 0 and not compatible:
+            logger.error(
+                f"La colección existente se construyó con dimensión {dimension_previa or 'completa (sin registrar)'} "
+                f"y EMB_DIM_TEXT pide {dimension}. Borra la colección o usa otro DB_PATH para reindexar."
+            )
+            pool.shutdown(cancel_futures=True)
+            return
+        if collection.count() > 0 and not manifest and not completa:
+            logger.info(" Colección sin manifiesto: sus chunks se sustituyen por los de ids estables.")
+
+        # ====================================================================
+        # PASO 2: PIPELINE PARSEO → CHUNKING → EMBEDDING → ESCRITURA
+        # ====================================================================
+        # Las etapas corren en paralelo unidas por colas acotadas: mientras se
+        # vectoriza un lote ya se están leyendo y troceando los PDFs siguientes.
+        # Chunks de 1000 caracteres con 200 de solapamiento.
+        text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=1000,    # Tamaño del fragmento
+            chunk_overlap=200,  # Solapamiento para no cortar frases a la mitad
+            separators=["\n\n", "\n", ". ", " ", ""] # Prioridad de corte
         )
-        print(f"   Lote {i//batch_size + 1}/{total_batches} procesado ({len(batch)} chunks)")
+
+        print(f"\n Iniciando pipeline de ingesta ({len(a_procesar)} PDFs, {workers} procesos de lectura)...")
+        errores = set()
+        parseo = EtapaEnHilo("parseo", leer_pdfs(a_procesar, errores, pool, workers), "páginas", medida=lambda item: len(item[1]))
+        chunking = EtapaEnHilo("chunking", trocear(parseo, text_splitter, ficheros), "chunks")
+        stats_embedding = {"segundos": 0.0, "lotes": 0, "tokens": 0, "tokens_padding": 0, "tokens_padding_fijo": 0}
+        embedding = EtapaEnHilo(
+            "embedding", vectorizar(chunking, model, stats_embedding), "chunks", medida=lambda item: len(item[0])
+        )
+        escritura = {"chunks": 0}
+        monitor = MonitorPipeline([parseo, chunking, embedding], escritura)
+        try:
+            for lote, embeddings in embedding:
+                collection.upsert(
+                    ids=[chunk_id for chunk_id, _, _ in lote],
+                    documents=[texto for _, texto, _ in lote],
+                    embeddings=embeddings,
+                    metadatas=[meta for _, _, meta in lote]
+                )
+                escritura["chunks"] += len(lote)
+        finally:
+            # Ante un error en cualquier etapa se detienen todas (no se sigue leyendo en vano)
+            for etapa in (parseo, chunking, embedding):
+                etapa.parar()
+            monitor.terminar()
+
+        if stats_embedding["tokens"]:
+            st = stats_embedding
+            logger.info(
+                f"[EMBEDDING] {st['tokens']} tokens en {st['lotes']} lotes, {st['segundos']:.1f}s de modelo "
+                f"({st['tokens'] / max(st['segundos'], 1e-9):.0f} tokens/s) | eficiencia de padding "
+                f"{st['tokens'] / st['tokens_padding'] * 100:.1f}% "
+                f"(lotes fijos de {BATCH_SIZE}: {st['tokens'] / st['tokens_padding_fijo'] * 100:.1f}%)"
+            )
+
+        for relativa in errores:
+            # Sin entrada en el manifiesto: se reintentará en la próxima ejecución
+            ficheros.pop(relativa, None)
+            hashes_indexados.discard(next(p["hash"] for p in a_procesar if p["relativa"] == relativa))
+    else:
+        logger.info(" Sin PDFs nuevos o modificados: no se carga el modelo de embeddings.")
+
+    # Las copias comparten los chunks del original; si este ha fallado, tampoco se registran
+    chunks = chunks_por_hash(ficheros)
+    for relativa, hash_pdf in duplicados.items():
+        if hash_pdf in hashes_indexados:
+            ficheros[relativa] = {"hash": hash_pdf, "chunks": chunks[hash_pdf]}
+
+    # ====================================================================
+    # PASO 3: PODA Y MANIFIESTO
+    # ====================================================================
+    if collection is not None:
+        eliminados = podar_coleccion(collection, {h[:20] for h in hashes_indexados})
+        logger.info(f"   - Chunks obsoletos eliminados: {eliminados}")
+        if a_procesar or eliminados:
+            marcar_ingesta()
+
+    guardar_manifest({
+        "embedding_model": MODELO_EMBEDDING, "embedding_dim_text": EMB_DIM_TEXT, "ficheros": ficheros
+    })
 
     logger.info("="*60)
     logger.info(" INGESTA DE PDFs COMPLETADA CORRECTAMENTE")
@@ -8,8 +8,9 @@ EVALUACION DEL MOTOR DE BUSQUEDA (HIT RATE / RECALL)
 
 METODOLOGIA:
     1. Golden Set: Lista predefinida de pares {Pregunta -> Documento Esperado}.
-    2. Consulta: Se envía cada pregunta a la API (endpoint /ask).
-    3. Análisis: Se extraen los metadatos de la respuesta (fuentes de texto e imágenes).
+    2. Consulta: Se envían todas las preguntas en una sola petición a la API
+       (endpoint /ask_batch, solo recuperación: sin reescritura ni generación).
+    3. Análisis: Se extraen las fuentes de cada resultado (texto e imágenes).
     4. Veredicto (Hit/Miss): 
        - HIT: El documento esperado aparece en la lista de fuentes.
        - MISS: El documento esperado NO fue recuperado.
@@ -21,13 +22,12 @@ METRICA:
 
 import requests
 import pandas as pd
-import json
 import time
 
 # ==============================================================================
 # CONFIGURACION
 # ==============================================================================
-API_URL = "http://127.0.0.1:8000/ask"
+API_URL = "http://127.0.0.1:8000/ask_batch"
 RETRIEVAL_TEST_SET = [
     {"q": "¿Que es Kafka?", "expected_doc": "apuntes_kafka.pdf"},
     {"q": "¿Que es el aprendizaje supervisado?", "expected_doc": "Explicacion_Modelos-Supervisado.pdf"},
@@ -41,43 +41,33 @@ RETRIEVAL_TEST_SET = [
 # FUNCIONES AUXILIARES
 # ==============================================================================
 
-def consultar_fuentes_api(pregunta):
+def consultar_fuentes_api(preguntas):
+    """
+    Recupera las fuentes de todas las preguntas con una sola llamada a /ask_batch.
+    Devuelve una lista de fuentes (texto + imágenes) por pregunta.
+    """
     try:
         payload = {
-            "pregunta": pregunta, 
-            "history": [],     # Sin historial para evaluación aislada
-            "persona": "chico" # Modo técnico por defecto
+            "preguntas": preguntas,
+            "persona": "chico", # Modo técnico por defecto
+            "generar": False    # Solo recuperación
         }
-        
-        # Importante: stream=True porque la API devuelve datos por trozos
-        with requests.post(API_URL, json=payload, stream=True, timeout=30) as response:
-            if response.status_code != 200:
-                print(f"[ERROR] API retornó estado {response.status_code}")
-                return []
-
-            # Iteramos línea por línea buscando el tipo "metadata"
-            for line in response.iter_lines():
-                if line:
-                    try:
-                        chunk = json.loads(line.decode('utf-8'))
-                        
-                        # Buscamos el bloque que contiene las fuentes
-                        if chunk.get("type") == "metadata":
-                            fuentes_texto = chunk.get("fuentes_texto", [])
-                            # Extraemos solo el filename de los objetos de imagen
-                            imagenes = [img.get("filename", "") for img in chunk.get("imagenes", [])]
-                            
-                            # Normalizamos y limpiamos nombres
-                            return fuentes_texto + imagenes
-                            
-                    except json.JSONDecodeError:
-                        continue
-            
-            return [] # Si termina sin metadatos
+        response = requests.post(API_URL, json=payload, timeout=300)
+        if response.status_code != 200:
+            print(f"[ERROR] API retornó estado {response.status_code}")
+            return [[] for _ in preguntas]
+
+        fuentes = []
+        for resultado in response.json().get("resultados", []):
+            fuentes_texto = resultado.get("fuentes_texto", [])
+            # Extraemos solo el filename de los objetos de imagen
+            imagenes = [img.get("filename", "") for img in resultado.get("imagenes", [])]
+            fuentes.append(fuentes_texto + imagenes)
+        return fuentes
 
     except Exception as e:
         print(f"[ERROR] Fallo de conexión: {e}")
-        return []
+        return [[] for _ in preguntas]
 
 # ==============================================================================
 # FUNCION PRINCIPAL DE EVALUACION
@@ -93,16 +83,16 @@ def evaluar_golden_set():
     hits = 0
     start_time = time.time()
 
-    for i, item in enumerate(RETRIEVAL_TEST_SET):
+    # 1. Consultar API (todas las preguntas en un único lote)
+    fuentes_por_caso = consultar_fuentes_api([item["q"] for item in RETRIEVAL_TEST_SET])
+
+    for i, (item, fuentes_recuperadas) in enumerate(zip(RETRIEVAL_TEST_SET, fuentes_por_caso)):
         q = item["q"]
         expected = item["expected_doc"]
         
         print(f"\n[CASO {i+1}] Pregunta: '{q}'")
         print(f"         Esperado: '{expected}'")
         
-        # 1. Consultar API
-        fuentes_recuperadas = consultar_fuentes_api(q)
-        
         # 2. Verificar coincidencia (Hit/Miss)
         # Usamos coincidencia parcial (in) por si la ruta devuelta es absoluta o relativa
         is_hit = any(expected.lower() in s.lower() for s in fuentes_recuperadas)
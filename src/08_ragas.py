@@ -6,9 +6,10 @@ EVALUACION DE CALIDAD GENERATIVA (METRICAS RAGAS)
    la precisión y relevancia de las respuestas generadas por el sistema RAG.
 
 METODOLOGIA (RAGAS - Retrieval Augmented Generation Assessment):
-    1. Generación: Se envían preguntas de control (Golden Data) a la API.
+    1. Generación: Se envían las preguntas de control (Golden Data) a la API
+       en un único lote (endpoint /ask_batch con generación).
     2. Recolección: Se capturan la respuesta generada y el contexto recuperado
-       (fragmentos de PDF/Imágenes) mediante el stream de la API.
+       (fragmentos de PDF/Imágenes) de cada resultado del lote.
     3. Juicio: Un modelo LLM potente (el Juez) analiza la coherencia entre:
        - Pregunta vs. Respuesta (Relevancia)
        - Contexto vs. Respuesta (Fidelidad/Faithfulness)
@@ -23,8 +24,6 @@ METRICAS:
 
 import requests
 import pandas as pd
-import time
-import json
 import os
 import logging
 from dotenv import load_dotenv
@@ -47,7 +46,7 @@ logger = logging.getLogger("evaluacion_ragas")
 
 API_HOST = os.getenv("API_HOST", "127.0.0.1")
 API_PORT = os.getenv("API_PORT", "8000")
-API_URL = f"http://{API_HOST}:{API_PORT}/ask"
+API_URL = f"http://{API_HOST}:{API_PORT}/ask_batch"
 PROVIDER = os.getenv("LLM_PROVIDER", "groq").lower()
 
 # ==============================================================================
@@ -112,55 +111,37 @@ GOLDEN_DATA = [
 
 def obtener_respuestas_sistema():
     """
-    Itera sobre el Golden Data, envía las preguntas a la API y reconstruye
-    la respuesta y el contexto desde el stream de datos.
+    Envía el Golden Data a la API en un único lote y recoge la respuesta
+    y el contexto de cada pregunta.
     """
     questions, answers, contexts, ground_truths = [], [], [], []
 
-    logger.info(f"Iniciando ciclo de preguntas ({len(GOLDEN_DATA)} casos)...")
+    logger.info(f"Enviando lote de preguntas ({len(GOLDEN_DATA)} casos)...")
 
-    for i, item in enumerate(GOLDEN_DATA):
-        q = item["question"]
-        logger.info(f"[{i+1}/{len(GOLDEN_DATA)}] Preguntando: '{q}'")
-        
-        try:
-            with requests.post(API_URL, json={"pregunta": q, "history": []}, stream=True, timeout=120) as response:
-                
-                if response.status_code == 200:
-                    full_answer = ""
-                    retrieved_context = []
-
-                    for line in response.iter_lines():
-                        if line:
-                            try:
-                                chunk = json.loads(line.decode('utf-8'))
-                                
-                                if chunk["type"] == "metadata":
-                                    retrieved_context = chunk.get("contexto_ragas", [])
-                                
-                                elif chunk["type"] == "content":
-                                    full_answer += chunk.get("delta", "")
-                                    
-                            except json.JSONDecodeError:
-                                continue
-                    
-                    questions.append(q)
-                    answers.append(full_answer)
-                    
-                    if not retrieved_context:
-                        retrieved_context = ["Sin contexto recuperado."]
-                    contexts.append(retrieved_context)
-                    
-                    ground_truths.append(item["ground_truth"])
-                    logger.info("Respuesta recibida y procesada correctamente.")
-                    
-                else:
-                    logger.error(f"Error HTTP API: {response.status_code}")
-                
-        except Exception as e:
-            logger.error(f"Error de conexión con la API: {e}")
-
-        time.sleep(1)
+    try:
+        payload = {"preguntas": [item["question"] for item in GOLDEN_DATA], "generar": True}
+        response = requests.post(API_URL, json=payload, timeout=1200)
+
+        if response.status_code == 200:
+            datos = response.json()
+            logger.info(f"Lote procesado: {datos.get('tiempos')}")
+
+            for item, resultado in zip(GOLDEN_DATA, datos.get("resultados", [])):
+                if resultado.get("respuesta") is None:
+                    logger.error(f"Sin respuesta para '{item['question']}': {resultado.get('error')}")
+                    continue
+
+                questions.append(item["question"])
+                answers.append(resultado["respuesta"])
+                contexts.append(resultado.get("contexto_ragas") or ["Sin contexto recuperado."])
+                ground_truths.append(item["ground_truth"])
+            logger.info(f"Respuestas recibidas y procesadas: {len(answers)}/{len(GOLDEN_DATA)}.")
+
+        else:
+            logger.error(f"Error HTTP API: {response.status_code}")
+
+    except Exception as e:
+        logger.error(f"Error de conexión con la API: {e}")
 
     return {
         "question": questions,
@@ -0,0 +1,201 @@
+"""
+================================================================================
+PARIDAD DE BACKENDS DE INFERENCIA (FP32 vs ONNX / INT8)
+================================================================================
+   Compara los modelos de la API cargados con un backend acelerado frente a la
+   referencia PyTorch fp32, para decidir cuánta precisión se cede a cambio de
+   velocidad en servidores solo-CPU.
+
+USO:
+    python src/10_paridad_backends.py [backend]
+    (backend: torch-int8 | onnx | onnx-int8; por defecto INFERENCE_BACKEND
+     o, si es 'torch', onnx-int8)
+
+METRICAS:
+    - Embeddings (Qwen y CLIP texto): coseno medio / mínimo entre el vector fp32
+      y el del backend, y solapamiento del Top-10 de ChromaDB con ambos vectores
+      (la base sigue indexada con embeddings fp32 de la ingesta). Los vectores se
+      truncan a la dimensión registrada en la colección (EMB_DIM_TEXT), como en la API.
+    - Reranker: correlación de Spearman de las puntuaciones, acuerdo en el Top-1
+      y solapamiento del Top-4 (los fragmentos que llegan al prompt).
+    - Latencia: tiempo medio por consulta de cada backend y aceleración.
+================================================================================
+"""
+
+import os
+import sys
+import time
+import logging
+
+import numpy as np
+import pandas as pd
+import chromadb
+from scipy.stats import spearmanr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.config import settings
+from src.api.inference_backend import cargar_embedder, cargar_reranker
+
+# ==============================================================================
+# CONFIGURACION
+# ==============================================================================
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("paridad_backends")
+
+CONSULTAS = [
+    "¿Que es Kafka?",
+    "¿Cuales son los componentes de la arquitectura Kafka?",
+    "¿Como funciona un broker en Kafka?",
+    "¿Cuales son los componentes de Hadoop?",
+    "¿Que es un indice en MongoDB?",
+    "¿Que es un raid?",
+    "¿Que tipos de datos tiene Hive?",
+    "¿Cual es el objetivo del aprendizaje supervisado?",
+    "¿Tipos de clasificación de la regresion logistica?",
+    "¿Cuando se detiene un arbol de decision?",
+    "¿Que es un centroide en K-Means?",
+    "Que es la convolucion?",
+    "¿Cuales son los tipos de redes neuronales?",
+    "Diagrama de la arquitectura de Kafka",
+]
+TOP_K_VECTOR = 10
+TOP_K_PROMPT = 4
+
+# ==============================================================================
+# FUNCIONES AUXILIARES
+# ==============================================================================
+
+def normalizar(m):
+    m = np.asarray(m, dtype=np.float32)
+    return m / np.maximum(np.linalg.norm(m, axis=1, keepdims=True), 1e-12)
+
+def dimension_coleccion(coleccion):
+    """
+    Dimensión registrada por la ingesta (EMB_DIM_TEXT); 0 = dimensión completa.
+    """
+    if coleccion is None:
+        return 0
+    return int((coleccion.metadata or {}).get("embedding_dim") or 0)
+
+def truncar(matriz, dim):
+    """
+    Truncado Matryoshka + re-normalización L2 por filas, como en la API (dim <= 0: sin truncar).
+    """
+    m = np.asarray(matriz, dtype=np.float32)
+    return normalizar(m[:, :dim]) if dim > 0 else m
+
+def cronometrar(func, repeticiones=3):
+    """
+    Devuelve (resultado, segundos por llamada) tras una llamada de calentamiento.
+    """
+    resultado = func()
+    t0 = time.perf_counter()
+    for _ in range(repeticiones):
+        func()
+    return resultado, (time.perf_counter() - t0) / repeticiones
+
+def solapamiento(a, b):
+    return len(set(a) & set(b)) / max(len(set(a) | set(b)), 1)
+
+def comparar_embedder(nombre_modelo, backend, coleccion, **kwargs):
+    ref, _ = cargar_embedder(nombre_modelo, "torch", settings.ONNX_EXPORT_DIR, settings.ONNX_QUANT_CONFIG, **kwargs)
+    cand, efectivo = cargar_embedder(nombre_modelo, backend, settings.ONNX_EXPORT_DIR, settings.ONNX_QUANT_CONFIG, **kwargs)
+
+    v_ref, t_ref = cronometrar(lambda: ref.encode(CONSULTAS, batch_size=len(CONSULTAS)))
+    v_cand, t_cand = cronometrar(lambda: cand.encode(CONSULTAS, batch_size=len(CONSULTAS)))
+    # Se comparan los vectores que usa la API: truncados a la dimensión de la colección
+    dim = dimension_coleccion(coleccion)
+    v_ref, v_cand = truncar(v_ref, dim), truncar(v_cand, dim)
+    cosenos = np.sum(normalizar(v_ref) * normalizar(v_cand), axis=1)
+
+    overlap = None
+    if coleccion is not None:
+        res_ref = coleccion.query(query_embeddings=np.asarray(v_ref).tolist(), n_results=TOP_K_VECTOR)
+        res_cand = coleccion.query(query_embeddings=np.asarray(v_cand).tolist(), n_results=TOP_K_VECTOR)
+        overlap = float(np.mean([solapamiento(a, b) for a, b in zip(res_ref["ids"], res_cand["ids"])]))
+
+    return {
+        "Modelo": nombre_modelo, "Backend": efectivo,
+        "Coseno medio": round(float(cosenos.mean()), 4), "Coseno mínimo": round(float(cosenos.min()), 4),
+        f"Top-{TOP_K_VECTOR} Chroma (Jaccard)": round(overlap, 3) if overlap is not None else "N/A",
+        "Latencia fp32 (ms/consulta)": round(t_ref / len(CONSULTAS) * 1000, 2),
+        "Latencia backend (ms/consulta)": round(t_cand / len(CONSULTAS) * 1000, 2),
+        "Aceleración": round(t_ref / t_cand, 2) if t_cand else "N/A",
+    }
+
+def comparar_reranker(nombre_modelo, backend, candidatos):
+    ref, _ = cargar_reranker(nombre_modelo, "torch", settings.ONNX_EXPORT_DIR, settings.ONNX_QUANT_CONFIG, trust_remote_code=True)
+    cand, efectivo = cargar_reranker(nombre_modelo, backend, settings.ONNX_EXPORT_DIR, settings.ONNX_QUANT_CONFIG, trust_remote_code=True)
+
+    rhos, top1, topk = [], [], []
+    t_ref = t_cand = 0.0
+    for consulta, docs in candidatos:
+        pares = [[consulta, d] for d in docs]
+        s_ref, t = cronometrar(lambda: ref.predict(pares, batch_size=len(pares)), 1)
+        t_ref += t
+        s_cand, t = cronometrar(lambda: cand.predict(pares, batch_size=len(pares)), 1)
+        t_cand += t
+
+        orden_ref, orden_cand = np.argsort(-np.asarray(s_ref)), np.argsort(-np.asarray(s_cand))
+        rhos.append(spearmanr(s_ref, s_cand)[0] if len(docs) > 1 else 1.0)
+        top1.append(orden_ref[0] == orden_cand[0])
+        topk.append(solapamiento(orden_ref[:TOP_K_PROMPT], orden_cand[:TOP_K_PROMPT]))
+
+    return {
+        "Modelo": nombre_modelo, "Backend": efectivo,
+        "Spearman medio": round(float(np.nanmean(rhos)), 4),
+        "Acuerdo Top-1": f"{np.mean(top1) * 100:.1f}%",
+        f"Top-{TOP_K_PROMPT} (Jaccard)": round(float(np.mean(topk)), 3),
+        "Latencia fp32 (ms/consulta)": round(t_ref / len(candidatos) * 1000, 2),
+        "Latencia backend (ms/consulta)": round(t_cand / len(candidatos) * 1000, 2),
+        "Aceleración": round(t_ref / t_cand, 2) if t_cand else "N/A",
+    }
+
+# ==============================================================================
+# EJECUCION PRINCIPAL
+# ==============================================================================
+
+def main():
+    backend = sys.argv[1] if len(sys.argv) > 1 else (
+        settings.INFERENCE_BACKEND if settings.INFERENCE_BACKEND != "torch" else "onnx-int8"
+    )
+    print("="*60)
+    print(f" PARIDAD DE BACKENDS: torch fp32 vs {backend}")
+    print("="*60)
+
+    col_text = col_img = None
+    if os.path.exists(settings.DB_PATH):
+        client = chromadb.PersistentClient(path=settings.DB_PATH)
+        try: col_text = client.get_collection("text_knowledge")
+        except Exception: logger.warning("Colección de texto no encontrada: se omite el Top-10 y el reranker")
+        try: col_img = client.get_collection("multimodal_knowledge")
+        except Exception: logger.warning("Colección de imágenes no encontrada: se omite el Top-10 de CLIP")
+
+    embeddings = [
+        comparar_embedder(settings.MODEL_TEXT, backend, col_text, trust_remote_code=True),
+        comparar_embedder(settings.MODEL_IMAGE, backend, col_img),
+    ]
+
+    reranker = []
+    if col_text is not None:
+        ref, _ = cargar_embedder(settings.MODEL_TEXT, "torch", settings.ONNX_EXPORT_DIR, settings.ONNX_QUANT_CONFIG, trust_remote_code=True)
+        vectores = truncar(ref.encode(CONSULTAS), dimension_coleccion(col_text))
+        res = col_text.query(query_embeddings=vectores.tolist(), n_results=TOP_K_VECTOR)
+        candidatos = [(q, docs) for q, docs in zip(CONSULTAS, res["documents"]) if docs]
+        reranker.append(comparar_reranker(settings.MODEL_RERANKER, backend, candidatos))
+
+    pd.set_option('display.max_columns', None)
+    pd.set_option('display.width', 1000)
+    print("\n" + "="*60)
+    print(" EMBEDDINGS")
+    print("="*60)
+    print(pd.DataFrame(embeddings).to_string(index=False))
+    if reranker:
+        print("\n" + "="*60)
+        print(" RERANKER")
+        print("="*60)
+        print(pd.DataFrame(reranker).to_string(index=False))
+    print("="*60)
+
+if __name__ == "__main__":
+    main()
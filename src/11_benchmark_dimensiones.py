@@ -0,0 +1,170 @@
+"""
+================================================================================
+BENCHMARK DE DIMENSIONES MATRYOSHKA (QWEN3-EMBEDDING)
+================================================================================
+   Mide cuánto se pierde en recuperación y cuánto se gana en latencia y espacio
+   al truncar los embeddings de Qwen3-Embedding a menos dimensiones
+   (EMB_DIM_TEXT), antes de reindexar la base con una dimensión menor.
+
+METODOLOGIA:
+    1. Lee los fragmentos de la colección 'text_knowledge' de DB_PATH.
+    2. Los vectoriza UNA vez a dimensión completa; cada dimensión se obtiene
+       truncando y re-normalizando (mismo procedimiento que la ingesta).
+    3. Para cada dimensión crea una colección ChromaDB (HNSW coseno) temporal
+       y lanza el Golden Set contra ella.
+
+METRICAS:
+    - Hit@1 / Hit@K: el documento esperado aparece en el Top-1 / Top-K.
+    - MRR@K: posición media recíproca del documento esperado.
+    - Latencia HNSW: tiempo medio y p95 de collection.query (ms).
+    - Tamaño: vectores en bruto (float32) y carpeta de ChromaDB en disco.
+================================================================================
+"""
+
+import os
+import time
+import shutil
+import logging
+import tempfile
+
+import numpy as np
+import pandas as pd
+import chromadb
+from dotenv import load_dotenv
+from sentence_transformers import SentenceTransformer
+
+# ==============================================================================
+# CONFIGURACION Y LOGS
+# ==============================================================================
+load_dotenv()
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("benchmark_dimensiones")
+
+DB_PATH = os.getenv("DB_PATH", "./chroma_db_multimodal")
+MODELO_EMB = os.getenv("MODEL_EMBEDDING_TEXT", "Qwen/Qwen3-Embedding-0.6B")
+DIMENSIONES = [128, 256, 512, 768, 1024]
+TOP_K = 5
+LOTE_CHROMA = 5000
+
+GOLDEN_DATASET = [
+    {"q": "¿Que es Kafka?", "expected_doc": "apuntes_kafka.pdf"},
+    {"q": "¿Cuales son los componentes de la arquitectura Kafka?", "expected_doc": "apuntes_kafka.pdf"},
+    {"q": "¿Como funciona un broker en Kafka?", "expected_doc": "apuntes_kafka.pdf"},
+    {"q": "¿Cuales son los componentes de Hadoop?", "expected_doc": "introduccion_hadoop.pdf"},
+    {"q": "¿Que es un indice en MongoDB?", "expected_doc": "MongoDB.pdf"},
+    {"q": "¿Que es un raid?", "expected_doc": "almacenamiento_de_datos.pdf"},
+    {"q": "¿Que tipos de datos tiene Hive?", "expected_doc": "apache_hive.pdf"},
+    {"q": "¿Cual es el objetivo del aprendizaje supervisado?", "expected_doc": "Explicacion_Modelos-Supervisado.pdf"},
+    {"q": "¿Tipos de clasificación de la regresión logistica?", "expected_doc": "Regresión Logística 2025-2026.pdf"},
+    {"q": "¿Cuando se detiene un arbol de decision?", "expected_doc": "arbol de decision_2025_2026.pdf"},
+    {"q": "¿Cual es el objetivo del aprendizaje no supervisado?", "expected_doc": "Kmeans_no_supervisado.pdf"},
+    {"q": "¿Que es un centroide en K-Means?", "expected_doc": "Kmeans_no_supervisado.pdf"},
+    {"q": "Que es la convolucion?", "expected_doc": "CNN_2025_2026.pdf"},
+]
+
+# ==============================================================================
+# FUNCIONES AUXILIARES
+# ==============================================================================
+
+def truncar(matriz, dim):
+    """
+    Truncado Matryoshka + re-normalización L2 por filas.
+    """
+    m = np.asarray(matriz, dtype=np.float32)[:, :dim]
+    return m / np.maximum(np.linalg.norm(m, axis=1, keepdims=True), 1e-12)
+
+def tamano_carpeta(ruta):
+    return sum(os.path.getsize(os.path.join(r, f)) for r, _, files in os.walk(ruta) for f in files)
+
+def evaluar_dimension(dim, datos, emb_docs, emb_queries):
+    logger.info(f"Evaluando dimensión {dim}...")
+    carpeta = tempfile.mkdtemp(prefix=f"bench_dim{dim}_")
+    try:
+        client = chromadb.PersistentClient(path=carpeta)
+        coleccion = client.create_collection(
+            "bench", metadata={"hnsw:space": "cosine", "embedding_model": MODELO_EMB, "embedding_dim": dim}
+        )
+        vectores = truncar(emb_docs, dim)
+        for i in range(0, len(datos["ids"]), LOTE_CHROMA):
+            coleccion.add(
+                ids=datos["ids"][i:i+LOTE_CHROMA],
+                embeddings=vectores[i:i+LOTE_CHROMA].tolist(),
+                metadatas=datos["metadatas"][i:i+LOTE_CHROMA],
+            )
+
+        hits_1 = hits_k = 0
+        mrr_sum = 0.0
+        latencias = []
+        for item, q_vec in zip(GOLDEN_DATASET, truncar(emb_queries, dim)):
+            t0 = time.perf_counter()
+            res = coleccion.query(query_embeddings=[q_vec.tolist()], n_results=TOP_K, include=["metadatas"])
+            latencias.append((time.perf_counter() - t0) * 1000)
+
+            fuentes = [os.path.basename(m.get("source", "")).lower() for m in res["metadatas"][0]]
+            objetivo = item["expected_doc"].lower()
+            posicion = next((i for i, f in enumerate(fuentes) if objetivo in f), -1)
+            if posicion != -1:
+                hits_k += 1
+                hits_1 += posicion == 0
+                mrr_sum += 1 / (posicion + 1)
+
+        del coleccion, client
+        total = len(GOLDEN_DATASET)
+        return {
+            "Dimensión": dim,
+            "Hit@1": f"{hits_1 / total * 100:.1f}%",
+            f"Hit@{TOP_K}": f"{hits_k / total * 100:.1f}%",
+            f"MRR@{TOP_K}": round(mrr_sum / total, 3),
+            "Latencia media (ms)": round(float(np.mean(latencias)), 2),
+            "Latencia p95 (ms)": round(float(np.percentile(latencias, 95)), 2),
+            "Vectores (MB)": round(vectores.nbytes / 1e6, 2),
+            "Disco ChromaDB (MB)": round(tamano_carpeta(carpeta) / 1e6, 2),
+        }
+    finally:
+        shutil.rmtree(carpeta, ignore_errors=True)
+
+# ==============================================================================
+# EJECUCION PRINCIPAL
+# ==============================================================================
+
+def main():
+    print("="*60)
+    print(" BENCHMARK DE DIMENSIONES MATRYOSHKA")
+    print("="*60)
+
+    if not os.path.exists(DB_PATH):
+        logger.error(f"No se encuentra la base de datos: {DB_PATH}")
+        return
+    try:
+        origen = chromadb.PersistentClient(path=DB_PATH).get_collection("text_knowledge")
+    except Exception as e:
+        logger.error(f"No existe la colección 'text_knowledge': {e}")
+        return
+
+    datos = origen.get(include=["documents", "metadatas"])
+    logger.info(f"Fragmentos: {len(datos['ids'])} | Modelo: {MODELO_EMB}")
+
+    # Una sola pasada del modelo a dimensión completa; el resto son truncados
+    model = SentenceTransformer(MODELO_EMB, trust_remote_code=True)
+    emb_docs = model.encode(datos["documents"], batch_size=32, normalize_embeddings=True, show_progress_bar=True)
+    emb_queries = model.encode([item["q"] for item in GOLDEN_DATASET], normalize_embeddings=True)
+    dim_completa = emb_docs.shape[1]
+
+    resultados = [evaluar_dimension(d, datos, emb_docs, emb_queries) for d in DIMENSIONES if d <= dim_completa]
+
+    df = pd.DataFrame(resultados)
+    print("\n" + "="*60)
+    print(" RESULTADOS CONSOLIDADOS")
+    print("="*60)
+    pd.set_option('display.max_columns', None)
+    pd.set_option('display.width', 1000)
+    print(df.to_string(index=False))
+    print("="*60)
+    try:
+        df.to_csv("benchmark_dimensiones.csv", index=False)
+        print("[INFO] Resultados guardados en 'benchmark_dimensiones.csv'")
+    except OSError:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -10,9 +10,24 @@ FLUJO DEL PIPELINE:
     2. Reescritura: Reformula la pregunta para mejorar la búsqueda.
     3. Recuperación Híbrida (Texto): Vectorial + BM25 + Fusión.
     4. Reranking (Texto): Reordenamiento con Cross-Encoder.
-    5. Recuperación Multimodal (Imágenes): CLIP + BM25.
+    5. Recuperación Multimodal (Imágenes): CLIP + BM25 (en paralelo con 3-4).
     6. Generación: Construcción del prompt blindado y streaming.
 
+CONCURRENCIA:
+    Todo el trabajo bloqueante (modelos, ChromaDB) se ejecuta en un pool de
+    hilos acotado (EXECUTOR_WORKERS) para no congelar el event loop.
+    Las llamadas al LLM usan un cliente asíncrono con pool HTTP/2 compartido.
+
+CONSULTAS POR LOTES:
+    /ask_batch recupera varias preguntas a la vez (un encode, una query de
+    ChromaDB con varios embeddings y un único lote del reranker) y, si se pide,
+    genera sus respuestas. Lo usan los scripts de evaluación.
+
+ARRANQUE:
+    Modelos, tokenizador, ChromaDB e índices BM25 se cargan en paralelo en
+    segundo plano. /health/ready informa del estado de cada componente y, con
+    DEGRADED_MODE, se atienden consultas de solo texto / BM25 mientras tanto.
+
 MODELOS UTILIZADOS:
     - Embeddings Texto: Qwen/Qwen3-Embedding-0.6B
     - Embeddings Imagen: clip-ViT-B-32
@@ -22,18 +37,35 @@ MODELOS UTILIZADOS:
 
 import os
 import time
+import asyncio
 import logging
 import math
 import json
-from typing import List, Dict, Any
+import hashlib
+import hmac
+import difflib
+from typing import List, Dict, Any, Optional, Tuple
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
+import numpy as np
+from fastapi import FastAPI, HTTPException, Header, Request
+from fastapi.responses import StreamingResponse, Response, JSONResponse
 from pydantic import BaseModel
 
 import chromadb
-from sentence_transformers import SentenceTransformer, CrossEncoder
-from rank_bm25 import BM25Okapi
+
+from src.api.executor import init_executor, shutdown_executor, run_blocking, ModeloProtegido
+from src.api.bm25_index import SparseBM25Index, huella_coleccion, diff_coleccion
+from src.api.reranker_service import RerankerMicroBatch
+from src.api.caches import EmbeddingCache, CacheLRU, SemanticCache, normalizar_texto
+from src.api.inference_backend import cargar_embedder, cargar_reranker
+from src.api.health import RegistroComponentes, LISTO, AUSENTE, ERROR, PENDIENTE, CARGANDO
+from src.api.metrics import (
+    medir, registrar_error, registrar_colector, exportar, TTFT, DURACION_STREAM, LIMITE_CUOTA, EN_CURSO
+)
+from src.api.prompt_budget import (
+    ContadorTokens, FragmentoContexto, PromptEnsamblado, ensamblar_prompt, compactar_prompt, MARCA_CONTEXTO, MARCA_INST_VISUAL,
+    tokenizador_por_defecto
+)
 
 # ==============================================================================
 # CONFIGURACION DE LOGS Y ENTORNO
@@ -54,10 +86,43 @@ except ImportError:
         MODEL_IMAGE = "clip-ViT-B-32"
         MODEL_RERANKER = "BAAI/bge-reranker-v2-m3"
         DB_PATH = "./chroma_db_multimodal"
-        def get_llm_client(self):
-            from openai import OpenAI
+        BM25_CACHE_DIR = os.path.join(DB_PATH, "bm25_index")
+        BM25_POLL_SECONDS = 60.0
+        ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+        RERANK_BATCH_WINDOW_MS = 5.0
+        RERANK_MAX_BATCH = 64
+        EMB_CACHE_SIZE = 2048
+        EMB_CACHE_TTL = 86400.0
+        EMB_CACHE_DISK = ""
+        REWRITE_CACHE_SIZE = 1024
+        REWRITE_CACHE_TTL = 3600.0
+        REWRITE_SPECULATIVE = True
+        REWRITE_SIMILARITY = 0.9
+        SEMANTIC_CACHE_SIZE = 512
+        SEMANTIC_CACHE_TTL = 86400.0
+        SEMANTIC_CACHE_THRESHOLD = 0.95
+        RERANK_CACHE_SIZE = 20000
+        RERANK_CACHE_TTL = 86400.0
+        DEDUP_THRESHOLD = 0.9
+        EXECUTOR_WORKERS = 8
+        TIMEOUT_RAMA_TEXTO = 30.0
+        TIMEOUT_RAMA_IMAGEN = 30.0
+        DISCONNECT_POLL_SECONDS = 0.5
+        BATCH_MAX_QUERIES = 256
+        BATCH_LLM_CONCURRENCY = 4
+        DEGRADED_MODE = False
+        INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch")
+        BACKEND_TEXT = BACKEND_IMAGE = BACKEND_RERANKER = INFERENCE_BACKEND
+        ONNX_EXPORT_DIR = "./cache/onnx"
+        ONNX_QUANT_CONFIG = "avx2"
+        EMB_DIM_TEXT = int(os.getenv("EMB_DIM_TEXT", "0"))
+        LLM_TOKENIZER = os.getenv("LLM_TOKENIZER", "")
+        PROMPT_MAX_TOKENS = 6000
+        PROMPT_HISTORY_KEEP = 2
+        def get_async_llm_client(self):
+            from openai import AsyncOpenAI
             return {
-                "client": OpenAI(base_url="https://openrouter.ai/api/v1", api_key=os.getenv("OPENROUTER_API_KEY")),
+                "client": AsyncOpenAI(base_url=os.getenv("LLM_BASE_URL", "https://openrouter.ai/api/v1"), api_key=os.getenv("OPENROUTER_API_KEY")),
                 "model": os.getenv("LLM_MODEL", "tngtech/deepseek-r1t2-chimera:free")
             }
     settings = MockSettings()
@@ -68,7 +133,7 @@ app = FastAPI(title="API RAG Universitario", version="3.5-Professional")
 # INICIALIZACION DE CLIENTES
 # ==============================================================================
 logger.info("[INICIO] Cargando clientes LLM...")
-llm_setup = settings.get_llm_client()
+llm_setup = settings.get_async_llm_client()  # AsyncOpenAI con pool HTTP/2 compartido
 client_llm = llm_setup["client"]
 MODEL_LLM_NAME = llm_setup["model"]
 
@@ -77,12 +142,27 @@ chroma_client = None
 model_texto = None
 model_imagen = None
 model_reranker = None
+reranker_service = None
+embedding_cache = None
+contador_tokens = None
 col_text = None
 col_img = None
 
-# Índices en memoria
-bm25_text_index = None; bm25_text_docs = []; bm25_text_metadatas = []
-bm25_img_index = None; bm25_img_docs = []; bm25_img_metadatas = []
+# Índices en memoria (BM25 disperso indexado por id de ChromaDB).
+# Se sustituyen de forma atómica (reasignación) al aplicar cambios incrementales.
+bm25_text_index = None
+bm25_img_index = None
+_indices_lock = asyncio.Lock()
+_tarea_poller = None
+_tarea_carga = None
+
+# Estado de carga de cada componente (arranque concurrente y /health/ready)
+COMPONENTES = ("modelo_texto", "modelo_imagen", "reranker", "tokenizador", "chroma", "indice_texto", "indice_imagen")
+componentes = RegistroComponentes(COMPONENTES)
+backends_inferencia: Dict[str, str] = {}  # backend efectivo de cada modelo (tras posibles fallbacks)
+
+# Contadores operativos
+metricas = {"cancelaciones": 0}
 
 # Prompt de Sistema para Reescritura (Query Rewriting)
 SYSTEM_PROMPT_REWRITE = """
@@ -93,6 +173,15 @@ Tu única función es reformular la consulta del usuario basándote en el HISTOR
 3. Devuelve SOLO el texto reescrito.
 """
 
+# Caché de reescrituras: clave = (hash del historial reciente, consulta normalizada)
+cache_reescrituras = CacheLRU(settings.REWRITE_CACHE_SIZE, settings.REWRITE_CACHE_TTL)
+
+# Caché semántica de respuestas (solo preguntas sin historial); SEMANTIC_CACHE_SIZE=0 la desactiva
+cache_semantica = (
+    SemanticCache(settings.SEMANTIC_CACHE_SIZE, settings.SEMANTIC_CACHE_TTL, settings.SEMANTIC_CACHE_THRESHOLD)
+    if settings.SEMANTIC_CACHE_SIZE > 0 else None
+)
+
 # ==============================================================================
 # MODELOS DE DATOS (Pydantic)
 # ==============================================================================
@@ -105,6 +194,11 @@ class QueryRequest(BaseModel):
     history: List[Message] = []
     persona: str = "chico" 
 
+class BatchRequest(BaseModel):
+    preguntas: List[str]
+    persona: str = "chico"
+    generar: bool = False  # True: además de recuperar, genera la respuesta de cada pregunta
+
 # ==============================================================================
 # FUNCIONES AUXILIARES DE LÓGICA
 # ==============================================================================
@@ -123,229 +217,755 @@ def calcular_certeza(logit: float) -> float:
 def reciprocal_rank_fusion(lists_of_results: List[List[Dict]], k=60):
     """
     Algoritmo RRF para fusionar listas de resultados (Vectorial + BM25).
+    Los candidatos se fusionan por id de ChromaDB (todos los chunks de un PDF
+    comparten 'path', así que no sirve como clave).
     """
     fused_scores = {}
     for doc_list in lists_of_results:
         for rank, item in enumerate(doc_list):
-            doc_id = item['meta'].get('path') or item['doc'][:100]
+            doc_id = item.get('id') or item['doc'][:100]
             if doc_id not in fused_scores:
-                fused_scores[doc_id] = {"doc": item['doc'], "meta": item['meta'], "score": 0.0}
+                fused_scores[doc_id] = {"id": item.get('id'), "doc": item['doc'], "meta": item['meta'], "score": 0.0}
             fused_scores[doc_id]["score"] += 1.0 / (k + rank)
     
     return sorted(fused_scores.values(), key=lambda x: x["score"], reverse=True)
 
-def reescribir_consulta_contextual(query_original: str, history: List[Message]) -> str:
+def _shingles(texto: str, n: int = 3) -> set:
+    palabras = normalizar_texto(texto).split()
+    if len(palabras) <= n:
+        return {" ".join(palabras)}
+    return {" ".join(palabras[i:i + n]) for i in range(len(palabras) - n + 1)}
+
+def deduplicar_candidatos(candidatos: List[Dict], umbral: float = 0.9) -> List[Dict]:
+    """
+    Elimina pasajes de texto duplicados (texto idéntico) o casi duplicados (Jaccard
+    de trigramas de palabras >= umbral) antes del reranking, conservando el de
+    mayor puntuación RRF. La lista de entrada debe venir ordenada por score.
+    No se aplica a imágenes: su 'doc' es una descripción generada.
+    """
+    vistos, firmas, unicos = set(), [], []
+    for c in candidatos:
+        exacto = hashlib.sha1(normalizar_texto(c['doc']).encode("utf-8")).hexdigest()
+        if exacto in vistos:
+            continue
+        sh = _shingles(c['doc'])
+        if any(len(sh & otro) / max(len(sh | otro), 1) >= umbral for otro in firmas):
+            continue
+        vistos.add(exacto)
+        firmas.append(sh)
+        unicos.append(c)
+    return unicos
+
+def clave_reescritura(query: str, history: List[Message]) -> str:
+    """
+    Clave de caché de una reescritura: solo influyen los últimos 4 mensajes.
+    """
+    reciente = json.dumps([[m.role, m.content] for m in history[-4:]], ensure_ascii=False)
+    return hashlib.sha1(f"{reciente}\x00{normalizar_texto(query)}".encode("utf-8")).hexdigest()
+
+def reescritura_sin_llm(query: str, history: List[Message]) -> Optional[str]:
+    """
+    Devuelve la consulta de búsqueda sin llamar al LLM cuando es posible:
+    sin historial no hay nada que resolver, y si no, se consulta la caché.
+    """
+    if not history:
+        return query
+    return cache_reescrituras.get(clave_reescritura(query, history))
+
+def consultas_equivalentes(a: str, b: str) -> bool:
+    """
+    True si dos consultas son iguales o casi idénticas (REWRITE_SIMILARITY).
+    """
+    na, nb = normalizar_texto(a), normalizar_texto(b)
+    return na == nb or difflib.SequenceMatcher(None, na, nb).ratio() >= settings.REWRITE_SIMILARITY
+
+async def reescribir_consulta_contextual(query_original: str, history: List[Message]) -> str:
     """
     Reescribe la pregunta del usuario usando el contexto del historial.
+    Sin historial se devuelve la consulta tal cual; las reescrituras se cachean.
     """
+    atajo = reescritura_sin_llm(query_original, history)
+    if atajo is not None:
+        return atajo
+
     try:
         contexto_chat = "\n".join([f"{m.role}: {m.content}" for m in history[-4:]])
         prompt = f"HISTORIAL:\n{contexto_chat}\nUSUARIO: {query_original}\nQUERY:"
         messages = [{"role": "system", "content": SYSTEM_PROMPT_REWRITE}, {"role": "user", "content": prompt}]
         
-        resp = client_llm.chat.completions.create(
+        resp = await client_llm.chat.completions.create(
             model=MODEL_LLM_NAME, messages=messages, temperature=0.1, max_tokens=60
         )
         rewritten = resp.choices[0].message.content.strip()
         
-        if not rewritten or len(rewritten) < 2: return query_original
+        if not rewritten or len(rewritten) < 2: rewritten = query_original
+        cache_reescrituras.put(clave_reescritura(query_original, history), rewritten)
         return rewritten
     except Exception:
+        registrar_error("rewrite")
         return query_original
 
+def marca_ingesta(nombre: str) -> Optional[str]:
+    """
+    Marca que escriben los scripts de ingesta al terminar de modificar una colección
+    (DB_PATH/ingesta_<colección>.json). Si cambia, el refresco compara contenidos
+    y no solo ids, porque la ingesta puede haber actualizado registros existentes.
+    """
+    try:
+        with open(os.path.join(settings.DB_PATH, f"ingesta_{nombre}.json"), "r", encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def cargar_o_construir_bm25(collection) -> SparseBM25Index:
+    """
+    Carga el índice BM25 persistido de una colección si su huella coincide;
+    en caso contrario lo reconstruye desde ChromaDB y lo guarda en disco.
+    """
+    directorio = os.path.join(settings.BM25_CACHE_DIR, collection.name)
+    # La marca se lee antes que la colección: una ingesta posterior se detectará en el refresco
+    marca = marca_ingesta(collection.name)
+    huella = huella_coleccion(collection)
+
+    t0 = time.time()
+    index = SparseBM25Index.cargar(directorio, huella)
+    if index is not None:
+        index.marca_ingesta = marca
+        logger.info(f"[INDEX] BM25 '{collection.name}' cargado de disco ({len(index)} docs, {time.time()-t0:.2f}s)")
+        return index
+
+    logger.info(f"[INDEX] Reconstruyendo BM25 '{collection.name}' (huella distinta o sin caché)...")
+    datos = collection.get()
+    index = SparseBM25Index.build(datos['ids'], datos['documents'], datos['metadatas'])
+    try:
+        index.guardar(directorio, huella)
+    except OSError as e:
+        logger.warning(f"[INDEX] No se pudo guardar el BM25 '{collection.name}': {e}")
+    index.huella = huella
+    index.marca_ingesta = marca
+    logger.info(f"[INDEX] BM25 '{collection.name}' construido ({len(index)} docs, {time.time()-t0:.2f}s)")
+    return index
+
+def actualizar_bm25(collection, index: Optional[SparseBM25Index]):
+    """
+    Aplica al índice solo los documentos nuevos, modificados o borrados de la colección.
+    Devuelve (índice_nuevo, resumen). Si no hay cambios devuelve el mismo índice.
+    Sin una ingesta nueva (marca sin cambios) solo se comparan los ids y se
+    descargan los documentos de los ids añadidos.
+    """
+    marca = marca_ingesta(collection.name)
+    completo = index is None or marca != index.marca_ingesta
+    upserts, borrados, huella = diff_coleccion(collection, index, completo)
+    resumen = {"docs": len(index) if index is not None else 0, "nuevos_o_modificados": len(upserts), "borrados": len(borrados)}
+    if not upserts and not borrados and index is not None:
+        index.marca_ingesta = marca
+        return index, resumen
+
+    if index is None:
+        nuevo = SparseBM25Index.build([u[0] for u in upserts], [u[1] for u in upserts], [u[2] for u in upserts])
+    else:
+        nuevo = index.aplicar_cambios(upserts, borrados)
+    try:
+        nuevo.guardar(os.path.join(settings.BM25_CACHE_DIR, collection.name), huella)
+    except OSError as e:
+        logger.warning(f"[INDEX] No se pudo guardar el BM25 '{collection.name}': {e}")
+    nuevo.huella = huella
+    nuevo.marca_ingesta = marca
+    resumen["docs"] = len(nuevo)
+    return nuevo, resumen
+
+def coleccion_inexistente(e: Exception) -> bool:
+    """
+    True si el error de ChromaDB indica que la colección no existe (según la versión:
+    NotFoundError, InvalidCollectionException o ValueError "... does not exist").
+    """
+    return type(e).__name__ in ("NotFoundError", "InvalidCollectionException") or "does not exist" in str(e)
+
+async def refrescar_indices() -> Dict[str, Any]:
+    """
+    Detecta cambios en las colecciones y actualiza los índices BM25 en caliente.
+    Las consultas en curso siguen usando el índice anterior hasta la sustitución.
+    """
+    global chroma_client, col_text, col_img, bm25_text_index, bm25_img_index
+
+    async with _indices_lock:
+        if chroma_client is None:
+            if not os.path.exists(settings.DB_PATH):
+                return {"error": "Base de datos no encontrada"}
+            chroma_client = await run_blocking(chromadb.PersistentClient, path=settings.DB_PATH)
+
+        resumen = {}
+        for nombre in ("text_knowledge", "multimodal_knowledge"):
+            actual = bm25_text_index if nombre == "text_knowledge" else bm25_img_index
+            componente = "indice_texto" if nombre == "text_knowledge" else "indice_imagen"
+            try:
+                # Se vuelve a pedir la colección: puede haberse borrado y recreado a mano (p. ej. para reindexar con otra dimensión)
+                col = await run_blocking(chroma_client.get_collection, nombre)
+                nuevo, resumen[nombre] = await run_blocking(actualizar_bm25, col, actual)
+            except Exception as e:
+                if not coleccion_inexistente(e):
+                    # Fallo transitorio: se sigue sirviendo con la colección y el índice anteriores
+                    logger.error(f"[INDEX] Error refrescando '{nombre}' (se mantiene el índice anterior): {e}")
+                    resumen[nombre] = {"error": str(e)}
+                    if actual is not None:
+                        componentes.marcar(componente, LISTO, error_refresco=str(e))
+                    else:
+                        componentes.marcar(componente, ERROR, error=str(e))
+                    continue
+                logger.warning(f"[INDEX] Colección '{nombre}' no disponible: {e}")
+                col, nuevo, resumen[nombre] = None, None, {"error": str(e), "docs": 0}
+
+            if nombre == "text_knowledge":
+                col_text, bm25_text_index = col, nuevo
+            else:
+                col_img, bm25_img_index = col, nuevo
+            componentes.marcar(
+                componente, LISTO if nuevo is not None else AUSENTE,
+                docs=resumen[nombre].get("docs", 0), error_refresco=None
+            )
+
+            # Un chunk modificado conserva su id: las puntuaciones cacheadas dejan de ser válidas
+            cambios = resumen[nombre]
+            if reranker_service and reranker_service.cache is not None and (
+                "error" in cambios or cambios.get("nuevos_o_modificados") or cambios.get("borrados")
+            ):
+                reranker_service.cache.clear()
+        return resumen
+
+async def poller_indices():
+    """
+    Tarea de fondo: revisa periódicamente las colecciones (BM25_POLL_SECONDS).
+    """
+    while True:
+        await asyncio.sleep(settings.BM25_POLL_SECONDS)
+        try:
+            resumen = await refrescar_indices()
+            for nombre, r in resumen.items():
+                if isinstance(r, dict) and (r.get("nuevos_o_modificados") or r.get("borrados")):
+                    logger.info(f"[INDEX] '{nombre}' actualizado: +{r['nuevos_o_modificados']} / -{r['borrados']} ({r['docs']} docs)")
+        except Exception as e:
+            logger.error(f"[INDEX] Error en el refresco periódico: {e}")
+
 # ==============================================================================
 # EVENTOS DE CICLO DE VIDA (STARTUP)
 # ==============================================================================
+async def _cargar_con_backend(cargador, nombre_modelo: str, backend: str, **kwargs):
+    modelo, efectivo = await run_blocking(
+        cargador, nombre_modelo, backend, settings.ONNX_EXPORT_DIR, settings.ONNX_QUANT_CONFIG, **kwargs
+    )
+    backends_inferencia[nombre_modelo] = efectivo
+    logger.info(f"[BACKEND] {nombre_modelo}: {efectivo}")
+    return ModeloProtegido(modelo)
+
+async def _cargar_modelo_texto():
+    global model_texto
+    model_texto = await _cargar_con_backend(cargar_embedder, settings.MODEL_TEXT, settings.BACKEND_TEXT, trust_remote_code=True)
+    return model_texto
+
+async def _cargar_modelo_imagen():
+    global model_imagen
+    model_imagen = await _cargar_con_backend(cargar_embedder, settings.MODEL_IMAGE, settings.BACKEND_IMAGE)
+    return model_imagen
+
+async def _cargar_reranker():
+    global model_reranker, reranker_service
+    modelo = await _cargar_con_backend(cargar_reranker, settings.MODEL_RERANKER, settings.BACKEND_RERANKER, trust_remote_code=True)
+    reranker_service = RerankerMicroBatch(
+        modelo, settings.RERANK_BATCH_WINDOW_MS, settings.RERANK_MAX_BATCH,
+        nombre_modelo=settings.MODEL_RERANKER, cache_size=settings.RERANK_CACHE_SIZE, cache_ttl=settings.RERANK_CACHE_TTL
+    )
+    model_reranker = modelo
+    return model_reranker
+
+async def _cargar_tokenizador():
+    global contador_tokens
+    contador_tokens = await run_blocking(ContadorTokens, settings.LLM_TOKENIZER or tokenizador_por_defecto(MODEL_LLM_NAME))
+    logger.info(f"[PROMPT] Presupuesto {settings.PROMPT_MAX_TOKENS} tokens (tokenizador: {contador_tokens.nombre})")
+    return contador_tokens
+
+async def _abrir_coleccion(nombre: str):
+    try:
+        return await run_blocking(chroma_client.get_collection, nombre)
+    except Exception:
+        logger.warning(f"[DB] Colección '{nombre}' no encontrada")
+        return None
+
+async def _cargar_indices():
+    """
+    Conecta con ChromaDB y carga los índices de texto e imagen en paralelo.
+    Retiene el lock de índices para que el poller no se adelante a la carga inicial.
+    """
+    global chroma_client, col_text, col_img, bm25_text_index, bm25_img_index
+
+    async with _indices_lock:
+        if not os.path.exists(settings.DB_PATH):
+            logger.warning(f"[DB] Base de datos no encontrada en: {settings.DB_PATH}")
+            for nombre in ("chroma", "indice_texto", "indice_imagen"): componentes.marcar(nombre, AUSENTE)
+            return
+
+        logger.info(f"[DB] Conectando a ChromaDB en: {settings.DB_PATH}")
+        chroma_client = await componentes.cargar("chroma", lambda: run_blocking(chromadb.PersistentClient, path=settings.DB_PATH))
+        if chroma_client is None:
+            for nombre in ("indice_texto", "indice_imagen"): componentes.marcar(nombre, ERROR, error="ChromaDB no disponible")
+            return
+
+        # La colección se publica antes que su BM25: la búsqueda vectorial puede
+        # empezar (modo degradado) mientras el índice se construye
+        async def cargar_texto():
+            global col_text, bm25_text_index
+            col_text = await _abrir_coleccion("text_knowledge")
+            if col_text is not None:
+                dim = dimension_texto(col_text)
+                logger.info(f"[DB] text_knowledge: embeddings de dimensión {dim or 'completa'}")
+                if settings.EMB_DIM_TEXT and dim != settings.EMB_DIM_TEXT:
+                    logger.warning(
+                        f"[DB] EMB_DIM_TEXT={settings.EMB_DIM_TEXT} no coincide con la colección ({dim or 'completa'}): "
+                        "se consulta con la dimensión de la colección. Reindexa para cambiarla."
+                    )
+                bm25_text_index = await run_blocking(cargar_o_construir_bm25, col_text)
+            return bm25_text_index
+
+        async def cargar_imagen():
+            global col_img, bm25_img_index
+            col_img = await _abrir_coleccion("multimodal_knowledge")
+            if col_img is not None:
+                bm25_img_index = await run_blocking(cargar_o_construir_bm25, col_img)
+            return bm25_img_index
+
+        await asyncio.gather(componentes.cargar("indice_texto", cargar_texto), componentes.cargar("indice_imagen", cargar_imagen))
+
+async def carga_inicial():
+    """
+    Carga en paralelo modelos, tokenizador, ChromaDB e índices BM25.
+    Cada componente pasa a 'listo' en cuanto termina (ver /health/ready).
+    """
+    t0 = time.time()
+    logger.info("[SISTEMA] Cargando modelos de Embeddings, Reranker e índices en paralelo...")
+    await asyncio.gather(
+        componentes.cargar("modelo_texto", _cargar_modelo_texto),
+        componentes.cargar("modelo_imagen", _cargar_modelo_imagen),
+        componentes.cargar("reranker", _cargar_reranker),
+        componentes.cargar("tokenizador", _cargar_tokenizador),
+        _cargar_indices(),
+    )
+    if modo_servicio() == "completo":
+        logger.info(f"[LISTO] Sistema preparado para consultas ({time.time()-t0:.1f}s).")
+    else:
+        logger.warning(f"[ARRANQUE] Carga terminada con componentes no disponibles: {componentes.snapshot()}")
+
+def modo_servicio() -> Optional[str]:
+    """
+    'completo' si todos los componentes han cargado (o no existen), 'degradado' si
+    DEGRADED_MODE está activo y al menos la búsqueda de texto es posible (BM25 o
+    Qwen + ChromaDB), o None si todavía no se pueden atender consultas.
+    """
+    estados = [componentes.estado(n) for n in COMPONENTES]
+    if all(e in (LISTO, AUSENTE) for e in estados) and componentes.listo("reranker"):
+        return "completo"
+    if settings.DEGRADED_MODE and (
+        componentes.listo("indice_texto") or (componentes.listo("modelo_texto") and col_text is not None)
+    ):
+        return "degradado"
+    return None
+
 @app.on_event("startup")
-def startup_event():
-    global chroma_client, model_texto, model_imagen, model_reranker
-    global col_text, col_img
-    global bm25_text_index, bm25_text_docs, bm25_text_metadatas
-    global bm25_img_index, bm25_img_docs, bm25_img_metadatas
+async def startup_event():
+    global embedding_cache, _tarea_carga
     
     logger.info(f"[SISTEMA] INICIANDO API (Provider: {settings.PROVIDER.upper()})")
-    
-    logger.info("[SISTEMA] Cargando modelos de Embeddings y Reranker...")
-    model_texto = SentenceTransformer(settings.MODEL_TEXT, trust_remote_code=True)
-    model_imagen = SentenceTransformer(settings.MODEL_IMAGE)
-    model_reranker = CrossEncoder(settings.MODEL_RERANKER, trust_remote_code=True)
-    
-    if os.path.exists(settings.DB_PATH):
-        logger.info(f"[DB] Conectando a ChromaDB en: {settings.DB_PATH}")
-        chroma_client = chromadb.PersistentClient(path=settings.DB_PATH)
-        
-        try: col_text = chroma_client.get_collection("text_knowledge")
-        except: logger.warning("[DB] Colección de texto no encontrada")
-        
-        try: col_img = chroma_client.get_collection("multimodal_knowledge")
-        except: logger.warning("[DB] Colección de imágenes no encontrada")
 
-        if col_text:
-            logger.info("[INDEX] Indexando documentos PDF para BM25...")
-            all_text = col_text.get()
-            bm25_text_docs = all_text['documents']
-            bm25_text_metadatas = all_text['metadatas']
-            bm25_text_index = BM25Okapi([d.lower().split() for d in bm25_text_docs])
+    init_executor(settings.EXECUTOR_WORKERS)
+    logger.info(f"[SISTEMA] Pool de trabajo bloqueante: {settings.EXECUTOR_WORKERS} hilos")
+    
+    embedding_cache = EmbeddingCache(settings.EMB_CACHE_SIZE, settings.EMB_CACHE_TTL, settings.EMB_CACHE_DISK)
+    # La carga no bloquea el arranque: /health/live responde desde el primer momento
+    _tarea_carga = asyncio.create_task(carga_inicial())
 
-        if col_img:
-            logger.info("[INDEX] Indexando imágenes para BM25...")
-            all_img = col_img.get()
-            bm25_img_docs = all_img['documents']
-            bm25_img_metadatas = all_img['metadatas']
-            bm25_img_index = BM25Okapi([d.lower().split() for d in bm25_img_docs])
+@app.on_event("startup")
+async def iniciar_poller_indices():
+    global _tarea_poller
+    if settings.BM25_POLL_SECONDS > 0:
+        logger.info(f"[INDEX] Refresco incremental de índices cada {settings.BM25_POLL_SECONDS:.0f}s")
+        _tarea_poller = asyncio.create_task(poller_indices())
 
-    logger.info("[LISTO] Sistema preparado para consultas.")
+@app.on_event("shutdown")
+async def shutdown_event():
+    if _tarea_carga: _tarea_carga.cancel()
+    if _tarea_poller: _tarea_poller.cancel()
+    if reranker_service: await reranker_service.cerrar()
+    await client_llm.close()
+    shutdown_executor()
 
 # ==============================================================================
-# GENERADOR RAG (STREAMING LOGIC)
+# RAMAS DE RECUPERACIÓN (TEXTO / IMAGEN)
 # ==============================================================================
 
-async def generate_rag_stream(query: str, history: List[Message], persona: str = "chico"):
+def version_colecciones() -> str:
     """
-    Núcleo del sistema RAG. Ejecuta recuperación y generación.
+    Versión del conocimiento indexado (huellas de ambas colecciones).
+    Cambia tras una ingesta aplicada en caliente e invalida la caché semántica.
     """
-    def log_msg(msg: str):
-        return json.dumps({"type": "log", "message": msg}) + "\n"
+    huellas = [getattr(idx, "huella", None) for idx in (bm25_text_index, bm25_img_index)]
+    return "|".join(str(h) for h in huellas)
 
-    logger.info("="*50)
-    logger.info(f"[NUEVA CONSULTA] RECIBIDA: '{query}'")
-    yield log_msg(f"Analizando consulta: '{query}'")
+def truncar_embedding(vec, dim: int) -> np.ndarray:
+    """
+    Truncado Matryoshka: conserva las `dim` primeras componentes y re-normaliza (L2).
+    dim <= 0 devuelve el vector sin cambios.
+    """
+    v = np.asarray(vec, dtype=np.float32).ravel()
+    if dim <= 0:
+        return v
+    v = v[:dim]
+    norma = float(np.linalg.norm(v))
+    return v / norma if norma else v
 
-    # 1. Reescribir
-    query_busqueda = reescribir_consulta_contextual(query, history)
-    logger.info(f"[REWRITE] '{query}' >> '{query_busqueda}'")
-    
-    if query_busqueda != query:
-        yield log_msg(f"Reformulado: '{query_busqueda}'")
-    
-    debug_info = {
-        "query_rewritten": f"{query} >> {query_busqueda}",
-        "step1_text_vec": [], "step1_text_bm25": [], "step2_text_final": [],
-        "step1_img_vec": [], "step1_img_bm25": [], "step2_img_final": []
-    }
-    
-    # 2. Retrieval Texto
-    yield log_msg("Buscando en documentos PDF...")
+def dimension_texto(coleccion) -> int:
+    """
+    Dimensión de las consultas de texto: la registrada en la colección por la ingesta
+    (las colecciones antiguas sin registro usan la dimensión completa) o EMB_DIM_TEXT.
+    """
+    if coleccion is None:
+        return settings.EMB_DIM_TEXT
+    return int((coleccion.metadata or {}).get("embedding_dim") or 0)
+
+def clave_embedding(nombre_modelo: str, dim: int = 0) -> str:
+    """
+    Espacio de la caché de embeddings: modelo, backend efectivo (con la configuración
+    de cuantización en onnx-int8) y dimensión. Los vectores de torch, onnx e int8 no
+    son idénticos, así que al cambiar de backend no se reutilizan los del disco.
+    """
+    backend = backends_inferencia.get(nombre_modelo, "torch")
+    if backend == "onnx-int8":
+        backend = f"{backend}:{settings.ONNX_QUANT_CONFIG}"
+    clave = f"{nombre_modelo}|{backend}"
+    return f"{clave}@{dim}" if dim > 0 else clave
+
+async def codificar_consulta(modelo, nombre_modelo: str, texto: str, dim: int = 0) -> List[float]:
+    """
+    Embedding de la consulta con caché (memoria + disco), truncado a `dim` si se indica.
+    Solo se ejecuta el modelo si la consulta no está en caché. La memoria se consulta
+    en el bucle de eventos; el disco (SQLite), en el pool de hilos.
+    """
+    clave = clave_embedding(nombre_modelo, dim)
+    vec = embedding_cache.get_memoria(clave, texto) if embedding_cache else None
+    if vec is None and embedding_cache and embedding_cache.en_disco:
+        vec = await run_blocking(embedding_cache.get_disco, clave, texto)
+    if vec is None:
+        vec = truncar_embedding(await run_blocking(modelo.encode, texto), dim)
+        if embedding_cache:
+            vec = await run_blocking(embedding_cache.put, clave, texto, vec)
+    return vec.tolist()
+
+async def codificar_lote(modelo, nombre_modelo: str, textos: List[str], dim: int = 0) -> List[List[float]]:
+    """
+    Versión por lotes de codificar_consulta: las consultas que no están en caché
+    se vectorizan en una sola pasada del modelo.
+    """
+    clave = clave_embedding(nombre_modelo, dim)
+    vecs = [embedding_cache.get_memoria(clave, t) if embedding_cache else None for t in textos]
+    faltan = [i for i, v in enumerate(vecs) if v is None]
+    if faltan and embedding_cache and embedding_cache.en_disco:
+        def buscar_disco():
+            for i in faltan:
+                vecs[i] = embedding_cache.get_disco(clave, textos[i])
+        await run_blocking(buscar_disco)
+        faltan = [i for i in faltan if vecs[i] is None]
+    if faltan:
+        nuevos = await run_blocking(modelo.encode, [textos[i] for i in faltan], batch_size=len(faltan))
+
+        def guardar():
+            for i, v in zip(faltan, nuevos):
+                v = truncar_embedding(v, dim)
+                vecs[i] = embedding_cache.put(clave, textos[i], v) if embedding_cache else v
+        await run_blocking(guardar)
+    return [v.tolist() for v in vecs]
+
+def seleccionar_texto(cands: List[Dict], scores: List[float], k: int = 4) -> List[Dict]:
+    """
+    Top-k de fragmentos de texto según la puntuación (logit) del reranker.
+    """
+    ranked = sorted([{"doc": c['doc'], "meta": c['meta'], "score": float(s), "certeza": calcular_certeza(float(s))}
+                     for c, s in zip(cands, scores)], key=lambda x: x['score'], reverse=True)
+    return ranked[:k]
+
+def orden_rrf(cands: List[Dict], k: int = 4) -> List[Dict]:
+    """
+    Top-k de texto sin reranker (modo degradado): se conserva el orden de la fusión RRF.
+    La puntuación RRF no es un logit: estos fragmentos no llevan certeza.
+    """
+    return [{"doc": c['doc'], "meta": c['meta'], "score": c['score'], "certeza": None} for c in cands[:k]]
+
+def seleccionar_imagenes(cands: List[Dict], scores: List[float], k: int = 3) -> List[Dict]:
+    """
+    Top-k de imágenes con certeza > 0% (el filtrado por umbral se hace en el Front).
+    """
+    ranked = []
+    for c, s in zip(cands, scores):
+        score_pct = calcular_certeza(float(s))
+        if score_pct > 0.0:
+            ranked.append({"doc": c['doc'], "meta": c['meta'], "score": score_pct, "certeza": score_pct})
+    return sorted(ranked, key=lambda x: x['score'], reverse=True)[:k]
+
+async def recuperar_texto(query_busqueda: str, query: str, debug_info: Dict, logs: List[str]) -> List[Dict]:
+    """
+    Rama de texto: Qwen → Chroma (text_knowledge) → BM25 → RRF → Rerank.
+    Los mensajes para el cliente se acumulan en `logs`.
+    """
     list_vec_text, list_bm25_text = [], []
+    coleccion, indice = col_text, bm25_text_index  # referencias estables durante la consulta
     
-    if col_text:
+    if coleccion and model_texto is not None:
         try:
-            vec = model_texto.encode(query_busqueda).tolist()
-            res = col_text.query(query_embeddings=[vec], n_results=10)
+            with medir("text_vector"):
+                vec = await codificar_consulta(model_texto, settings.MODEL_TEXT, query_busqueda, dimension_texto(coleccion))
+                res = await run_blocking(coleccion.query, query_embeddings=[vec], n_results=10)
             logger.info(f"   [VECTOR TEXT] Encontrados {len(res['documents'][0])} candidatos")
             for i, doc in enumerate(res['documents'][0]):
                 meta = res['metadatas'][0][i]
-                list_vec_text.append({"doc": doc, "meta": meta})
+                list_vec_text.append({"id": res['ids'][0][i], "doc": doc, "meta": meta})
                 debug_info["step1_text_vec"].append(f"{meta.get('source')} ({meta.get('asignatura')})")
-        except Exception as e: logger.error(f"[ERROR] Vector Text: {e}")
+        except Exception as e:
+            registrar_error("text_vector")
+            logger.error(f"[ERROR] Vector Text: {e}")
         
-    if bm25_text_index:
+    if indice:
         try:
-            top = bm25_text_index.get_top_n(query_busqueda.lower().split(), bm25_text_docs, n=10)
+            with medir("text_bm25"):
+                top = await run_blocking(indice.search, query_busqueda, 10)
             logger.info(f"   [BM25 TEXT] Encontrados {len(top)} candidatos")
-            for doc in top:
-                idx = bm25_text_docs.index(doc)
-                meta = bm25_text_metadatas[idx]
-                list_bm25_text.append({"doc": doc, "meta": meta})
+            for doc_id, _ in top:
+                doc, meta = indice.documento(doc_id)
+                list_bm25_text.append({"id": doc_id, "doc": doc, "meta": meta})
                 debug_info["step1_text_bm25"].append(f"{meta.get('source')} ({meta.get('asignatura')})")
-        except Exception as e: logger.error(f"[ERROR] BM25 Text: {e}")
+        except Exception as e:
+            registrar_error("text_bm25")
+            logger.error(f"[ERROR] BM25 Text: {e}")
 
-    cands_text = reciprocal_rank_fusion([list_vec_text, list_bm25_text])[:15]
+    with medir("text_rrf"):
+        fusion = reciprocal_rank_fusion([list_vec_text, list_bm25_text])
+        cands_text = deduplicar_candidatos(fusion, settings.DEDUP_THRESHOLD)[:15]
+    if len(fusion) > len(cands_text):
+        logger.info(f"   [DEDUP TEXT] {len(fusion)} candidatos fusionados -> {len(cands_text)} únicos")
     final_text = []
     
-    if cands_text:
+    if cands_text and reranker_service is None:
+        # Modo degradado: sin Cross-Encoder se conserva el orden de la fusión RRF
+        logs.append("Reranker cargando: se usa el orden de la búsqueda híbrida.")
+        final_text = orden_rrf(cands_text)
+        debug_info["step2_text_final"] = [f"[RRF {x['score']:.3f}] {x['meta'].get('source')}" for x in final_text]
+    elif cands_text:
         logger.info(f"[RERANK TEXT] Evaluando {len(cands_text)} fragmentos...")
-        yield log_msg(f"Reordenando {len(cands_text)} fragmentos de texto...")
+        logs.append(f"Reordenando {len(cands_text)} fragmentos de texto...")
         
-        scores = model_reranker.predict([[query, x['doc']] for x in cands_text])
-        ranked = sorted([{"doc": c['doc'], "meta": c['meta'], "score": float(s)} for c, s in zip(cands_text, scores)], key=lambda x: x['score'], reverse=True)
-        final_text = ranked[:4]
+        with medir("text_rerank"):
+            scores = await reranker_service.puntuar([[query, x['doc']] for x in cands_text], [x['id'] for x in cands_text])
+        final_text = seleccionar_texto(cands_text, scores)
         
         debug_info["step2_text_final"] = [f"[{x['score']:.2f}] {x['meta'].get('source')}" for x in final_text]
 
-    # 3. Retrieval Imagen
-    yield log_msg("Buscando en diapositivas e imagenes...")
+    return final_text
+
+async def recuperar_imagenes(query_busqueda: str, query: str, debug_info: Dict, logs: List[str]) -> List[Dict]:
+    """
+    Rama de imagen: CLIP → Chroma (multimodal_knowledge) → BM25 → RRF → Rerank.
+    Los mensajes para el cliente se acumulan en `logs`.
+    """
     list_vec_img, list_bm25_img = [], []
+    coleccion, indice = col_img, bm25_img_index  # referencias estables durante la consulta
     
-    if col_img:
+    if coleccion and model_imagen is not None:
         try:
-            vec_img = model_imagen.encode(query_busqueda).tolist()
-            res = col_img.query(query_embeddings=[vec_img], n_results=10)
+            with medir("image_vector"):
+                vec_img = await codificar_consulta(model_imagen, settings.MODEL_IMAGE, query_busqueda)
+                res = await run_blocking(coleccion.query, query_embeddings=[vec_img], n_results=10)
             logger.info(f"   [VECTOR IMG] Encontrados {len(res['documents'][0])} candidatos")
             for i, doc in enumerate(res['documents'][0]):
                 meta = res['metadatas'][0][i]
-                list_vec_img.append({"doc": doc, "meta": meta})
+                list_vec_img.append({"id": res['ids'][0][i], "doc": doc, "meta": meta})
                 debug_info["step1_img_vec"].append(meta.get('source'))
-        except Exception as e: logger.error(f"[ERROR] Vector Img: {e}")
+        except Exception as e:
+            registrar_error("image_vector")
+            logger.error(f"[ERROR] Vector Img: {e}")
     
-    if bm25_img_index:
+    if indice:
         try:
-            top = bm25_img_index.get_top_n(query_busqueda.lower().split(), bm25_img_docs, n=10)
+            with medir("image_bm25"):
+                top = await run_blocking(indice.search, query_busqueda, 10)
             logger.info(f"   [BM25 IMG] Encontrados {len(top)} candidatos")
-            for doc in top:
-                idx = bm25_img_docs.index(doc)
-                meta = bm25_img_metadatas[idx]
-                list_bm25_img.append({"doc": doc, "meta": meta})
+            for doc_id, _ in top:
+                doc, meta = indice.documento(doc_id)
+                list_bm25_img.append({"id": doc_id, "doc": doc, "meta": meta})
                 debug_info["step1_img_bm25"].append(meta.get('source'))
-        except Exception as e: logger.error(f"[ERROR] BM25 Img: {e}")
+        except Exception as e:
+            registrar_error("image_bm25")
+            logger.error(f"[ERROR] BM25 Img: {e}")
 
-    cands_img = reciprocal_rank_fusion([list_vec_img, list_bm25_img])[:10]
+    # Las imágenes no se deduplican por texto: figuras distintas pueden tener
+    # descripciones casi iguales; RRF ya las fusiona por id.
+    with medir("image_rrf"):
+        cands_img = reciprocal_rank_fusion([list_vec_img, list_bm25_img])[:10]
     final_img = []
     
-    if cands_img:
+    if cands_img and reranker_service is None:
+        # Sin Cross-Encoder no hay umbral de certeza: no se muestran imágenes
+        logs.append("Reranker cargando: se omiten las imágenes.")
+    elif cands_img:
         logger.info(f"[RERANK IMG] Evaluando {len(cands_img)} imagenes...")
-        yield log_msg(f"Evaluando {len(cands_img)} imagenes candidatas...")
+        logs.append(f"Evaluando {len(cands_img)} imagenes candidatas...")
         
-        scores = model_reranker.predict([[query, x['doc']] for x in cands_img])
-        ranked = []
+        with medir("image_rerank"):
+            scores = await reranker_service.puntuar([[query, x['doc']] for x in cands_img], [x['id'] for x in cands_img])
         for c, s in zip(cands_img, scores):
-            logit = float(s)
-            score_pct = calcular_certeza(logit)
-            
-            logger.info(f"   >> IMG: {c['meta'].get('source')} | Score: {score_pct}%")
-            
-            if score_pct > 0.0:
-                ranked.append({"doc": c['doc'], "meta": c['meta'], "score": score_pct})
-        
-        final_img = sorted(ranked, key=lambda x: x['score'], reverse=True)[:3]
+            logger.info(f"   >> IMG: {c['meta'].get('source')} | Score: {calcular_certeza(float(s))}%")
+        final_img = seleccionar_imagenes(cands_img, scores)
         debug_info["step2_img_final"] = [f"[{x['score']}%] {x['meta'].get('source')}" for x in final_img]
         
         if final_img:
-            yield log_msg(f"Recuperadas {len(final_img)} imagenes (filtrado en Front).")
+            logs.append(f"Recuperadas {len(final_img)} imagenes (filtrado en Front).")
         else:
-            yield log_msg("Ninguna imagen tiene sentido semantico minimo.")
+            logs.append("Ninguna imagen tiene sentido semantico minimo.")
 
-    context_list, ragas_ctx, imgs_out, fuentes = [], [], [], []
-    
-    for x in final_text:
-        context_list.append(f"[TEXTO - {x['meta'].get('asignatura')}]: {x['doc']}")
-        ragas_ctx.append(x['doc'])
-        fuentes.append(f"{x['meta'].get('source')}")
-        
-    for x in final_img:
-        context_list.append(f"[IMAGEN - {x['meta'].get('source')}]: {x['doc']}")
-        ragas_ctx.append(f"Img: {x['doc']}")
-        imgs_out.append({"path": x['meta'].get('path'), "filename": x['meta'].get('source'), "score": x['score']})
+    return final_img
 
-    yield json.dumps({
-        "type": "metadata", 
-        "fuentes_texto": list(set(fuentes)), 
-        "imagenes": imgs_out, 
-        "debug_info": debug_info, 
-        "contexto_ragas": ragas_ctx
-    }) + "\n"
+ETIQUETA_RAMA = {"TEXTO": "text", "IMAGEN": "image"}
 
-    yield log_msg("Generando respuesta con IA...")
-    
-    prompt_txt = "\n".join(context_list) or "Sin información relevante en la base de datos."
-    
-    inst_visual = (
-        "3. Tienes acceso a imágenes marcadas como [IMAGEN]. Úsalas activamente para explicar puntos visuales."
-        if imgs_out else 
-        "3. No hay imágenes disponibles para esta consulta. Ignora referencias visuales del texto."
+async def esperar_rama(tarea: asyncio.Task, nombre: str, logs: List[str]) -> List[Dict]:
+    """
+    Espera el resultado de una rama de recuperación.
+    Si agota su timeout o falla, la consulta continúa sin sus resultados.
+    """
+    try:
+        return await tarea
+    except asyncio.TimeoutError:
+        registrar_error(f"{ETIQUETA_RAMA[nombre]}_timeout")
+        logger.warning(f"[TIMEOUT] Rama {nombre} cancelada por tiempo excedido")
+        logs.append(f"Búsqueda de {nombre.lower()} cancelada por tiempo excedido.")
+    except Exception as e:
+        registrar_error(f"{ETIQUETA_RAMA[nombre]}_branch")
+        logger.error(f"[ERROR] Rama {nombre}: {e}")
+    return []
+
+def lanzar_recuperacion(query_busqueda: str, query: str) -> Dict[str, Any]:
+    """
+    Lanza las dos ramas de recuperación en paralelo, cada una con su timeout.
+    Cada lanzamiento tiene su propio debug y logs, de modo que una búsqueda
+    especulativa descartada no contamina la definitiva.
+    """
+    ctx = {
+        "query": query_busqueda, "logs_text": [], "logs_img": [],
+        "debug": {
+            "step1_text_vec": [], "step1_text_bm25": [], "step2_text_final": [],
+            "step1_img_vec": [], "step1_img_bm25": [], "step2_img_final": []
+        },
+    }
+    ctx["text"] = asyncio.create_task(asyncio.wait_for(
+        recuperar_texto(query_busqueda, query, ctx["debug"], ctx["logs_text"]), timeout=settings.TIMEOUT_RAMA_TEXTO
+    ))
+    ctx["img"] = asyncio.create_task(asyncio.wait_for(
+        recuperar_imagenes(query_busqueda, query, ctx["debug"], ctx["logs_img"]), timeout=settings.TIMEOUT_RAMA_IMAGEN
+    ))
+    return ctx
+
+def cancelar_recuperacion(ctx: Optional[Dict[str, Any]]):
+    if ctx:
+        for tarea in (ctx["text"], ctx["img"]): tarea.cancel()
+
+# ==============================================================================
+# RECUPERACIÓN POR LOTES (/ask_batch)
+# ==============================================================================
+
+def _candidatos_chroma(res: Dict, fila: int) -> List[Dict]:
+    return [
+        {"id": doc_id, "doc": doc, "meta": meta}
+        for doc_id, doc, meta in zip(res['ids'][fila], res['documents'][fila], res['metadatas'][fila])
+    ]
+
+def _candidatos_bm25(indice: SparseBM25Index, top: List) -> List[Dict]:
+    candidatos = []
+    for doc_id, _ in top:
+        doc, meta = indice.documento(doc_id)
+        candidatos.append({"id": doc_id, "doc": doc, "meta": meta})
+    return candidatos
+
+async def _buscar_lote(coleccion, indice, modelo, nombre_modelo: str, consultas: List[str],
+                       etiqueta: str, dim: int = 0) -> List[List[List[Dict]]]:
+    """
+    Búsqueda vectorial (un solo encode y una sola query con todas las consultas)
+    y BM25 (un solo producto disperso) de una colección.
+    Devuelve, por consulta, las listas [vectorial, bm25] para la fusión RRF.
+    """
+    listas = [[[], []] for _ in consultas]
+    if coleccion and modelo is not None:
+        try:
+            with medir(f"{etiqueta}_batch_vector"):
+                vecs = await codificar_lote(modelo, nombre_modelo, consultas, dim)
+                res = await run_blocking(coleccion.query, query_embeddings=vecs, n_results=10)
+            for fila in range(len(consultas)):
+                listas[fila][0] = _candidatos_chroma(res, fila)
+        except Exception as e:
+            registrar_error(f"{etiqueta}_batch_vector")
+            logger.error(f"[ERROR] Vector lote ({etiqueta}): {e}")
+    if indice:
+        try:
+            with medir(f"{etiqueta}_batch_bm25"):
+                tops = await run_blocking(indice.search_batch, consultas, 10)
+            for fila, top in enumerate(tops):
+                listas[fila][1] = _candidatos_bm25(indice, top)
+        except Exception as e:
+            registrar_error(f"{etiqueta}_batch_bm25")
+            logger.error(f"[ERROR] BM25 lote ({etiqueta}): {e}")
+    return listas
+
+async def recuperar_lote(consultas: List[str]) -> List[Tuple[List[Dict], List[Dict]]]:
+    """
+    Recuperación híbrida de varias consultas a la vez (sin reescritura ni timeouts
+    por rama): ambas colecciones se consultan en paralelo y todos los pares
+    (consulta, pasaje) de texto e imagen se puntúan en un único lote del reranker.
+    Devuelve (final_text, final_img) por consulta, igual que las ramas de /ask.
+    """
+    coleccion_t, coleccion_i = col_text, col_img  # referencias estables durante el lote
+    listas_t, listas_i = await asyncio.gather(
+        _buscar_lote(coleccion_t, bm25_text_index, model_texto, settings.MODEL_TEXT, consultas, "text", dimension_texto(coleccion_t)),
+        _buscar_lote(coleccion_i, bm25_img_index, model_imagen, settings.MODEL_IMAGE, consultas, "image"),
     )
 
-# --- DEFINICIÓN DE ROLES AJUSTADA (BLINDADA CONTRA ALUCINACIONES) ---
+    with medir("batch_rrf"):
+        cands_t = [deduplicar_candidatos(reciprocal_rank_fusion(l), settings.DEDUP_THRESHOLD)[:15] for l in listas_t]
+        cands_i = [reciprocal_rank_fusion(l)[:10] for l in listas_i]  # imágenes: sin dedup por texto
+
+    if reranker_service is None:
+        # Modo degradado: orden RRF para el texto y sin imágenes (no hay certeza)
+        return [(orden_rrf(ct), []) for ct in cands_t]
+
+    pares, ids = [], []
+    for q, ct, ci in zip(consultas, cands_t, cands_i):
+        pares += [[q, c['doc']] for c in ct + ci]
+        ids += [c['id'] for c in ct + ci]
+    logger.info(f"[RERANK LOTE] Evaluando {len(pares)} pares de {len(consultas)} consultas...")
+    with medir("batch_rerank"):
+        scores = await reranker_service.puntuar(pares, ids)
+
+    resultados, inicio = [], 0
+    for ct, ci in zip(cands_t, cands_i):
+        s_t = scores[inicio:inicio + len(ct)]
+        s_i = scores[inicio + len(ct):inicio + len(ct) + len(ci)]
+        inicio += len(ct) + len(ci)
+        resultados.append((seleccionar_texto(ct, s_t), seleccionar_imagenes(ci, s_i)))
+    return resultados
+
+# ==============================================================================
+# PROMPT DEL SISTEMA (ROLES + CONTEXTO)
+# ==============================================================================
+
+def construir_prompt(query: str, history: List[Message], persona: str,
+                     final_text: List[Dict], final_img: List[Dict]) -> Tuple[PromptEnsamblado, Dict[str, Any]]:
+    """
+    Construye los mensajes para el LLM con el rol de la persona y el contexto
+    recuperado, dentro del presupuesto de tokens (PROMPT_MAX_TOKENS).
+    Devuelve el prompt ensamblado y su resumen para el evento de metadatos.
+    """
+    # --- DEFINICIÓN DE ROLES AJUSTADA (BLINDADA CONTRA ALUCINACIONES) ---
     if persona.lower() == "LEXIA":
         nombre_ia = "LexIA"
         rol_definition = """
@@ -390,7 +1010,23 @@ async def generate_rag_stream(query: str, history: List[Message], persona: str =
         """
         error_response = "[ERROR 404: DATA_UNAVAILABLE] >> La consulta solicitada no tiene coincidencia en los vectores de la base de conocimiento local."
 
-    sys_prompt = f"""
+    # Prioriza por certeza del reranker y recorta primero los turnos antiguos
+    # y el contexto de menor valor. Sin reranker (modo degradado, orden RRF) no
+    # hay certeza: la prioridad es la posición, por debajo de cualquier certeza.
+    def prioridad(x: Dict, posicion: int) -> float:
+        return x['certeza'] if x.get('certeza') is not None else -float(posicion)
+
+    fragmentos = [
+        FragmentoContexto(f"[TEXTO - {x['meta'].get('asignatura')}]: {x['doc']}", prioridad(x, i),
+                          {"tipo": "texto", "doc": x['doc'], "fuente": x['meta'].get('source')})
+        for i, x in enumerate(final_text)
+    ] + [
+        FragmentoContexto(f"[IMAGEN - {x['meta'].get('source')}]: {x['doc']}", prioridad(x, i),
+                          {"tipo": "imagen", "doc": x['doc']})
+        for i, x in enumerate(final_img)
+    ]
+
+    plantilla = compactar_prompt(f"""
     <system_core>
     {rol_definition}
     </system_core>
@@ -413,56 +1049,464 @@ async def generate_rag_stream(query: str, history: List[Message], persona: str =
     <instructions>
     1. Analiza el <context_data> buscando palabras clave de la pregunta.
     2. Si encuentras la info, sintetízala según tu personalidad ({nombre_ia}).
-    {inst_visual}
+    {MARCA_INST_VISUAL}
     4. Cita las fuentes de manera implícita (ej: "Según el diagrama de arquitectura...").
     </instructions>
 
     <context_data>
-    {prompt_txt}
+    {MARCA_CONTEXTO}
     </context_data>
+    """)
+
+    def plantilla_sistema(incluidos: List[FragmentoContexto]) -> str:
+        inst_visual = (
+            "3. Tienes acceso a imágenes marcadas como [IMAGEN]. Úsalas activamente para explicar puntos visuales."
+            if any(f.origen["tipo"] == "imagen" for f in incluidos) else 
+            "3. No hay imágenes disponibles para esta consulta. Ignora referencias visuales del texto."
+        )
+        prompt_txt = "\n".join(f.texto for f in incluidos) or "Sin información relevante en la base de datos."
+        return plantilla.replace(MARCA_INST_VISUAL, inst_visual).replace(MARCA_CONTEXTO, prompt_txt)
+
+    contador = contador_tokens or ContadorTokens()
+    ensamblado = ensamblar_prompt(
+        plantilla_sistema, fragmentos, [{"role": m.role, "content": m.content} for m in history], query,
+        contador, settings.PROMPT_MAX_TOKENS, settings.PROMPT_HISTORY_KEEP
+    )
+    logger.info(
+        f"[PROMPT] {ensamblado.tokens}/{settings.PROMPT_MAX_TOKENS} tokens | "
+        f"contexto {len(ensamblado.incluidos)}/{len(fragmentos)} | turnos descartados {ensamblado.turnos_descartados}"
+    )
+    return ensamblado, ensamblado.resumen(contador.nombre)
+
+# ==============================================================================
+# GENERADOR RAG (STREAMING LOGIC)
+# ==============================================================================
+
+async def vigilar_desconexion(request: Request, tarea: asyncio.Task, cancelado: asyncio.Event):
+    """
+    Comprueba periódicamente si el cliente sigue conectado; si se ha ido,
+    marca la consulta como cancelada y cancela la tarea que ejecuta el pipeline.
+    """
+    while not tarea.done():
+        if await request.is_disconnected():
+            cancelado.set()
+            tarea.cancel()
+            return
+        await asyncio.sleep(settings.DISCONNECT_POLL_SECONDS)
+
+async def detener_tarea(tarea: asyncio.Task, intentos: int = 5):
+    """
+    Cancela la tarea y espera a que termine. La cancelación se repite si la tarea
+    la ignora (el cliente HTTP del LLM puede absorberla durante create()).
+    """
+    for _ in range(intentos):
+        if tarea.done():
+            break
+        tarea.cancel()
+        await asyncio.wait({tarea}, timeout=settings.DISCONNECT_POLL_SECONDS)
+    if not tarea.done():
+        logger.warning("[CANCELADO] El pipeline no ha atendido la cancelación")
+    elif not tarea.cancelled() and tarea.exception():
+        logger.warning(f"[CANCELADO] Error al detener el pipeline: {tarea.exception()}")
+
+# Limpiezas en curso (referencia fuerte para que no las recoja el GC)
+_limpiezas: set = set()
+
+async def liberar_recursos(recursos: Dict[str, Any]):
+    """
+    Cancela las búsquedas pendientes y cierra el stream del LLM de una consulta.
+    """
+    for ctx in recursos["recuperaciones"]:
+        cancelar_recuperacion(ctx)
+    if recursos.get("stream") is not None:
+        try:
+            await recursos["stream"].close()
+        except Exception as e:
+            logger.warning(f"[LLM] Error cerrando el stream: {e}")
+
+async def generate_rag_stream(query: str, history: List[Message], persona: str = "chico", request: Optional[Request] = None):
+    """
+    Ejecuta el pipeline RAG en una tarea propia y reenvía sus líneas NDJSON.
+    Si el cliente se desconecta (pestaña cerrada, timeout), se cancelan la
+    recuperación pendiente y el stream del LLM, y se contabiliza la cancelación.
+    Si el pipeline falla, el cliente recibe una línea {"type": "error"}.
+    """
+    cola: asyncio.Queue = asyncio.Queue(maxsize=64)
+    cancelado = asyncio.Event()
+    recursos = {"recuperaciones": [], "stream": None, "cancelado": cancelado}
+
+    async def productor():
+        pipeline = pipeline_rag(query, history, persona, recursos)
+        try:
+            async for linea in pipeline:
+                if cancelado.is_set():
+                    break
+                await cola.put(linea)
+        finally:
+            await pipeline.aclose()
+            await liberar_recursos(recursos)
+
+    EN_CURSO.inc()
+    tarea = asyncio.create_task(productor())
+    vigilante = asyncio.create_task(vigilar_desconexion(request, tarea, cancelado)) if request is not None else None
+    cancelada = False
+    lectura = None
+    try:
+        while True:
+            lectura = asyncio.ensure_future(cola.get())
+            await asyncio.wait({lectura, tarea}, return_when=asyncio.FIRST_COMPLETED)
+            if lectura.done():
+                yield lectura.result()
+                continue
+            lectura.cancel()
+            while not cola.empty():
+                yield cola.get_nowait()
+            break
+        if tarea.cancelled() or cancelado.is_set():
+            # Solo el vigilante cancela la tarea: ha detectado la desconexión del cliente
+            cancelada = True
+        elif tarea.exception():
+            registrar_error("pipeline")
+            logger.error(f"[ERROR] Pipeline RAG: {tarea.exception()}")
+            yield json.dumps({"type": "error", "message": f"Error técnico: {tarea.exception()}"}) + "\n"
+    except (GeneratorExit, asyncio.CancelledError):
+        # El servidor cierra la respuesta porque el cliente se ha ido
+        cancelada = True
+        raise
+    finally:
+        EN_CURSO.dec()
+        cancelado.set()
+        if lectura is not None: lectura.cancel()
+        if vigilante: vigilante.cancel()
+        if cancelada:
+            metricas["cancelaciones"] += 1
+            logger.warning(f"[CANCELADO] Cliente desconectado: consulta '{query}' abortada")
+        # La espera se hace en una tarea propia: si esta respuesta ya está cancelada,
+        # la limpieza continúa en segundo plano hasta que el pipeline termine
+        limpieza = asyncio.create_task(detener_tarea(tarea))
+        _limpiezas.add(limpieza)
+        limpieza.add_done_callback(_limpiezas.discard)
+        try:
+            await asyncio.shield(limpieza)
+        except asyncio.CancelledError:
+            pass
+
+async def pipeline_rag(query: str, history: List[Message], persona: str, recursos: Dict[str, Any]):
+    """
+    Núcleo del sistema RAG. Ejecuta recuperación y generación.
+    Las tareas y el stream abiertos se registran en `recursos` para poder liberarlos.
     """
+    def log_msg(msg: str):
+        return json.dumps({"type": "log", "message": msg}) + "\n"
+
+    inicio = time.perf_counter()
+    logger.info("="*50)
+    logger.info(f"[NUEVA CONSULTA] RECIBIDA: '{query}'")
+    yield log_msg(f"Analizando consulta: '{query}'")
+
+    modo = modo_servicio() or "degradado"
+    if modo == "degradado":
+        logger.warning("[DEGRADADO] Consulta atendida con componentes aún cargando")
+        yield log_msg("Modo degradado: algunos modelos siguen cargando, la búsqueda será parcial.")
+
+    # 0. Caché semántica (solo preguntas sin historial): reutiliza el embedding de Qwen
+    vec_semantico, version = None, None
+    if cache_semantica is not None and not history and model_texto is not None:
+        try:
+            vec_semantico = await codificar_consulta(model_texto, settings.MODEL_TEXT, query, dimension_texto(col_text))
+            version = version_colecciones()
+            acierto = cache_semantica.buscar(persona.lower(), vec_semantico, version)
+        except Exception as e:
+            logger.error(f"[ERROR] Caché semántica: {e}")
+            registrar_error("semantic_cache")
+            acierto = None
+        if acierto:
+            payload, similitud = acierto
+            logger.info(f"[CACHE SEMANTICA] HIT ({similitud:.3f}) con '{payload['pregunta']}'")
+            yield log_msg(f"Respuesta recuperada de caché (pregunta similar: '{payload['pregunta']}')")
+            yield payload["metadata"]
+            TTFT.labels("cache").observe(time.perf_counter() - inicio)
+            for delta in payload["deltas"]:
+                yield json.dumps({"type": "content", "delta": delta}) + "\n"
+            DURACION_STREAM.labels("cache").observe(time.perf_counter() - inicio)
+            return
+
+    # 1. Reescribir (se omite sin historial y se cachea por historial + consulta)
+    especulativa = None
+    query_busqueda = reescritura_sin_llm(query, history)
+    
+    if query_busqueda is None:
+        if settings.REWRITE_SPECULATIVE:
+            # Búsqueda especulativa con la consulta original mientras el LLM reescribe
+            especulativa = lanzar_recuperacion(query, query)
+            recursos["recuperaciones"].append(especulativa)
+        with medir("rewrite"):
+            query_busqueda = await reescribir_consulta_contextual(query, history)
+    logger.info(f"[REWRITE] '{query}' >> '{query_busqueda}'")
+    
+    if query_busqueda != query:
+        yield log_msg(f"Reformulado: '{query_busqueda}'")
     
-    msgs = [{"role": "system", "content": sys_prompt}]
-    for m in history: msgs.append({"role": m.role, "content": m.content})
-    msgs.append({"role": "user", "content": query})
+    # 2. Recuperación en paralelo (Texto + Imagen), cada rama con su timeout
+    yield log_msg("Buscando en documentos PDF...")
+    yield log_msg("Buscando en diapositivas e imagenes...")
+    
+    if especulativa and consultas_equivalentes(query, query_busqueda):
+        logger.info("[REWRITE] Reescritura equivalente: se reutiliza la búsqueda especulativa")
+        recuperacion = especulativa
+    else:
+        cancelar_recuperacion(especulativa)
+        recuperacion = lanzar_recuperacion(query_busqueda, query)
+        recursos["recuperaciones"].append(recuperacion)
+    
+    # 3. Unión de resultados (los logs se emiten en orden: texto y después imagen)
+    final_text = await esperar_rama(recuperacion["text"], "TEXTO", recuperacion["logs_text"])
+    for m in recuperacion["logs_text"]: yield log_msg(m)
+    
+    final_img = await esperar_rama(recuperacion["img"], "IMAGEN", recuperacion["logs_img"])
+    for m in recuperacion["logs_img"]: yield log_msg(m)
+    
+    debug_info = {"query_rewritten": f"{query} >> {query_busqueda}", "modo": modo, **recuperacion["debug"]}
+
+    # 4. Prompt con presupuesto de tokens
+    ensamblado, info_prompt = construir_prompt(query, history, persona, final_text, final_img)
+
+    ragas_ctx = [f.origen["doc"] if f.origen["tipo"] == "texto" else f"Img: {f.origen['doc']}" for f in ensamblado.incluidos]
+    fuentes = [f"{f.origen['fuente']}" for f in ensamblado.incluidos if f.origen["tipo"] == "texto"]
+    imgs_out = [{"path": x['meta'].get('path'), "filename": x['meta'].get('source'), "score": x['score']} for x in final_img]
+
+    evento_metadata = json.dumps({
+        "type": "metadata", 
+        "fuentes_texto": list(set(fuentes)), 
+        "imagenes": imgs_out, 
+        "debug_info": debug_info, 
+        "contexto_ragas": ragas_ctx,
+        "prompt": info_prompt
+    }) + "\n"
+    yield evento_metadata
+
+    yield log_msg("Generando respuesta con IA...")
+    msgs = ensamblado.mensajes
+
+    cancelado = recursos["cancelado"]
+    if cancelado.is_set():
+        return
 
     logger.info(f"[LLM] Enviando prompt ({MODEL_LLM_NAME})...")
 
     try:
-        stream = client_llm.chat.completions.create(model=MODEL_LLM_NAME, messages=msgs, stream=True)
+        stream = await client_llm.chat.completions.create(model=MODEL_LLM_NAME, messages=msgs, stream=True)
+        recursos["stream"] = stream
         chunk_count = 0
-        for chunk in stream:
+        deltas = []
+        # Streaming asíncrono: cada delta se reenvía en cuanto llega, sin ocupar un hilo.
+        # La cancelación se comprueba en cada chunk: Task.cancel() no basta si la absorbe el cliente HTTP
+        async for chunk in stream:
+            if cancelado.is_set():
+                await stream.close()
+                logger.info(f"[LLM] Stream cerrado por cancelación ({chunk_count} chunks recibidos).")
+                return
             chunk_count += 1
             if chunk.choices and chunk.choices[0].delta.content:
                 c = chunk.choices[0].delta.content
+                if not deltas:
+                    TTFT.labels("llm").observe(time.perf_counter() - inicio)
+                deltas.append(c)
                 yield json.dumps({"type": "content", "delta": c}) + "\n"
         
+        DURACION_STREAM.labels("llm").observe(time.perf_counter() - inicio)
         logger.info(f"[EXITO] Respuesta generada ({chunk_count} chunks enviados).")
 
+        # Solo se cachean respuestas completas: ni las de modo degradado (contexto
+        # parcial) ni las de consultas canceladas (el cliente no llegó a recibirlas)
+        if vec_semantico is not None and deltas and modo == "completo" and not cancelado.is_set():
+            cache_semantica.guardar(persona.lower(), vec_semantico, {
+                "pregunta": query, "metadata": evento_metadata, "deltas": deltas
+            }, version)
+
     except Exception as e:
         error_msg = str(e)
         
         if "429" in error_msg:
+            LIMITE_CUOTA.inc()
             logger.warning("[AVISO] Límite de cuota Groq excedido (429).")
             mensaje_amigable = "⏳ **Límite de servicio alcanzado:** El modelo está saturado temporalmente. Por favor, espera 30 minutos antes de volver a preguntar."
             yield json.dumps({"type": "error", "message": mensaje_amigable}) + "\n"
         else:
+            registrar_error("llm")
             logger.error(f"[ERROR LLM] {error_msg}")
             yield json.dumps({"type": "error", "message": f"Error técnico: {error_msg}"}) + "\n"
 
+async def generar_respuesta(mensajes: List[Dict], semaforo: asyncio.Semaphore) -> Dict[str, Any]:
+    """
+    Generación sin streaming para /ask_batch, limitada por `semaforo`
+    (BATCH_LLM_CONCURRENCY) para no saturar la cuota del proveedor.
+    """
+    async with semaforo:
+        try:
+            resp = await client_llm.chat.completions.create(model=MODEL_LLM_NAME, messages=mensajes)
+            return {"respuesta": resp.choices[0].message.content or ""}
+        except Exception as e:
+            if "429" in str(e):
+                LIMITE_CUOTA.inc()
+            else:
+                registrar_error("llm")
+            logger.error(f"[ERROR LLM] Lote: {e}")
+            return {"respuesta": None, "error": str(e)}
+
+# ==============================================================================
+# MÉTRICAS (PROMETHEUS)
+# ==============================================================================
+
+def estado_metricas() -> Dict[str, Any]:
+    """
+    Estado interno que el colector de Prometheus lee en cada scrape.
+    """
+    caches = {"rewrite": (cache_reescrituras.hits, cache_reescrituras.misses)}
+    if embedding_cache is not None:
+        e = embedding_cache.stats()
+        caches["embedding"] = (e["hits_memoria"] + e["hits_disco"], e["misses"])
+    if cache_semantica is not None:
+        caches["semantic"] = (cache_semantica.hits, cache_semantica.misses)
+    if reranker_service is not None and reranker_service.cache is not None:
+        caches["rerank"] = (reranker_service.cache.hits, reranker_service.cache.misses)
+    return {
+        "caches": caches,
+        "indices": {
+            "bm25_text": len(bm25_text_index) if bm25_text_index is not None else 0,
+            "bm25_image": len(bm25_img_index) if bm25_img_index is not None else 0,
+        },
+        "cancelaciones": metricas["cancelaciones"],
+    }
+
+registrar_colector(estado_metricas)
+
 # ==============================================================================
 # ENDPOINTS API
 # ==============================================================================
 
 @app.post("/ask")
-async def ask_question(request: QueryRequest):
+async def ask_question(request: QueryRequest, http_request: Request):
     """
     Endpoint principal para consultas.
     """
-    if not model_reranker: 
+    if modo_servicio() is None: 
         raise HTTPException(status_code=503, detail="Cargando modelos, por favor espere...")
         
     return StreamingResponse(
-        generate_rag_stream(request.pregunta, request.history, request.persona), 
+        generate_rag_stream(request.pregunta, request.history, request.persona, http_request), 
         media_type="application/x-ndjson"
-    )
\ No newline at end of file
+    )
+
+@app.post("/ask_batch")
+async def ask_batch(request: BatchRequest):
+    """
+    Consultas por lotes (evaluación del Golden Set): codificación, búsqueda en
+    ChromaDB / BM25 y reranking de todas las preguntas en un solo lote.
+    Devuelve los candidatos de cada pregunta y, si `generar`, su respuesta.
+    """
+    if modo_servicio() is None:
+        raise HTTPException(status_code=503, detail="Cargando modelos, por favor espere...")
+    if len(request.preguntas) > settings.BATCH_MAX_QUERIES:
+        raise HTTPException(status_code=413, detail=f"Máximo {settings.BATCH_MAX_QUERIES} preguntas por lote")
+
+    t0 = time.perf_counter()
+    recuperados = await recuperar_lote(request.preguntas) if request.preguntas else []
+    t_recuperacion = time.perf_counter() - t0
+
+    resultados, mensajes = [], []
+    for q, (final_text, final_img) in zip(request.preguntas, recuperados):
+        ensamblado, info_prompt = construir_prompt(q, [], request.persona, final_text, final_img)
+        mensajes.append(ensamblado.mensajes)
+        resultados.append({
+            "pregunta": q,
+            "texto": [{"source": x['meta'].get('source'), "asignatura": x['meta'].get('asignatura'), "score": x['score'], "certeza": x['certeza'], "doc": x['doc']} for x in final_text],
+            "imagenes": [{"path": x['meta'].get('path'), "filename": x['meta'].get('source'), "score": x['score']} for x in final_img],
+            "fuentes_texto": list({f.origen["fuente"] for f in ensamblado.incluidos if f.origen["tipo"] == "texto"}),
+            "contexto_ragas": [f.origen["doc"] if f.origen["tipo"] == "texto" else f"Img: {f.origen['doc']}" for f in ensamblado.incluidos],
+            "prompt": info_prompt,
+        })
+
+    t_generacion = 0.0
+    if request.generar and resultados:
+        t1 = time.perf_counter()
+        semaforo = asyncio.Semaphore(max(1, settings.BATCH_LLM_CONCURRENCY))
+        respuestas = await asyncio.gather(*(generar_respuesta(m, semaforo) for m in mensajes))
+        for r, resp in zip(resultados, respuestas):
+            r.update(resp)
+        t_generacion = time.perf_counter() - t1
+
+    logger.info(
+        f"[LOTE] {len(resultados)} preguntas | recuperación {t_recuperacion:.2f}s | generación {t_generacion:.2f}s"
+    )
+    return {
+        "modo": modo_servicio(),
+        "resultados": resultados,
+        "tiempos": {"recuperacion_s": round(t_recuperacion, 3), "generacion_s": round(t_generacion, 3)},
+    }
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """
+    Métricas en formato Prometheus (latencias por etapa, cachés, errores e índices).
+    """
+    cuerpo, tipo = exportar()
+    return Response(content=cuerpo, media_type=tipo)
+
+@app.get("/health/live")
+async def health_live():
+    """
+    Liveness: el proceso responde (no depende de la carga de modelos).
+    """
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def health_ready():
+    """
+    Readiness: 200 si se pueden atender consultas (modo completo o degradado),
+    503 mientras se cargan los componentes. Incluye el estado de cada uno.
+    """
+    modo = modo_servicio()
+    cuerpo = {"status": modo or "cargando", "degraded_mode": settings.DEGRADED_MODE, "componentes": componentes.snapshot()}
+    return JSONResponse(cuerpo, status_code=200 if modo else 503)
+
+def comprobar_token_admin(token: Optional[str]):
+    """
+    Los endpoints /admin exigen X-Admin-Token; sin ADMIN_TOKEN configurado quedan desactivados.
+    """
+    if not settings.ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Endpoints de administración desactivados (ADMIN_TOKEN vacío)")
+    if not token or not hmac.compare_digest(token.encode("utf-8"), settings.ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="Token de administración no válido")
+
+@app.post("/admin/reindex")
+async def admin_reindex(x_admin_token: Optional[str] = Header(default=None)):
+    """
+    Aplica en caliente los cambios de ChromaDB (tras una ingesta) a los índices BM25,
+    sin reiniciar la API ni recargar los modelos.
+    """
+    comprobar_token_admin(x_admin_token)
+    if componentes.estado("chroma") in (PENDIENTE, CARGANDO):
+        raise HTTPException(status_code=503, detail="Cargando índices, por favor espere...")
+
+    return {"status": "ok", "colecciones": await refrescar_indices()}
+
+@app.get("/admin/stats")
+async def admin_stats(x_admin_token: Optional[str] = Header(default=None)):
+    """
+    Estadísticas internas: cachés, micro-batching del reranker e índices.
+    """
+    comprobar_token_admin(x_admin_token)
+
+    return {
+        "embedding_cache": embedding_cache.stats() if embedding_cache else None,
+        "rewrite_cache": cache_reescrituras.stats(),
+        "cancelaciones": metricas["cancelaciones"],
+        "semantic_cache": cache_semantica.stats() if cache_semantica else None,
+        "reranker": reranker_service.stats_completas() if reranker_service else None,
+        "backends": backends_inferencia,
+        "bm25_docs": {
+            "text_knowledge": len(bm25_text_index) if bm25_text_index is not None else 0,
+            "multimodal_knowledge": len(bm25_img_index) if bm25_img_index is not None else 0,
+        },
+    }
\ No newline at end of file
@@ -0,0 +1,390 @@
+"""
+================================================================================
+ÍNDICE BM25 DISPERSO (CSR)
+================================================================================
+   Motor de búsqueda léxica (Sparse Retrieval) indexado por id de ChromaDB.
+   Sustituye a rank_bm25, que puntuaba todo el corpus en Python puro y obligaba
+   a recuperar los metadatos con list.index() (O(N) por resultado y erróneo
+   cuando dos chunks tienen el mismo texto).
+
+FUNCIONAMIENTO:
+    1. Tokenización: minúsculas + split por espacios (igual que antes).
+    2. Matriz de frecuencias (documento x término) en formato CSR.
+    3. Compilación: pesos BM25 precalculados en una matriz término x documento.
+    4. Consulta: un único producto disperso (query x pesos), cuyo coste depende
+       de los postings de los términos de la consulta, y top-k con argpartition.
+
+PERSISTENCIA:
+    El índice se guarda junto a la base de datos (ficheros .npy cargados con
+    mmap + un JSON con ids, textos, metadatos y vocabulario). Cada índice lleva
+    la huella de su colección (nº de registros + hash de ids y contenidos) y
+    solo se reutiliza si la huella coincide; si no, se reconstruye.
+    Cada guardado escribe una versión nueva en su propio subdirectorio y después
+    sustituye de forma atómica la cabecera (index.json) que apunta a ella: nunca
+    se sobrescriben ficheros que el índice en uso pueda tener mapeados (en Windows
+    eso falla). Las versiones antiguas se borran cuando ya no están mapeadas.
+
+ACTUALIZACIÓN INCREMENTAL:
+    diff_coleccion() detecta ids nuevos, modificados y borrados respecto al
+    índice en memoria y aplicar_cambios() genera un índice NUEVO tokenizando
+    solo esos documentos. En el modo rápido solo se descargan los ids (y los
+    documentos de los ids nuevos); la comparación completa de contenidos se
+    reserva para cuando una ingesta ha podido modificar registros existentes. El índice original no se modifica, de modo que la API
+    puede seguir sirviendo consultas con él y sustituirlo de forma atómica.
+
+NOTA:
+    El IDF usa la variante log(1 + (N - df + 0.5) / (df + 0.5)), siempre positiva,
+    en lugar del IDF con epsilon de BM25Okapi.
+================================================================================
+"""
+
+import os
+import json
+import uuid
+import shutil
+import hashlib
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+
+
+FORMATO_VERSION = 2
+_ARRAYS = ("tf_data", "tf_indices", "tf_indptr", "w_data", "w_indices", "w_indptr")
+
+
+def tokenizar(texto: str) -> List[str]:
+    """
+    Tokenizador del índice (el mismo para documentos y consultas).
+    """
+    return (texto or "").lower().split()
+
+
+class SparseBM25Index:
+    """
+    Índice BM25 inmutable con acceso por id de ChromaDB.
+    """
+
+    def __init__(self, ids: List[str], docs: List[str], metadatas: List[Dict],
+                 vocab: Dict[str, int], tf: sparse.csr_matrix, k1: float = 1.5, b: float = 0.75,
+                 pesos: Optional[sparse.csr_matrix] = None):
+        self.ids = list(ids)
+        self.docs = list(docs)
+        self.metadatas = list(metadatas)
+        self.vocab = vocab
+        self.tf = tf
+        self.k1 = k1
+        self.b = b
+        self._pos = {doc_id: i for i, doc_id in enumerate(self.ids)}
+        self.huella: Optional[str] = None  # huella de la colección de origen (si se conoce)
+        self.marca_ingesta: Optional[str] = None  # última marca de ingesta comparada con la colección
+        self._pesos = pesos if pesos is not None else self._compilar()
+
+    # --------------------------------------------------------------------------
+    # CONSTRUCCIÓN
+    # --------------------------------------------------------------------------
+    @classmethod
+    def build(cls, ids: List[str], docs: List[str], metadatas: Optional[List[Dict]] = None,
+              k1: float = 1.5, b: float = 0.75) -> "SparseBM25Index":
+        """
+        Construye el índice a partir de las listas devueltas por collection.get().
+        """
+        docs = [d or "" for d in docs]
+        metadatas = metadatas or [{} for _ in docs]
+        vocab: Dict[str, int] = {}
+        tf = cls._matriz_frecuencias(docs, vocab)
+        return cls(ids, docs, metadatas, vocab, tf, k1=k1, b=b)
+
+    @staticmethod
+    def _matriz_frecuencias(docs: List[str], vocab: Dict[str, int]) -> sparse.csr_matrix:
+        """
+        Tokeniza los documentos y devuelve su matriz CSR de frecuencias.
+        Los términos nuevos se añaden a `vocab`.
+        """
+        indptr, indices, data = [0], [], []
+        for doc in docs:
+            for term, count in Counter(tokenizar(doc)).items():
+                indices.append(vocab.setdefault(term, len(vocab)))
+                data.append(count)
+            indptr.append(len(indices))
+        return sparse.csr_matrix(
+            (np.asarray(data, dtype=np.float32), np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int64)),
+            shape=(len(docs), len(vocab))
+        )
+
+    def _compilar(self) -> sparse.csr_matrix:
+        """
+        Precalcula los pesos BM25 de cada (término, documento).
+        """
+        n_docs, n_terms = len(self.ids), len(self.vocab)
+        if self.tf.shape[1] < n_terms:
+            self.tf.resize((n_docs, n_terms))
+        if n_docs == 0 or self.tf.nnz == 0:
+            return sparse.csr_matrix((n_terms, n_docs), dtype=np.float32)
+
+        doc_len = np.asarray(self.tf.sum(axis=1), dtype=np.float32).ravel()
+        avgdl = float(doc_len.mean()) or 1.0
+        df = np.bincount(self.tf.indices, minlength=n_terms).astype(np.float32)
+        idf = np.log1p((n_docs - df + 0.5) / (df + 0.5))
+
+        coo = self.tf.tocoo()
+        tf_vals = coo.data
+        norm = self.k1 * (1.0 - self.b + self.b * doc_len[coo.row] / avgdl)
+        pesos = idf[coo.col] * tf_vals * (self.k1 + 1.0) / (tf_vals + norm)
+        return sparse.csr_matrix((pesos.astype(np.float32), (coo.col, coo.row)), shape=(n_terms, n_docs))
+
+    # --------------------------------------------------------------------------
+    # CONSULTA
+    # --------------------------------------------------------------------------
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[str, float]]:
+        """
+        Devuelve hasta k pares (id, score) ordenados por score descendente.
+        Solo se devuelven documentos que contienen algún término de la consulta.
+        """
+        term_ids = [self.vocab[t] for t in tokenizar(query) if t in self.vocab]
+        if not term_ids or not self.ids:
+            return []
+
+        cols, counts = np.unique(np.asarray(term_ids, dtype=np.int32), return_counts=True)
+        q = sparse.csr_matrix(
+            (counts.astype(np.float32), (np.zeros(len(cols), dtype=np.int32), cols)),
+            shape=(1, self._pesos.shape[0])
+        )
+        res = (q @ self._pesos).tocsr()
+        doc_idx, scores = res.indices, res.data
+        if len(scores) == 0:
+            return []
+
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            doc_idx, scores = doc_idx[top], scores[top]
+        orden = np.lexsort((doc_idx, -scores))
+        return [(self.ids[doc_idx[i]], float(scores[i])) for i in orden]
+
+    def search_batch(self, queries: List[str], k: int = 10) -> List[List[Tuple[str, float]]]:
+        """
+        Igual que search() para varias consultas, con un único producto disperso
+        (consultas x términos) @ pesos. Devuelve una lista de resultados por consulta.
+        """
+        if not self.ids:
+            return [[] for _ in queries]
+
+        filas, cols = [], []
+        for fila, query in enumerate(queries):
+            for t in tokenizar(query):
+                if t in self.vocab:
+                    filas.append(fila)
+                    cols.append(self.vocab[t])
+        # Las entradas repetidas (término repetido en la consulta) se suman al construir la matriz
+        q = sparse.csr_matrix(
+            (np.ones(len(cols), dtype=np.float32), (np.asarray(filas, dtype=np.int32), np.asarray(cols, dtype=np.int32))),
+            shape=(len(queries), self._pesos.shape[0])
+        )
+        res = (q @ self._pesos).tocsr()
+
+        resultados = []
+        for fila in range(len(queries)):
+            ini, fin = res.indptr[fila], res.indptr[fila + 1]
+            doc_idx, scores = res.indices[ini:fin], res.data[ini:fin]
+            if len(scores) > k:
+                top = np.argpartition(-scores, k - 1)[:k]
+                doc_idx, scores = doc_idx[top], scores[top]
+            orden = np.lexsort((doc_idx, -scores))
+            resultados.append([(self.ids[doc_idx[i]], float(scores[i])) for i in orden])
+        return resultados
+
+    def documento(self, doc_id: str) -> Tuple[str, Dict]:
+        """
+        Devuelve (texto, metadatos) de un id indexado.
+        """
+        i = self._pos[doc_id]
+        return self.docs[i], self.metadatas[i]
+
+    def aplicar_cambios(self, upserts: List[Tuple[str, str, Dict]], borrados: Iterable[str]) -> "SparseBM25Index":
+        """
+        Devuelve un índice nuevo con los documentos `upserts` (id, texto, metadatos)
+        añadidos o reemplazados y los ids `borrados` eliminados.
+        Solo se tokenizan los documentos de `upserts`; los pesos BM25 se recalculan
+        de forma vectorizada porque IDF y longitud media cambian globalmente.
+        """
+        fuera = set(borrados) | {doc_id for doc_id, _, _ in upserts}
+        keep = [i for i, doc_id in enumerate(self.ids) if doc_id not in fuera]
+
+        vocab = dict(self.vocab)
+        nuevos_docs = [doc or "" for _, doc, _ in upserts]
+        tf_nuevos = self._matriz_frecuencias(nuevos_docs, vocab)
+
+        tf_keep = self.tf[keep] if keep else sparse.csr_matrix((0, self.tf.shape[1]), dtype=np.float32)
+        tf_keep = sparse.csr_matrix(tf_keep, dtype=np.float32)
+        tf_keep.resize((tf_keep.shape[0], len(vocab)))
+        tf_nuevos.resize((tf_nuevos.shape[0], len(vocab)))
+        tf = sparse.vstack([tf_keep, tf_nuevos], format="csr", dtype=np.float32)
+
+        ids = [self.ids[i] for i in keep] + [doc_id for doc_id, _, _ in upserts]
+        docs = [self.docs[i] for i in keep] + nuevos_docs
+        metadatas = [self.metadatas[i] for i in keep] + [meta or {} for _, _, meta in upserts]
+        return SparseBM25Index(ids, docs, metadatas, vocab, tf, k1=self.k1, b=self.b)
+
+    # --------------------------------------------------------------------------
+    # PERSISTENCIA
+    # --------------------------------------------------------------------------
+    def guardar(self, directorio: str, huella: str):
+        """
+        Serializa el índice en un subdirectorio nuevo de `directorio`, etiquetado con
+        la huella de la colección. La cabecera que apunta a él se escribe la última:
+        un guardado a medias nunca es válido.
+        """
+        version = f"v_{uuid.uuid4().hex[:12]}"
+        destino = os.path.join(directorio, version)
+        os.makedirs(destino)
+
+        arrays = {
+            "tf_data": self.tf.data, "tf_indices": self.tf.indices, "tf_indptr": self.tf.indptr,
+            "w_data": self._pesos.data, "w_indices": self._pesos.indices, "w_indptr": self._pesos.indptr,
+        }
+        for nombre, arr in arrays.items():
+            np.save(os.path.join(destino, f"{nombre}.npy"), np.ascontiguousarray(arr))
+
+        vocab = [None] * len(self.vocab)
+        for term, i in self.vocab.items():
+            vocab[i] = term
+        datos = {
+            "k1": self.k1, "b": self.b, "shape_tf": list(self.tf.shape), "shape_w": list(self._pesos.shape),
+            "vocab": vocab, "ids": self.ids, "docs": self.docs, "metadatas": self.metadatas,
+        }
+        with open(os.path.join(destino, "datos.json"), "w", encoding="utf-8") as f:
+            json.dump(datos, f, ensure_ascii=False)
+
+        ruta_meta = os.path.join(directorio, "index.json")
+        tmp = ruta_meta + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": FORMATO_VERSION, "fingerprint": huella, "datos": version}, f)
+        os.replace(tmp, ruta_meta)
+        self.huella = huella
+        self._limpiar_versiones(directorio, version)
+
+    @staticmethod
+    def _limpiar_versiones(directorio: str, vigente: str):
+        """
+        Borra las versiones anteriores y los ficheros del formato antiguo. Las que
+        siguen mapeadas por un índice en uso no se pueden borrar en Windows: se
+        reintentan en el siguiente guardado.
+        """
+        for nombre in os.listdir(directorio):
+            ruta = os.path.join(directorio, nombre)
+            try:
+                if nombre.startswith("v_") and nombre != vigente and os.path.isdir(ruta):
+                    shutil.rmtree(ruta)
+                elif nombre.endswith(".npy"):
+                    os.remove(ruta)
+            except OSError:
+                pass
+
+    @classmethod
+    def cargar(cls, directorio: str, huella: Optional[str] = None) -> Optional["SparseBM25Index"]:
+        """
+        Carga un índice guardado. Devuelve None si no existe, está incompleto
+        o su huella no coincide con la indicada.
+        """
+        ruta_meta = os.path.join(directorio, "index.json")
+        if not os.path.exists(ruta_meta):
+            return None
+        try:
+            with open(ruta_meta, "r", encoding="utf-8") as f:
+                cabecera = json.load(f)
+            if cabecera.get("version") != FORMATO_VERSION:
+                return None
+            if huella is not None and cabecera.get("fingerprint") != huella:
+                return None
+
+            origen = os.path.join(directorio, cabecera["datos"])
+            with open(os.path.join(origen, "datos.json"), "r", encoding="utf-8") as f:
+                datos = json.load(f)
+            arr = {n: np.load(os.path.join(origen, f"{n}.npy"), mmap_mode="r") for n in _ARRAYS}
+            tf = sparse.csr_matrix((arr["tf_data"], arr["tf_indices"], arr["tf_indptr"]), shape=tuple(datos["shape_tf"]), copy=False)
+            pesos = sparse.csr_matrix((arr["w_data"], arr["w_indices"], arr["w_indptr"]), shape=tuple(datos["shape_w"]), copy=False)
+            vocab = {term: i for i, term in enumerate(datos["vocab"])}
+            index = cls(datos["ids"], datos["docs"], datos["metadatas"], vocab, tf,
+                        k1=datos["k1"], b=datos["b"], pesos=pesos)
+            index.huella = cabecera["fingerprint"]
+            return index
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+
+def _hash_contenido(doc: Optional[str]) -> str:
+    return hashlib.sha1((doc or "").encode("utf-8")).hexdigest()
+
+
+def _combinar_huella(total: int, pares: List[Tuple[str, str]]) -> str:
+    h = hashlib.sha1()
+    for doc_id, doc_hash in sorted(pares):
+        h.update(f"{doc_id}\x00{doc_hash}\n".encode("utf-8"))
+    return f"{total}-{h.hexdigest()}"
+
+
+def huella_coleccion(collection, page_size: int = 5000) -> str:
+    """
+    Huella de una colección de ChromaDB: nº de registros + hash de (id, contenido).
+    No descarga embeddings ni metadatos y es independiente del orden de lectura.
+    """
+    total = collection.count()
+    pares = []
+    for offset in range(0, total, page_size):
+        lote = collection.get(include=["documents"], limit=page_size, offset=offset)
+        for doc_id, doc in zip(lote["ids"], lote["documents"]):
+            pares.append((doc_id, _hash_contenido(doc)))
+    return _combinar_huella(total, pares)
+
+
+def diff_coleccion(collection, index: Optional[SparseBM25Index], completo: bool = True, page_size: int = 5000):
+    """
+    Compara la colección con el índice en memoria.
+    Devuelve (upserts, borrados, huella): upserts son los (id, texto, metadatos)
+    nuevos o modificados, borrados los ids que ya no existen en la colección.
+
+    Con completo=False solo se comparan los ids: se descargan los documentos de
+    los ids nuevos y se asume que los ya indexados no han cambiado. La huella
+    resultante es la misma que calcularía huella_coleccion().
+    """
+    if completo or index is None:
+        return _diff_completo(collection, index, page_size)
+
+    total = collection.count()
+    ids = []
+    for offset in range(0, total, page_size):
+        ids.extend(collection.get(include=[], limit=page_size, offset=offset)["ids"])
+    vistos = set(ids)
+    borrados = [doc_id for doc_id in index.ids if doc_id not in vistos]
+    if len(ids) == len(index) and not borrados:
+        return [], [], index.huella or _combinar_huella(total, [(i, _hash_contenido(d)) for i, d in zip(index.ids, index.docs)])
+
+    nuevos = [doc_id for doc_id in ids if doc_id not in index._pos]
+    upserts = []
+    for i in range(0, len(nuevos), page_size):
+        lote = collection.get(ids=nuevos[i:i + page_size], include=["documents", "metadatas"])
+        upserts.extend((doc_id, doc or "", meta or {}) for doc_id, doc, meta in zip(lote["ids"], lote["documents"], lote["metadatas"]))
+
+    pares = [(doc_id, _hash_contenido(doc)) for doc_id, doc, _ in upserts]
+    pares += [(doc_id, _hash_contenido(index.docs[index._pos[doc_id]])) for doc_id in ids if doc_id in index._pos]
+    return upserts, borrados, _combinar_huella(total, pares)
+
+
+def _diff_completo(collection, index: Optional[SparseBM25Index], page_size: int):
+    total = collection.count()
+    pares, upserts, vistos = [], [], set()
+    for offset in range(0, total, page_size):
+        lote = collection.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+        for doc_id, doc, meta in zip(lote["ids"], lote["documents"], lote["metadatas"]):
+            vistos.add(doc_id)
+            pares.append((doc_id, _hash_contenido(doc)))
+            pos = index._pos.get(doc_id) if index is not None else None
+            if pos is None or index.docs[pos] != (doc or "") or index.metadatas[pos] != (meta or {}):
+                upserts.append((doc_id, doc or "", meta or {}))
+
+    borrados = [doc_id for doc_id in (index.ids if index is not None else []) if doc_id not in vistos]
+    return upserts, borrados, _combinar_huella(total, pares)
@@ -0,0 +1,241 @@
+"""
+================================================================================
+CACHÉS EN MEMORIA Y EN DISCO
+================================================================================
+   Estructuras de caché compartidas por el backend RAG.
+
+COMPONENTES:
+    - CacheLRU: caché en memoria thread-safe con desalojo por tamaño (LRU) y
+      caducidad (TTL), con contadores de aciertos/fallos.
+    - EmbeddingCache: caché de embeddings de consulta en dos niveles
+      (LRU en memoria + SQLite opcional en disco que sobrevive a reinicios),
+      indexada por (modelo, texto normalizado).
+    - SemanticCache: caché de respuestas completas para preguntas casi
+      idénticas (similitud coseno sobre el embedding de la consulta), separada
+      por persona e invalidada cuando cambia la versión de las colecciones.
+================================================================================
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+import numpy as np
+
+
+def normalizar_texto(texto: str) -> str:
+    """
+    Normalización de consultas para las claves de caché:
+    Unicode NFC, minúsculas y espacios colapsados.
+    """
+    return " ".join(unicodedata.normalize("NFC", texto or "").lower().split())
+
+
+class CacheLRU:
+    """
+    Caché LRU en memoria con TTL opcional (ttl <= 0 desactiva la caducidad).
+    """
+
+    def __init__(self, max_items: int = 1024, ttl: float = 0.0):
+        self.max_items = max(1, max_items)
+        self.ttl = ttl
+        self._datos: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, clave: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._datos.get(clave)
+            if item is None:
+                self.misses += 1
+                return None
+            valor, instante = item
+            if self.ttl > 0 and time.time() - instante > self.ttl:
+                del self._datos[clave]
+                self.misses += 1
+                return None
+            self._datos.move_to_end(clave)
+            self.hits += 1
+            return valor
+
+    def put(self, clave: Hashable, valor: Any):
+        with self._lock:
+            self._datos[clave] = (valor, time.time())
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_items:
+                self._datos.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._datos.clear()
+
+    def __len__(self) -> int:
+        return len(self._datos)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "items": len(self._datos), "hits": self.hits, "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+class EmbeddingCache:
+    """
+    Caché de embeddings de consulta: LRU en memoria + SQLite opcional en disco.
+    """
+
+    def __init__(self, max_items: int = 2048, ttl: float = 0.0, ruta_disco: str = ""):
+        self.memoria = CacheLRU(max_items, ttl)
+        self.ttl = ttl
+        self.hits_disco = 0
+        self._db = None
+        self._db_lock = threading.Lock()
+        if ruta_disco:
+            os.makedirs(os.path.dirname(os.path.abspath(ruta_disco)), exist_ok=True)
+            self._db = sqlite3.connect(ruta_disco, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "clave TEXT PRIMARY KEY, dim INTEGER, vector BLOB, creado REAL)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def _clave(modelo: str, texto: str) -> str:
+        return hashlib.sha1(f"{modelo}\x00{normalizar_texto(texto)}".encode("utf-8")).hexdigest()
+
+    @property
+    def en_disco(self) -> bool:
+        return self._db is not None
+
+    def get_memoria(self, modelo: str, texto: str) -> Optional[np.ndarray]:
+        """
+        Consulta solo la LRU en memoria (sin E/S): apta para el bucle de eventos.
+        """
+        return self.memoria.get(self._clave(modelo, texto))
+
+    def get_disco(self, modelo: str, texto: str) -> Optional[np.ndarray]:
+        """
+        Consulta SQLite y sube el acierto a memoria. Bloqueante: usar desde el pool de hilos.
+        """
+        if self._db is None:
+            return None
+        clave = self._clave(modelo, texto)
+        with self._db_lock:
+            fila = self._db.execute("SELECT vector, creado FROM embeddings WHERE clave = ?", (clave,)).fetchone()
+        if fila is None or (self.ttl > 0 and time.time() - fila[1] > self.ttl):
+            return None
+        vec = np.frombuffer(fila[0], dtype=np.float32).copy()
+        self.hits_disco += 1
+        self.memoria.put(clave, vec)
+        return vec
+
+    def get(self, modelo: str, texto: str) -> Optional[np.ndarray]:
+        vec = self.get_memoria(modelo, texto)
+        return vec if vec is not None else self.get_disco(modelo, texto)
+
+    def put(self, modelo: str, texto: str, vector) -> np.ndarray:
+        clave = self._clave(modelo, texto)
+        vec = np.asarray(vector, dtype=np.float32).ravel()
+        self.memoria.put(clave, vec)
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings (clave, dim, vector, creado) VALUES (?, ?, ?, ?)",
+                    (clave, int(vec.shape[0]), vec.tobytes(), time.time())
+                )
+                self._db.commit()
+        return vec
+
+    def stats(self) -> Dict[str, Any]:
+        s = self.memoria.stats()
+        # Un acierto en disco cuenta como fallo en memoria: se corrige para el total
+        fallos = s["misses"] - self.hits_disco
+        total = s["hits"] + self.hits_disco + fallos
+        return {
+            "items_memoria": s["items"], "hits_memoria": s["hits"], "hits_disco": self.hits_disco,
+            "misses": fallos, "hit_rate": round((s["hits"] + self.hits_disco) / total, 3) if total else 0.0,
+            "disco": self._db is not None,
+        }
+
+
+class SemanticCache:
+    """
+    Caché semántica de respuestas: devuelve la entrada más parecida de la misma
+    persona si su similitud coseno supera el umbral. LRU + TTL.
+    """
+
+    def __init__(self, max_items: int = 512, ttl: float = 0.0, umbral: float = 0.95):
+        self.max_items = max(1, max_items)
+        self.ttl = ttl
+        self.umbral = umbral
+        self.version: Optional[str] = None
+        self._entradas: "OrderedDict[int, tuple]" = OrderedDict()
+        self._siguiente = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidaciones = 0
+
+    @staticmethod
+    def _normalizar(vec) -> np.ndarray:
+        v = np.asarray(vec, dtype=np.float32).ravel()
+        n = float(np.linalg.norm(v))
+        return v / n if n else v
+
+    def _comprobar_version(self, version: Optional[str]):
+        if version != self.version:
+            if self._entradas:
+                self.invalidaciones += 1
+            self._entradas.clear()
+            self.version = version
+
+    def buscar(self, persona: str, vec, version: Optional[str]) -> Optional[Tuple[Dict[str, Any], float]]:
+        """
+        Devuelve (payload, similitud) de la mejor entrada sobre el umbral, o None.
+        """
+        q = self._normalizar(vec)
+        ahora = time.time()
+        with self._lock:
+            self._comprobar_version(version)
+            if self.ttl > 0:
+                for clave in [c for c, e in self._entradas.items() if ahora - e[3] > self.ttl]:
+                    del self._entradas[clave]
+
+            candidatos = [(c, e) for c, e in self._entradas.items() if e[0] == persona and e[1].shape == q.shape]
+            if not candidatos:
+                self.misses += 1
+                return None
+
+            sims = np.stack([e[1] for _, e in candidatos]) @ q
+            mejor = int(np.argmax(sims))
+            if float(sims[mejor]) < self.umbral:
+                self.misses += 1
+                return None
+
+            clave, entrada = candidatos[mejor]
+            self._entradas.move_to_end(clave)
+            self.hits += 1
+            return entrada[2], float(sims[mejor])
+
+    def guardar(self, persona: str, vec, payload: Dict[str, Any], version: Optional[str]):
+        with self._lock:
+            self._comprobar_version(version)
+            self._entradas[self._siguiente] = (persona, self._normalizar(vec), payload, time.time())
+            self._siguiente += 1
+            while len(self._entradas) > self.max_items:
+                self._entradas.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "items": len(self._entradas), "hits": self.hits, "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "invalidaciones": self.invalidaciones,
+        }
@@ -0,0 +1,83 @@
+"""
+================================================================================
+EJECUTOR ACOTADO PARA TRABAJO BLOQUEANTE
+================================================================================
+   Utilidades para sacar del event loop de FastAPI todo el trabajo bloqueante
+   del pipeline RAG (inferencia de modelos, consultas a ChromaDB y llamadas
+   síncronas al LLM).
+
+COMPONENTES:
+    - Pool de hilos acotado (tamaño configurable con EXECUTOR_WORKERS).
+    - run_blocking: ejecuta una función síncrona en el pool y la espera con await.
+    - ModeloProtegido: envoltorio que serializa el acceso a un modelo compartido
+      (SentenceTransformer / CrossEncoder), cuyos tokenizadores no son seguros
+      entre hilos.
+================================================================================
+"""
+
+import asyncio
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def init_executor(max_workers: int) -> ThreadPoolExecutor:
+    """
+    Crea (una sola vez) el pool de hilos compartido por toda la API.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="rag-worker")
+    return _executor
+
+
+def shutdown_executor():
+    """
+    Libera el pool de hilos (evento de apagado de la API).
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+async def run_blocking(func: Callable, *args, **kwargs) -> Any:
+    """
+    Ejecuta una función bloqueante en el pool acotado sin congelar el event loop.
+    """
+    executor = _executor or init_executor(4)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+class ModeloProtegido:
+    """
+    Envoltorio thread-safe para un modelo compartido.
+    Las llamadas de inferencia (encode / predict) se serializan con un lock;
+    el resto de atributos se delegan directamente al modelo original.
+    """
+
+    def __init__(self, model):
+        self._model = model
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        return self._model
+
+    def encode(self, *args, **kwargs):
+        with self._lock:
+            return self._model.encode(*args, **kwargs)
+
+    def predict(self, *args, **kwargs):
+        with self._lock:
+            return self._model.predict(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
@@ -0,0 +1,70 @@
+"""
+================================================================================
+ESTADO DE LOS COMPONENTES (ARRANQUE Y HEALTH CHECKS)
+================================================================================
+   Registro del estado de carga de cada componente del backend (modelos,
+   ChromaDB, índices BM25, tokenizador), usado por la carga concurrente del
+   arranque y por los endpoints /health/live y /health/ready.
+
+ESTADOS:
+    pendiente -> cargando -> listo | error | ausente
+    ("ausente": el recurso no existe, p. ej. la colección no se ha ingerido).
+================================================================================
+"""
+
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+logger = logging.getLogger("RAG_CORE")
+
+PENDIENTE, CARGANDO, LISTO, ERROR, AUSENTE = "pendiente", "cargando", "listo", "error", "ausente"
+
+
+class RegistroComponentes:
+    """
+    Estado de carga por componente, con duración y último error.
+    """
+
+    def __init__(self, nombres: Iterable[str]):
+        self._estado: Dict[str, Dict[str, Any]] = {n: {"estado": PENDIENTE} for n in nombres}
+
+    def marcar(self, nombre: str, estado: str, **extra):
+        self._estado.setdefault(nombre, {}).update({"estado": estado, **extra})
+
+    def estado(self, nombre: str) -> str:
+        return self._estado.get(nombre, {}).get("estado", PENDIENTE)
+
+    def listo(self, *nombres: str) -> bool:
+        return all(self.estado(n) == LISTO for n in nombres)
+
+    def terminado(self) -> bool:
+        """
+        True cuando ningún componente está pendiente o cargando.
+        """
+        return all(e["estado"] not in (PENDIENTE, CARGANDO) for e in self._estado.values())
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {n: dict(e) for n, e in self._estado.items()}
+
+    async def cargar(self, nombre: str, corrutina: Callable[[], Awaitable[Any]]) -> Optional[Any]:
+        """
+        Ejecuta la carga de un componente registrando su estado y duración.
+        Un fallo queda aislado en el componente (no aborta el resto del arranque).
+        Si la carga devuelve None, el componente se marca como ausente.
+        """
+        self.marcar(nombre, CARGANDO)
+        t0 = time.time()
+        try:
+            resultado = await corrutina()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.marcar(nombre, ERROR, segundos=round(time.time() - t0, 2), error=str(e))
+            logger.error(f"[ARRANQUE] Fallo cargando {nombre}: {e}")
+            return None
+        estado = LISTO if resultado is not None else AUSENTE
+        self.marcar(nombre, estado, segundos=round(time.time() - t0, 2))
+        logger.info(f"[ARRANQUE] {nombre}: {estado} ({time.time() - t0:.1f}s)")
+        return resultado
@@ -0,0 +1,99 @@
+"""
+================================================================================
+BACKENDS DE INFERENCIA (TORCH / INT8 / ONNX RUNTIME)
+================================================================================
+   Carga los modelos de embeddings y el reranker con el backend elegido en
+   Config (INFERENCE_BACKEND o BACKEND_TEXT / BACKEND_IMAGE / BACKEND_RERANKER),
+   para acelerar la inferencia en servidores solo-CPU.
+
+BACKENDS:
+    - torch:       PyTorch fp32 (referencia).
+    - torch-int8:  cuantización dinámica int8 de las capas Linear (torch.quantization).
+    - onnx:        ONNX Runtime fp32 (exportación con Optimum la primera vez).
+    - onnx-int8:   ONNX Runtime con cuantización dinámica int8
+                   (ONNX_QUANT_CONFIG: avx2, avx512, avx512_vnni o arm64).
+
+Las exportaciones ONNX se guardan en ONNX_EXPORT_DIR/<modelo> y se reutilizan.
+CLIP (clip-ViT-B-32) no es exportable a ONNX desde sentence-transformers: para
+él los backends onnx* se sustituyen por torch-int8.
+Si un backend falla, se registra el error y se carga el modelo en fp32.
+================================================================================
+"""
+
+import os
+import re
+import logging
+
+from sentence_transformers import SentenceTransformer, CrossEncoder
+
+logger = logging.getLogger("RAG_CORE")
+
+BACKENDS = ("torch", "torch-int8", "onnx", "onnx-int8")
+
+
+def _directorio_export(nombre_modelo: str, dir_export: str) -> str:
+    return os.path.join(dir_export, re.sub(r"[^\w.-]+", "__", nombre_modelo))
+
+
+def _cuantizar_torch(modelo):
+    """
+    Cuantización dinámica int8 (pesos int8, activaciones cuantizadas al vuelo) en CPU.
+    """
+    import torch
+    red = modelo.model if isinstance(modelo, CrossEncoder) else modelo
+    torch.quantization.quantize_dynamic(red, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return modelo
+
+
+def _cargar_onnx(clase, nombre_modelo: str, int8: bool, dir_export: str, config_cuant: str, **kwargs):
+    """
+    Exporta (una sola vez) el modelo a ONNX y, si se pide, su versión int8; después lo carga.
+    """
+    destino = _directorio_export(nombre_modelo, dir_export)
+    if not os.path.exists(os.path.join(destino, "onnx", "model.onnx")):
+        logger.info(f"[BACKEND] Exportando {nombre_modelo} a ONNX en {destino} (solo la primera vez)...")
+        clase(nombre_modelo, backend="onnx", **kwargs).save_pretrained(destino)
+
+    if not int8:
+        return clase(destino, backend="onnx", **kwargs)
+
+    fichero = f"onnx/model_qint8_{config_cuant}.onnx"
+    if not os.path.exists(os.path.join(destino, fichero)):
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+        logger.info(f"[BACKEND] Cuantizando {nombre_modelo} a int8 ({config_cuant})...")
+        export_dynamic_quantized_onnx_model(clase(destino, backend="onnx", **kwargs), config_cuant, destino)
+    return clase(destino, backend="onnx", model_kwargs={"file_name": fichero}, **kwargs)
+
+
+def cargar_modelo(clase, nombre_modelo: str, backend: str = "torch", dir_export: str = "./cache/onnx",
+                  config_cuant: str = "avx2", exportable_onnx: bool = True, **kwargs):
+    """
+    Carga un SentenceTransformer o CrossEncoder con el backend indicado.
+    Devuelve (modelo, backend_efectivo).
+    """
+    if backend not in BACKENDS:
+        logger.warning(f"[BACKEND] Backend '{backend}' desconocido para {nombre_modelo}. Se usa 'torch'.")
+        backend = "torch"
+    if backend.startswith("onnx") and not exportable_onnx:
+        logger.warning(f"[BACKEND] {nombre_modelo} no admite ONNX: se usa 'torch-int8'.")
+        backend = "torch-int8"
+
+    try:
+        if backend == "torch":
+            return clase(nombre_modelo, **kwargs), backend
+        if backend == "torch-int8":
+            return _cuantizar_torch(clase(nombre_modelo, **kwargs)), backend
+        return _cargar_onnx(clase, nombre_modelo, backend == "onnx-int8", dir_export, config_cuant, **kwargs), backend
+    except Exception as e:
+        logger.error(f"[BACKEND] No se pudo cargar {nombre_modelo} con '{backend}' ({e}). Se usa 'torch' fp32.")
+        return clase(nombre_modelo, **kwargs), "torch"
+
+
+def cargar_embedder(nombre_modelo: str, backend: str, dir_export: str, config_cuant: str, **kwargs):
+    # Los modelos CLIP de sentence-transformers no son un Transformer exportable con Optimum
+    exportable = "clip" not in nombre_modelo.lower()
+    return cargar_modelo(SentenceTransformer, nombre_modelo, backend, dir_export, config_cuant, exportable, **kwargs)
+
+
+def cargar_reranker(nombre_modelo: str, backend: str, dir_export: str, config_cuant: str, **kwargs):
+    return cargar_modelo(CrossEncoder, nombre_modelo, backend, dir_export, config_cuant, True, **kwargs)
@@ -0,0 +1,106 @@
+"""
+================================================================================
+MÉTRICAS PROMETHEUS
+================================================================================
+   Instrumentación del pipeline RAG expuesta en GET /metrics (formato texto de
+   Prometheus), para ver dónde se va la latencia bajo carga real y poder
+   alertar ante regresiones.
+
+MÉTRICAS:
+    - rag_stage_duration_seconds{stage}: latencia por etapa (rewrite,
+      text_vector, text_bm25, text_rrf, text_rerank, image_vector, image_bm25,
+      image_rrf, image_rerank; en /ask_batch: text_batch_vector, text_batch_bm25,
+      image_batch_vector, image_batch_bm25, batch_rrf, batch_rerank).
+    - rag_time_to_first_token_seconds{origen}: desde la recepción de la
+      consulta hasta el primer fragmento de respuesta (llm / cache).
+    - rag_stream_duration_seconds{origen}: duración total de la respuesta.
+    - rag_llm_rate_limited_total: respuestas 429 del proveedor LLM.
+    - rag_errors_total{stage}: errores por etapa.
+    - rag_requests_in_flight: consultas /ask en curso.
+    - rag_cache_hits_total / rag_cache_misses_total{cache}, rag_index_documents{index}
+      y rag_cancelled_requests_total: se leen de las estadísticas internas en
+      cada scrape (ColectorEstado), sin contabilidad duplicada.
+================================================================================
+"""
+
+from typing import Any, Callable, Dict
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+REGISTRO = CollectorRegistry()
+
+# Buckets desde operaciones en memoria (ms) hasta generaciones largas
+BUCKETS_ETAPA = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BUCKETS_LLM = (0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 30.0, 60.0, 120.0)
+
+LATENCIA_ETAPA = Histogram(
+    "rag_stage_duration_seconds", "Latencia de cada etapa del pipeline RAG",
+    ["stage"], buckets=BUCKETS_ETAPA, registry=REGISTRO
+)
+TTFT = Histogram(
+    "rag_time_to_first_token_seconds", "Tiempo hasta el primer fragmento de respuesta",
+    ["origen"], buckets=BUCKETS_LLM, registry=REGISTRO
+)
+DURACION_STREAM = Histogram(
+    "rag_stream_duration_seconds", "Duración total de la respuesta en streaming",
+    ["origen"], buckets=BUCKETS_LLM, registry=REGISTRO
+)
+LIMITE_CUOTA = Counter("rag_llm_rate_limited", "Respuestas 429 del proveedor LLM", registry=REGISTRO)
+ERRORES = Counter("rag_errors", "Errores por etapa del pipeline", ["stage"], registry=REGISTRO)
+EN_CURSO = Gauge("rag_requests_in_flight", "Consultas /ask en curso", registry=REGISTRO)
+
+
+def medir(etapa: str):
+    """
+    Context manager que observa la duración de una etapa en LATENCIA_ETAPA.
+    """
+    return LATENCIA_ETAPA.labels(etapa).time()
+
+
+def registrar_error(etapa: str):
+    ERRORES.labels(etapa).inc()
+
+
+class ColectorEstado:
+    """
+    Colector que traduce en cada scrape el estado interno de la API
+    (estadísticas de cachés, tamaño de índices, cancelaciones) a métricas.
+
+    `fuente` devuelve {"caches": {nombre: (hits, misses)}, "indices": {nombre: docs},
+    "cancelaciones": int}.
+    """
+
+    def __init__(self, fuente: Callable[[], Dict[str, Any]]):
+        self.fuente = fuente
+
+    def collect(self):
+        estado = self.fuente()
+        hits = CounterMetricFamily("rag_cache_hits", "Aciertos por caché", labels=["cache"])
+        misses = CounterMetricFamily("rag_cache_misses", "Fallos por caché", labels=["cache"])
+        for nombre, (h, m) in estado.get("caches", {}).items():
+            hits.add_metric([nombre], h)
+            misses.add_metric([nombre], m)
+        yield hits
+        yield misses
+
+        indices = GaugeMetricFamily("rag_index_documents", "Documentos en los índices cargados", labels=["index"])
+        for nombre, docs in estado.get("indices", {}).items():
+            indices.add_metric([nombre], docs)
+        yield indices
+
+        yield CounterMetricFamily(
+            "rag_cancelled_requests", "Consultas abortadas por desconexión del cliente",
+            value=estado.get("cancelaciones", 0)
+        )
+
+
+def registrar_colector(fuente: Callable[[], Dict[str, Any]]):
+    REGISTRO.register(ColectorEstado(fuente))
+
+
+def exportar() -> tuple:
+    """
+    Devuelve (cuerpo, content-type) para la respuesta de /metrics.
+    """
+    return generate_latest(REGISTRO), CONTENT_TYPE_LATEST
@@ -0,0 +1,211 @@
+"""
+================================================================================
+ENSAMBLADO DEL PROMPT CON PRESUPUESTO DE TOKENS
+================================================================================
+   Construye la lista de mensajes para el LLM sin superar PROMPT_MAX_TOKENS,
+   contando con el tokenizador del modelo destino.
+
+POLÍTICA DE RECORTE (en orden, hasta caber en el presupuesto):
+    1. Se descartan los turnos más antiguos del historial, conservando los
+       PROMPT_HISTORY_KEEP mensajes más recientes.
+    2. Se descartan los fragmentos de contexto de menor puntuación del
+       reranker (siempre se conserva el mejor).
+    3. Se descarta el resto del historial.
+    4. Se trunca el fragmento de contexto que queda.
+
+TOKENIZADOR:
+    - LLM_TOKENIZER (id de Hugging Face). Si está vacío, el del modelo LLM por
+      defecto de cada proveedor (TOKENIZADORES_CONOCIDOS); para otros modelos se
+      prueba su nombre sin el sufijo de variante de OpenRouter (":free"), que solo
+      sirve si coincide con un repositorio de Hugging Face: en ese caso conviene
+      fijar LLM_TOKENIZER. Se carga con transformers.AutoTokenizer.
+    - Si no se puede cargar, se usa una estimación por caracteres.
+
+La plantilla del sistema se compacta (sin sangría) antes de insertar el contexto.
+================================================================================
+"""
+
+import logging
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+
+logger = logging.getLogger("RAG_CORE")
+
+# Coste aproximado del envoltorio de cada mensaje en la plantilla de chat
+TOKENS_POR_MENSAJE = 4
+
+# Tokenizador en Hugging Face de los modelos LLM por defecto (nombres del proveedor)
+TOKENIZADORES_CONOCIDOS = {
+    "tngtech/deepseek-r1t2-chimera": "tngtech/DeepSeek-TNG-R1T2-Chimera",
+    "llama-3.3-70b-versatile": "unsloth/Llama-3.3-70B-Instruct",
+}
+
+# Marcadores de la plantilla del prompt de sistema
+MARCA_CONTEXTO = "\x00CONTEXTO\x00"
+MARCA_INST_VISUAL = "\x00INST_VISUAL\x00"
+
+
+def compactar_prompt(texto: str) -> str:
+    """
+    Elimina la sangría y las líneas en blanco repetidas de una plantilla de prompt
+    (la sangría del código fuente solo consume tokens).
+    """
+    lineas, anterior_vacia = [], True
+    for linea in texto.strip().splitlines():
+        linea = linea.strip()
+        if not linea and anterior_vacia:
+            continue
+        lineas.append(linea)
+        anterior_vacia = not linea
+    return "\n".join(lineas)
+
+
+def tokenizador_por_defecto(nombre_modelo: str) -> str:
+    """
+    Id de Hugging Face del tokenizador para un modelo LLM cuando LLM_TOKENIZER está vacío.
+    """
+    base = nombre_modelo.split(":", 1)[0]
+    return TOKENIZADORES_CONOCIDOS.get(base.lower(), base)
+
+
+class ContadorTokens:
+    """
+    Cuenta tokens con el tokenizador del modelo destino (o una estimación).
+    """
+
+    def __init__(self, nombre_tokenizador: str = "", chars_por_token: float = 3.5):
+        self.nombre = "estimacion"
+        self.chars_por_token = chars_por_token
+        self._tokenizer = None
+        if nombre_tokenizador:
+            try:
+                from transformers import AutoTokenizer
+                self._tokenizer = AutoTokenizer.from_pretrained(nombre_tokenizador)
+                self.nombre = nombre_tokenizador
+            except Exception as e:
+                logger.warning(f"[PROMPT] Tokenizador '{nombre_tokenizador}' no disponible ({e}). Se usa estimación: "
+                               "fija LLM_TOKENIZER con el id de Hugging Face del modelo.")
+
+    def contar(self, texto: str) -> int:
+        if not texto:
+            return 0
+        if self._tokenizer is not None:
+            return len(self._tokenizer.encode(texto, add_special_tokens=False))
+        return int(len(texto) / self.chars_por_token) + 1
+
+    def truncar(self, texto: str, max_tokens: int) -> str:
+        """
+        Recorta `texto` a `max_tokens` tokens como máximo.
+        """
+        if max_tokens <= 0:
+            return ""
+        if self._tokenizer is not None:
+            ids = self._tokenizer.encode(texto, add_special_tokens=False)
+            if len(ids) <= max_tokens:
+                return texto
+            return self._tokenizer.decode(ids[:max_tokens], skip_special_tokens=True) + " [...]"
+        limite = int(max_tokens * self.chars_por_token)
+        return texto if len(texto) <= limite else texto[:limite] + " [...]"
+
+
+@dataclass
+class FragmentoContexto:
+    """
+    Fragmento candidato para <context_data>. `puntuacion` es la prioridad para el recorte:
+    la certeza del reranker (0-100) o, sin reranker, un valor negativo según el orden RRF.
+    """
+    texto: str
+    puntuacion: float
+    origen: Dict = field(default_factory=dict)
+
+
+@dataclass
+class PromptEnsamblado:
+    mensajes: List[Dict[str, str]]
+    incluidos: List[FragmentoContexto]
+    tokens: int
+    presupuesto: int
+    contextos_descartados: int = 0
+    contextos_truncados: int = 0
+    turnos_descartados: int = 0
+
+    def resumen(self, tokenizador: str) -> Dict:
+        return {
+            "tokens": self.tokens, "presupuesto": self.presupuesto, "tokenizador": tokenizador,
+            "contextos_incluidos": len(self.incluidos), "contextos_descartados": self.contextos_descartados,
+            "contextos_truncados": self.contextos_truncados, "turnos_descartados": self.turnos_descartados,
+        }
+
+
+def ensamblar_prompt(plantilla_sistema: Callable[[List[FragmentoContexto]], str],
+                     fragmentos: List[FragmentoContexto], history: List[Dict[str, str]], query: str,
+                     contador: ContadorTokens, presupuesto: int, conservar_historial: int = 2) -> PromptEnsamblado:
+    """
+    Devuelve los mensajes (system + historial + usuario) dentro de `presupuesto` tokens.
+    `plantilla_sistema` genera el prompt de sistema a partir de los fragmentos incluidos
+    (en el orden original de recuperación). presupuesto <= 0 desactiva el recorte.
+    """
+    orden_original = {id(f): i for i, f in enumerate(fragmentos)}
+    por_valor = sorted(fragmentos, key=lambda f: f.puntuacion, reverse=True)
+    turnos = list(history)
+
+    # +1 por el salto de línea que separa los fragmentos dentro de <context_data>
+    coste_fragmento = {id(f): contador.contar(f.texto) + 1 for f in fragmentos}
+    coste_turno = [contador.contar(m["content"]) + TOKENS_POR_MENSAJE for m in turnos]
+    coste_query = contador.contar(query) + TOKENS_POR_MENSAJE
+
+    def incluidos_en_orden(lista):
+        return sorted(lista, key=lambda f: orden_original[id(f)])
+
+    def construir(lista, turnos_actuales):
+        sistema = plantilla_sistema(incluidos_en_orden(lista))
+        mensajes = [{"role": "system", "content": sistema}, *turnos_actuales, {"role": "user", "content": query}]
+        return mensajes, contador.contar(sistema) + TOKENS_POR_MENSAJE
+
+    resultado = PromptEnsamblado([], [], 0, presupuesto)
+    seleccion = list(por_valor)
+    mensajes, coste_sistema = construir(seleccion, turnos)
+
+    def total():
+        return coste_sistema + sum(coste_turno) + coste_query
+
+    if presupuesto <= 0 or total() <= presupuesto:
+        resultado.mensajes, resultado.incluidos, resultado.tokens = mensajes, incluidos_en_orden(seleccion), total()
+        return resultado
+
+    # El coste del sistema se estima de forma incremental y se recalcula al final
+    base_sistema = contador.contar(plantilla_sistema([])) + TOKENS_POR_MENSAJE
+    coste_sistema = base_sistema + sum(coste_fragmento[id(f)] for f in seleccion)
+
+    # 1. Turnos antiguos (se conservan los más recientes)
+    while len(turnos) > conservar_historial and total() > presupuesto:
+        turnos.pop(0); coste_turno.pop(0)
+        resultado.turnos_descartados += 1
+
+    # 2. Contexto de menor valor (siempre queda el mejor fragmento)
+    while len(seleccion) > 1 and total() > presupuesto:
+        descartado = seleccion.pop()
+        coste_sistema -= coste_fragmento[id(descartado)]
+        resultado.contextos_descartados += 1
+
+    # 3. Resto del historial
+    while turnos and total() > presupuesto:
+        turnos.pop(0); coste_turno.pop(0)
+        resultado.turnos_descartados += 1
+
+    # 4. Truncado del último fragmento
+    if seleccion and total() > presupuesto:
+        f = seleccion[0]
+        # Margen para la marca " [...]" que se añade al recortar
+        disponible = coste_fragmento[id(f)] - 1 - (total() - presupuesto) - 4
+        recortado = FragmentoContexto(contador.truncar(f.texto, disponible), f.puntuacion, f.origen)
+        orden_original[id(recortado)] = orden_original[id(f)]
+        seleccion = [recortado] if recortado.texto else []
+        resultado.contextos_truncados = 1 if recortado.texto else 0
+        resultado.contextos_descartados += 0 if recortado.texto else 1
+
+    mensajes, coste_sistema = construir(seleccion, turnos)
+    resultado.mensajes, resultado.incluidos, resultado.tokens = mensajes, incluidos_en_orden(seleccion), total()
+    if resultado.tokens > presupuesto:
+        logger.warning(f"[PROMPT] El prompt mínimo ({resultado.tokens} tokens) supera el presupuesto ({presupuesto})")
+    return resultado
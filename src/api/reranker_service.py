@@ -0,0 +1,145 @@
+"""
+================================================================================
+SERVICIO DE RERANKING CON MICRO-BATCHING
+================================================================================
+   Agrupa los pares (consulta, pasaje) de todas las peticiones en curso durante
+   una ventana corta (RERANK_BATCH_WINDOW_MS) y los evalúa con el Cross-Encoder
+   en un único lote, devolviendo a cada petición sus propias puntuaciones.
+
+FUNCIONAMIENTO:
+    1. Cada petición encola su lista de pares junto a un Future.
+    2. El worker espera el primer elemento y recoge los que lleguen durante la
+       ventana (hasta RERANK_MAX_BATCH pares).
+    3. Los pares se ordenan por longitud para minimizar el padding y se evalúan
+       con una sola llamada a predict() en el pool de hilos (en sub-lotes de
+       hasta RERANK_MAX_BATCH pares, p. ej. al puntuar un lote de /ask_batch).
+    4. Las puntuaciones se reordenan y se reparten a cada Future.
+
+CACHÉ DE PUNTUACIONES:
+    Si la petición indica los ids de ChromaDB de sus pasajes, las puntuaciones
+    se cachean por (modelo reranker, consulta normalizada, id). Solo los pares
+    sin puntuación en caché llegan al Cross-Encoder.
+================================================================================
+"""
+
+import asyncio
+import logging
+from typing import List, Optional, Sequence
+
+from src.api.executor import run_blocking
+from src.api.caches import CacheLRU, normalizar_texto
+
+logger = logging.getLogger("RAG_CORE")
+
+
+class RerankerMicroBatch:
+    """
+    Planificador de micro-lotes sobre un CrossEncoder compartido.
+    """
+
+    def __init__(self, modelo, ventana_ms: float = 5.0, max_batch: int = 64,
+                 nombre_modelo: str = "", cache_size: int = 0, cache_ttl: float = 0.0):
+        self.modelo = modelo
+        self.nombre_modelo = nombre_modelo
+        self.cache = CacheLRU(cache_size, cache_ttl) if cache_size > 0 else None
+        self.ventana = max(0.0, ventana_ms) / 1000.0
+        self.max_batch = max(1, max_batch)
+        self._cola: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.stats = {"lotes": 0, "pares": 0, "peticiones": 0}
+
+    def _asegurar_worker(self):
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._worker.get_loop() is not loop:
+            self._cola = asyncio.Queue()
+            self._worker = asyncio.create_task(self._bucle())
+
+    async def puntuar(self, pares: Sequence[Sequence[str]], ids: Optional[Sequence[str]] = None) -> List[float]:
+        """
+        Devuelve la puntuación (logit) del Cross-Encoder para cada par (consulta, pasaje).
+        `ids` (opcional) son los ids de ChromaDB de los pasajes, para usar la caché.
+        """
+        if not pares:
+            return []
+
+        scores: List[Optional[float]] = [None] * len(pares)
+        claves = None
+        if self.cache is not None and ids is not None:
+            claves = [(self.nombre_modelo, normalizar_texto(q), doc_id) for (q, _), doc_id in zip(pares, ids)]
+            scores = [self.cache.get(clave) if clave[2] is not None else None for clave in claves]
+
+        pendientes = [i for i, sc in enumerate(scores) if sc is None]
+        if pendientes:
+            nuevos = await self._encolar([pares[i] for i in pendientes])
+            for i, sc in zip(pendientes, nuevos):
+                scores[i] = sc
+                if claves and claves[i][2] is not None:
+                    self.cache.put(claves[i], sc)
+        return scores
+
+    def stats_completas(self):
+        return {**self.stats, "cache": self.cache.stats() if self.cache is not None else None}
+
+    async def _encolar(self, pares: List[Sequence[str]]) -> List[float]:
+        self._asegurar_worker()
+        futuro = asyncio.get_running_loop().create_future()
+        await self._cola.put((list(pares), futuro))
+        return await futuro
+
+    async def cerrar(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    async def _recoger_lote(self) -> list:
+        lote = [await self._cola.get()]
+        total = len(lote[0][0])
+        loop = asyncio.get_running_loop()
+        limite = loop.time() + self.ventana
+
+        while total < self.max_batch:
+            restante = limite - loop.time()
+            try:
+                if restante > 0:
+                    item = await asyncio.wait_for(self._cola.get(), timeout=restante)
+                else:
+                    item = self._cola.get_nowait()
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                break
+            lote.append(item)
+            total += len(item[0])
+        return lote
+
+    async def _bucle(self):
+        while True:
+            lote = await self._recoger_lote()
+            lote = [(pares, fut) for pares, fut in lote if not fut.done()]
+            if not lote:
+                continue
+
+            pares = [p for item_pares, _ in lote for p in item_pares]
+            orden = sorted(range(len(pares)), key=lambda i: len(pares[i][0]) + len(pares[i][1]))
+
+            try:
+                scores_ordenados = await run_blocking(
+                    self.modelo.predict, [pares[i] for i in orden], batch_size=max(min(len(pares), self.max_batch), 1)
+                )
+            except Exception as e:
+                logger.error(f"[RERANK] Error en el micro-lote: {e}")
+                for _, fut in lote:
+                    if not fut.done(): fut.set_exception(e)
+                continue
+
+            scores = [0.0] * len(pares)
+            for pos, i in enumerate(orden):
+                scores[i] = float(scores_ordenados[pos])
+
+            self.stats["lotes"] += 1
+            self.stats["pares"] += len(pares)
+            self.stats["peticiones"] += len(lote)
+
+            inicio = 0
+            for item_pares, fut in lote:
+                fin = inicio + len(item_pares)
+                if not fut.done(): fut.set_result(scores[inicio:fin])
+                inicio = fin
@@ -1,6 +1,7 @@
 import os
+import httpx
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from groq import Groq  
 
 # Cargar variables
@@ -10,17 +11,83 @@ class Config:
     # RUTAS
     DB_PATH = os.getenv("DB_PATH", "./chroma_db_multimodal")
     IMAGENES_DIR = os.getenv("DATA_PATH_IMAGENES", "./data/imagenes")
+    BM25_CACHE_DIR = os.getenv("BM25_CACHE_DIR", os.path.join(DB_PATH, "bm25_index"))
+    BM25_POLL_SECONDS = float(os.getenv("BM25_POLL_SECONDS", "60"))  # 0 = sin refresco automático
+
+    # ADMINISTRACIÓN (vacío = endpoints /admin desactivados)
+    ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
     
     # MODELOS LOCALES
     MODEL_TEXT = os.getenv("MODEL_EMBEDDING_TEXT", "Qwen/Qwen3-Embedding-0.6B")
     MODEL_IMAGE = os.getenv("MODEL_EMBEDDING_IMAGE", "clip-ViT-B-32")
     MODEL_RERANKER = os.getenv("MODEL_RERANKER", "BAAI/bge-reranker-v2-m3")
+
+    # BACKEND DE INFERENCIA (torch | torch-int8 | onnx | onnx-int8), global o por modelo
+    INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch").lower()
+    BACKEND_TEXT = os.getenv("BACKEND_TEXT", INFERENCE_BACKEND).lower()
+    BACKEND_IMAGE = os.getenv("BACKEND_IMAGE", INFERENCE_BACKEND).lower()
+    BACKEND_RERANKER = os.getenv("BACKEND_RERANKER", INFERENCE_BACKEND).lower()
+    ONNX_EXPORT_DIR = os.getenv("ONNX_EXPORT_DIR", "./cache/onnx")
+    ONNX_QUANT_CONFIG = os.getenv("ONNX_QUANT_CONFIG", "avx2")  # avx2 | avx512 | avx512_vnni | arm64
+
+    # DIMENSIÓN MATRYOSHKA DE QWEN (ingesta y consulta; 0 = completa). La API usa la registrada en la colección
+    EMB_DIM_TEXT = int(os.getenv("EMB_DIM_TEXT", "0"))
     
     # LLM PROVIDER (Switch)
     PROVIDER = os.getenv("LLM_PROVIDER", "openrouter").lower()
+    LLM_BASE_URL = os.getenv("LLM_BASE_URL", "")  # Endpoint OpenAI-compatible alternativo (ej: servidor local)
+
+    # CLIENTE LLM ASÍNCRONO (pool HTTP/2 compartido)
+    LLM_HTTP2 = os.getenv("LLM_HTTP2", "true").lower() == "true"
+    LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+    LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+    LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+    LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "20"))
+    LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+
+    # PRESUPUESTO DEL PROMPT (tokens de entrada; 0 = sin límite)
+    LLM_TOKENIZER = os.getenv("LLM_TOKENIZER", "")  # id de Hugging Face; vacío = tokenizador del modelo LLM por defecto
+    PROMPT_MAX_TOKENS = int(os.getenv("PROMPT_MAX_TOKENS", "6000"))
+    PROMPT_HISTORY_KEEP = int(os.getenv("PROMPT_HISTORY_KEEP", "2"))  # mensajes recientes que se recortan al final
     
     # UMBRALES
     UMBRAL_RERANKER = float(os.getenv("UMBRAL_RERANKER", "0.0"))
+    DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.9"))  # Jaccard para pasajes de texto casi duplicados
+
+    # CONCURRENCIA (pool de hilos para modelos, ChromaDB y LLM)
+    EXECUTOR_WORKERS = int(os.getenv("EXECUTOR_WORKERS", "8"))
+    TIMEOUT_RAMA_TEXTO = float(os.getenv("TIMEOUT_RAMA_TEXTO", "30"))
+    TIMEOUT_RAMA_IMAGEN = float(os.getenv("TIMEOUT_RAMA_IMAGEN", "30"))
+    DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", "0.5"))
+
+    # CONSULTAS POR LOTES (/ask_batch: evaluación del Golden Set)
+    BATCH_MAX_QUERIES = int(os.getenv("BATCH_MAX_QUERIES", "256"))
+    BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "4"))  # generaciones simultáneas
+
+    # ARRANQUE (modo degradado: atender con BM25 / solo texto mientras cargan los modelos)
+    DEGRADED_MODE = os.getenv("DEGRADED_MODE", "false").lower() == "true"
+
+    # RERANKER (micro-batching entre peticiones concurrentes)
+    RERANK_BATCH_WINDOW_MS = float(os.getenv("RERANK_BATCH_WINDOW_MS", "5"))
+    RERANK_MAX_BATCH = int(os.getenv("RERANK_MAX_BATCH", "64"))
+    RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "20000"))  # pares (consulta, id); 0 = sin caché
+    RERANK_CACHE_TTL = float(os.getenv("RERANK_CACHE_TTL", "86400"))
+
+    # CACHÉ DE EMBEDDINGS DE CONSULTA (memoria + disco opcional)
+    EMB_CACHE_SIZE = int(os.getenv("EMB_CACHE_SIZE", "2048"))
+    EMB_CACHE_TTL = float(os.getenv("EMB_CACHE_TTL", "86400"))  # segundos, 0 = sin caducidad
+    EMB_CACHE_DISK = os.getenv("EMB_CACHE_DISK", "")  # ruta SQLite, vacío = solo memoria
+
+    # REESCRITURA DE CONSULTAS (caché y búsqueda especulativa)
+    REWRITE_CACHE_SIZE = int(os.getenv("REWRITE_CACHE_SIZE", "1024"))
+    REWRITE_CACHE_TTL = float(os.getenv("REWRITE_CACHE_TTL", "3600"))
+    REWRITE_SPECULATIVE = os.getenv("REWRITE_SPECULATIVE", "true").lower() == "true"
+    REWRITE_SIMILARITY = float(os.getenv("REWRITE_SIMILARITY", "0.9"))
+
+    # CACHÉ SEMÁNTICA DE RESPUESTAS (preguntas sin historial; 0 = desactivada)
+    SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "512"))
+    SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "86400"))
+    SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
 
     @staticmethod
     def get_llm_client():
@@ -48,5 +115,47 @@ class Config:
                 "type": "openai"
             }
 
+    @staticmethod
+    def get_async_llm_client():
+        """
+        Cliente asíncrono OpenAI-compatible con pool de conexiones HTTP/2 compartido.
+        Groq y OpenRouter exponen la API de OpenAI, así que se usa AsyncOpenAI para ambos.
+        """
+        if Config.PROVIDER == "groq":
+            api_key = os.getenv("GROQ_API_KEY")
+            base_url = "https://api.groq.com/openai/v1"
+            model = os.getenv("LLM_MODEL_GROQ", "llama-3.3-70b-versatile")
+        else: # Default: OpenRouter
+            api_key = os.getenv("OPENROUTER_API_KEY")
+            base_url = "https://openrouter.ai/api/v1"
+            model = os.getenv("LLM_MODEL_OPENROUTER", "tngtech/deepseek-r1t2-chimera:free")
+
+        if Config.LLM_BASE_URL:
+            base_url = Config.LLM_BASE_URL
+            api_key = api_key or "sk-local"
+        if not api_key: raise ValueError(f"Falta la API key de {Config.PROVIDER.upper()} en .env")
+
+        try:
+            import h2  # noqa: F401  (HTTP/2 requiere el extra httpx[http2])
+            http2 = Config.LLM_HTTP2
+        except ImportError:
+            http2 = False
+
+        http_client = httpx.AsyncClient(
+            http2=http2,
+            timeout=httpx.Timeout(Config.LLM_TIMEOUT, connect=Config.LLM_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=Config.LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=Config.LLM_MAX_KEEPALIVE,
+                keepalive_expiry=Config.LLM_KEEPALIVE_EXPIRY,
+            ),
+        )
+        print(f"Usando proveedor: {Config.PROVIDER.upper()} (async, {base_url}, HTTP/2={'si' if http2 else 'no'})")
+        return {
+            "client": AsyncOpenAI(base_url=base_url, api_key=api_key, http_client=http_client),
+            "model": model,
+            "type": "openai"
+        }
+
 # Instancia global para importar
 settings = Config()
\ No newline at end of file